@@ -0,0 +1,317 @@
+"""Benchmark format_sql performance.
+
+Measures each formatting stage over the SQL files in the repository and over
+synthetic queries made from concatenated copies of a base query. Results can
+be saved as JSON and compared against a saved baseline. Comparisons are only
+reported, because throughput and peak memory both vary with the machine, the
+Python version, and what earlier stages left allocated.
+
+The split stage strips comments and splits statements the way UDF files are
+parsed, and can be compared to sqlparse with e.g.
+--stages split sqlparse_split --dirs udf udf_js udf_legacy templates --scales
+"""
+
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+import json
+import os
+import os.path
+import time
+import tracemalloc
+
+from .formatter import inline_block_format, reformat, reformat_stream
+from .tokenizer import tokenize
+from .tree import split
+
+DEFAULT_DIRS = ("templates", "udf", "udf_js")
+DEFAULT_BASE = "templates/telemetry_derived/clients_daily_v6/query.sql"
+
+
+def run_tokenize(text):
+    """Tokenize text and return the number of tokens."""
+    return sum(1 for _ in tokenize(text))
+
+
+def run_format(tokens):
+    """Format a list of tokens."""
+    for _ in inline_block_format(tokens):
+        pass
+
+
+def run_reformat(text):
+    """Reformat text."""
+    reformat(text)
+
+
+def run_reformat_stream(path):
+    """Reformat the file at path as a stream."""
+    with open(path) as fp:
+        for _ in reformat_stream(fp):
+            pass
+
+
+def run_split(text):
+    """Strip comments and split text into statements."""
+    split(text, strip_comments=True)
+
+
+def run_sqlparse_split(text):
+    """Strip comments and split text into statements with sqlparse."""
+    # sqlparse is only needed for comparison, so CI can run without it
+    import sqlparse
+
+    sqlparse.split(sqlparse.format(text, strip_comments=True))
+
+
+# stage name to (function, whether the function takes text, tokens, or a path)
+STAGES = {
+    "tokenize": (run_tokenize, "text"),
+    "format": (run_format, "tokens"),
+    "reformat": (run_reformat, "text"),
+    "reformat_stream": (run_reformat_stream, "path"),
+    "split": (run_split, "text"),
+    "sqlparse_split": (run_sqlparse_split, "text"),
+}
+# sqlparse is only benchmarked for comparison when requested
+DEFAULT_STAGES = [stage for stage in STAGES if stage != "sqlparse_split"]
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument(
+    "--dirs",
+    nargs="*",
+    default=DEFAULT_DIRS,
+    help="Directories to recursively search for .sql files to use as the corpus",
+)
+parser.add_argument(
+    "--base",
+    default=DEFAULT_BASE,
+    help="SQL file to use as the base query for synthetic inputs",
+)
+parser.add_argument(
+    "--scales",
+    nargs="*",
+    default=[10, 100],
+    type=int,
+    help="Number of copies of the base query to concatenate for synthetic inputs",
+)
+parser.add_argument(
+    "--stages",
+    nargs="+",
+    default=DEFAULT_STAGES,
+    choices=list(STAGES),
+    help="Stages to benchmark",
+)
+parser.add_argument(
+    "--repeat",
+    default=1,
+    type=int,
+    help="Number of times to time each stage; the fastest time is reported",
+)
+parser.add_argument(
+    "--no-memory",
+    "--no_memory",
+    dest="memory",
+    action="store_false",
+    help="Skip measuring peak memory, which requires an extra run of each stage",
+)
+parser.add_argument(
+    "--output",
+    metavar="FILE",
+    help="Write results as JSON to FILE, e.g. to save a new baseline",
+)
+parser.add_argument(
+    "--baseline",
+    metavar="FILE",
+    help="Compare results for synthetic inputs against a baseline JSON file, and "
+    "report stages that are slower or use more memory than allowed by --tolerance",
+)
+parser.add_argument(
+    "--tolerance",
+    default=0.25,
+    type=float,
+    help="Fraction by which results may be worse than the baseline; defaults to 0.25",
+)
+
+
+def read_corpus(dirs):
+    """Read every .sql file in dirs."""
+    texts = []
+    for directory in dirs:
+        for root, _, files in os.walk(directory):
+            for filename in sorted(files):
+                if filename.endswith(".sql"):
+                    with open(os.path.join(root, filename)) as fp:
+                        texts.append(fp.read())
+    return texts
+
+
+def scaled_query(query, scale):
+    """Concatenate scale copies of query as separate statements."""
+    return ";\n".join([query.rstrip().rstrip(";")] * scale) + "\n"
+
+
+def calibrate(repeat=3):
+    """Time a fixed workload, to normalize results across machines.
+
+    Throughput multiplied by calibration seconds is roughly independent of
+    the speed of the machine the benchmark runs on.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sum(len(str(i)) for i in range(10 ** 6))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_stage(stage, texts, repeat, memory):
+    """Measure time and peak memory to run stage on each of texts."""
+    func, input_type = STAGES[stage]
+    with TemporaryDirectory() as tmp:
+        if input_type == "tokens":
+            inputs = [list(tokenize(text)) for text in texts]
+        elif input_type == "path":
+            # streams read from disk, so their input isn't counted as memory used
+            inputs = [os.path.join(tmp, f"{i}.sql") for i in range(len(texts))]
+            for path, text in zip(inputs, texts):
+                with open(path, "w") as fp:
+                    fp.write(text)
+        else:
+            inputs = texts
+        return _measure(func, inputs, repeat, memory)
+
+
+def _measure(func, inputs, repeat, memory):
+    """Measure time and peak memory to run func on each of inputs."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in inputs:
+            func(value)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    result = {"seconds": seconds}
+    if memory:
+        # measure separately because tracing slows down execution
+        peak = 0
+        for value in inputs:
+            tracemalloc.start()
+            try:
+                func(value)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        result["peak_memory_bytes"] = peak
+    return result
+
+
+def benchmark(inputs, stages, repeat=1, memory=True):
+    """Benchmark stages for each named list of texts in inputs."""
+    results = {}
+    for name, texts in inputs.items():
+        num_bytes = sum(len(text) for text in texts)
+        num_tokens = sum(run_tokenize(text) for text in texts)
+        result = results[name] = {
+            "files": len(texts),
+            "bytes": num_bytes,
+            "tokens": num_tokens,
+            "stages": {},
+        }
+        for stage in stages:
+            measured = result["stages"][stage] = measure_stage(
+                stage, texts, repeat, memory
+            )
+            measured["bytes_per_second"] = num_bytes / measured["seconds"]
+            measured["tokens_per_second"] = num_tokens / measured["seconds"]
+    return results
+
+
+def print_results(results):
+    """Print results as a table."""
+    print(
+        f"{'input':<16} {'stage':<16} {'files':>5} {'bytes':>9} {'seconds':>8} "
+        f"{'tokens/s':>9} {'bytes/s':>10} {'peak MiB':>8}"
+    )
+    for name, result in results.items():
+        for stage, measured in result["stages"].items():
+            peak = measured.get("peak_memory_bytes")
+            print(
+                f"{name:<16} {stage:<16} {result['files']:>5} {result['bytes']:>9} "
+                f"{measured['seconds']:>8.2f} {measured['tokens_per_second']:>9.0f} "
+                f"{measured['bytes_per_second']:>10.0f} "
+                + (f"{peak / 2 ** 20:>8.1f}" if peak is not None else f"{'-':>8}")
+            )
+
+
+def compare(report, baseline, tolerance):
+    """Compare a report to a baseline report and return a list of differences.
+
+    Throughput is normalized by calibration time before comparing. Only inputs
+    and stages present in both reports are compared, except for the corpus,
+    which changes whenever SQL files are added or edited, and inputs that are
+    no longer the same size as in the baseline.
+    """
+    differences = []
+    scale = report["calibration_seconds"] / baseline["calibration_seconds"]
+    for name, result in report["results"].items():
+        if name == "corpus" or result["bytes"] != baseline["results"].get(name, {}).get(
+            "bytes"
+        ):
+            continue
+        for stage, measured in result["stages"].items():
+            try:
+                expected = baseline["results"][name]["stages"][stage]
+            except KeyError:
+                continue
+            throughput = measured["bytes_per_second"] * scale
+            if throughput < expected["bytes_per_second"] * (1 - tolerance):
+                differences.append(
+                    f"{name} {stage}: normalized throughput "
+                    f"{throughput:.0f} bytes/s is below baseline "
+                    f"{expected['bytes_per_second']:.0f} bytes/s"
+                )
+            peak = measured.get("peak_memory_bytes")
+            expected_peak = expected.get("peak_memory_bytes")
+            if None not in (peak, expected_peak) and peak > expected_peak * (
+                1 + tolerance
+            ):
+                differences.append(
+                    f"{name} {stage}: peak memory {peak} bytes is above baseline "
+                    f"{expected_peak} bytes"
+                )
+    return differences
+
+
+def main():
+    """Run benchmarks."""
+    args = parser.parse_args()
+    inputs = {}
+    if args.dirs:
+        inputs["corpus"] = read_corpus(args.dirs)
+    if args.scales:
+        with open(args.base) as fp:
+            base = fp.read()
+        for scale in args.scales:
+            inputs[f"synthetic_{scale}x"] = [scaled_query(base, scale)]
+    report = {
+        "calibration_seconds": calibrate(),
+        "results": benchmark(inputs, args.stages, args.repeat, args.memory),
+    }
+    print_results(report["results"])
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        differences = compare(report, baseline, args.tolerance)
+        for difference in differences:
+            print(f"WORSE THAN BASELINE: {difference}")
+        if not differences:
+            print(f"No stages are worse than {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Caches that avoid formatting the same queries and statements again."""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import os.path
+
+FORMAT_SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def formatter_version():
+    """Hash the source code of format_sql.
+
+    Cached results are only valid for the formatter version that produced them,
+    so any change to format_sql invalidates the cache.
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(FORMAT_SQL_DIR)):
+        if filename.endswith(".py"):
+            digest.update(filename.encode())
+            with open(os.path.join(FORMAT_SQL_DIR, filename), "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def content_hash(text):
+    """Hash query text for use as a cache key."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class FormatCache:
+    """Persistent set of content hashes for queries that reformat won't change."""
+
+    def __init__(self, path, version=None):
+        """Initialize, discarding cached results from other formatter versions."""
+        self.path = path
+        self.version = version or formatter_version()
+        self.formatted = set()
+        self.modified = False
+        try:
+            with open(path) as fp:
+                cache = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        if isinstance(cache, dict) and cache.get("version") == self.version:
+            self.formatted = set(cache.get("formatted", []))
+
+    def __contains__(self, key):
+        """Determine whether key is the hash of a formatted query."""
+        return key in self.formatted
+
+    def add(self, key):
+        """Record key as the hash of a formatted query."""
+        if key not in self.formatted:
+            self.formatted.add(key)
+            self.modified = True
+
+    def save(self):
+        """Atomically write the cache to disk if it was modified."""
+        if not self.modified:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {"version": self.version, "formatted": sorted(self.formatted)}, fp
+            )
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+
+class StatementCacheEntry:
+    """Tokens and formatted text of a statement in a StatementCache."""
+
+    __slots__ = ("text", "tokens", "following", "at_end", "formatted")
+
+    def __init__(self, text, tokens, following, at_end):
+        """Initialize."""
+        self.text = text
+        self.tokens = tokens
+        # text after the statement that its tokens and boundary depend on
+        self.following = following
+        # whether following must be all of the remaining text
+        self.at_end = at_end
+        # formatted text by format function
+        self.formatted = {}
+
+
+class StatementCache:
+    """In-memory LRU cache of tokenized and formatted statements.
+
+    Statements are found by their text at a statement boundary in a query, so
+    that repeated statements, such as temporary UDF definitions prepended to
+    many generated queries, are tokenized and formatted once per process.
+    Statements shorter than prefix_length are not cached, because they are
+    cheap to format and would make lookups slower.
+    """
+
+    def __init__(self, maxsize=1024, prefix_length=64):
+        """Initialize."""
+        self.maxsize = maxsize
+        self.prefix_length = prefix_length
+        self.entries = OrderedDict()
+        # statement texts by prefix, to find statements without knowing their end
+        self.by_prefix = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Get the number of cached statements."""
+        return len(self.entries)
+
+    def _prefix(self, text, pos=0):
+        """Get the prefix used to look up statements starting at pos in text."""
+        stop = pos + self.prefix_length
+        return text[pos:stop]
+
+    def match(self, query, pos):
+        """Get the cached statement that starts at pos in query, if any.
+
+        A statement only matches if the text after it is also the same as far as
+        its tokens and the boundary at its end depend on it.
+        """
+        for text in self.by_prefix.get(self._prefix(query, pos), ()):
+            if not query.startswith(text, pos):
+                continue
+            entry = self.entries[text]
+            end = pos + len(text)
+            if query.startswith(entry.following, end) and not (
+                entry.at_end and end + len(entry.following) != len(query)
+            ):
+                self.entries.move_to_end(text)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def add(self, text, tokens, following, at_end):
+        """Add a statement and return its entry, evicting the oldest if full."""
+        entry = StatementCacheEntry(text, tokens, following, at_end)
+        if len(text) < self.prefix_length or self.maxsize <= 0:
+            return entry
+        if text not in self.entries:
+            self.by_prefix.setdefault(self._prefix(text), []).append(text)
+            if len(self.entries) >= self.maxsize:
+                self._evict()
+        self.entries[text] = entry
+        self.entries.move_to_end(text)
+        return entry
+
+    def _evict(self):
+        """Remove the least recently used statement."""
+        text, _ = self.entries.popitem(last=False)
+        prefix = self._prefix(text)
+        self.by_prefix[prefix].remove(text)
+        if not self.by_prefix[prefix]:
+            del self.by_prefix[prefix]
+        self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        """Get the fraction of statement lookups that were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        """Describe cache usage.
+
+        Entries are omitted if there are none, e.g. because counts were summed
+        from caches in other processes.
+        """
+        report = (
+            f"statement cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate), {self.evictions} evictions"
+        )
+        if self.entries:
+            report += f", {len(self)} of {self.maxsize} entries used"
+        return report
@@ -1,7 +1,6 @@
 """Format SQL."""
 
-from dataclasses import replace
-import re
+from collections import deque
 
 from .tokenizer import (
     AliasSeparator,
@@ -22,9 +21,82 @@ from .tokenizer import (
     StatementSeparator,
     TopLevelKeyword,
     Whitespace,
+    is_terminated,
+    lookahead,
     tokenize,
+    tokenize_stream,
 )
 
+# Bit flags for the behaviour of each token type, so that formatting a token
+# requires one lookup and bitwise tests instead of chains of isinstance checks
+WHITESPACE = 1 << 0
+COMMENT = 1 << 1
+OPENING_BRACKET = 1 << 2
+CLOSING_BRACKET = 1 << 3
+TOP_LEVEL_KEYWORD = 1 << 4
+BLOCK_START_KEYWORD = 1 << 5
+BLOCK_END_KEYWORD = 1 << 6
+STATEMENT_SEPARATOR = 1 << 7
+ALIAS_SEPARATOR = 1 << 8
+FIELD_ACCESS_OPERATOR = 1 << 9
+OPERATOR = 1 << 10
+# may be preceded by a unary operator without a space
+OPERAND = 1 << 11
+# gets capitalized
+CAPITALIZE = 1 << 12
+# must be preceded by a newline
+NEWLINE_BEFORE = 1 << 13
+# must be followed by a newline
+NEWLINE_AFTER = 1 << 14
+# must not be preceded by a space
+NO_SPACE_BEFORE = 1 << 15
+# may be followed by a space before an opening bracket
+SPACE_BEFORE_NEXT_BRACKET = 1 << 16
+
+TOKEN_BEHAVIOURS = [
+    (WHITESPACE, (Whitespace,)),
+    (COMMENT, (Comment,)),
+    (OPENING_BRACKET, (OpeningBracket,)),
+    (CLOSING_BRACKET, (ClosingBracket,)),
+    (TOP_LEVEL_KEYWORD, (TopLevelKeyword,)),
+    (BLOCK_START_KEYWORD, (BlockStartKeyword,)),
+    (BLOCK_END_KEYWORD, (BlockEndKeyword,)),
+    (STATEMENT_SEPARATOR, (StatementSeparator,)),
+    (ALIAS_SEPARATOR, (AliasSeparator,)),
+    (FIELD_ACCESS_OPERATOR, (FieldAccessOperator,)),
+    (OPERATOR, (Operator,)),
+    (OPERAND, (Literal, Identifier)),
+    (CAPITALIZE, (ReservedKeyword,)),
+    (NEWLINE_BEFORE, (NewlineKeyword, ClosingBracket, BlockKeyword)),
+    (
+        NEWLINE_AFTER,
+        (
+            Comment,
+            BlockKeyword,
+            TopLevelKeyword,
+            OpeningBracket,
+            ExpressionSeparator,
+            StatementSeparator,
+        ),
+    ),
+    (NO_SPACE_BEFORE, (FieldAccessOperator, ExpressionSeparator)),
+    (SPACE_BEFORE_NEXT_BRACKET, (SpaceBeforeBracketKeyword, Operator)),
+]
+
+
+class _TokenFlags(dict):
+    """Table of token type to behaviour flags."""
+
+    def __missing__(self, token_type):
+        """Compute flags the first time token_type is seen."""
+        flags = self[token_type] = sum(
+            flag for flag, types in TOKEN_BEHAVIOURS if issubclass(token_type, types)
+        )
+        return flags
+
+
+TOKEN_FLAGS = _TokenFlags()
+
 
 def simple_format(tokens, indent="  "):
     """Format tokens in a single pass."""
@@ -37,105 +109,93 @@ def simple_format(tokens, indent="  "):
     next_operator_is_unary = True
     indent_types = []
     can_format = True
+    # reuse whitespace tokens instead of creating one for each use
+    space, newline, indents = Whitespace(" "), Whitespace("\n"), {}
     for token in tokens:
+        flags = TOKEN_FLAGS[type(token)]
         # skip original whitespace tokens, unless formatting is disabled
-        if isinstance(token, Whitespace):
+        if flags & WHITESPACE:
             if not can_format:
                 yield token
             continue
 
         # update state for current token
-        if isinstance(token, Comment):
+        if flags & COMMENT:
             # enable to disable formatting
             if can_format and token.format_off:
                 can_format = False
             elif not can_format and token.format_on:
                 can_format = True
-        elif isinstance(token, ClosingBracket):
+        elif flags & CLOSING_BRACKET:
             # decrease indent to match last OpeningBracket
             while indent_types and indent_types.pop() is not OpeningBracket:
                 pass
-        elif isinstance(token, TopLevelKeyword):
+        elif flags & TOP_LEVEL_KEYWORD:
             # decrease indent from previous TopLevelKeyword
             if indent_types and indent_types[-1] is TopLevelKeyword:
                 indent_types.pop()
-        elif isinstance(token, BlockEndKeyword):
+        elif flags & BLOCK_END_KEYWORD:
             # decrease indent to match last BlockKeyword
             while indent_types and indent_types.pop() is not BlockKeyword:
                 pass
             prev_was_statement_separator = False
 
         # yield whitespace
-        if not can_format or isinstance(token, StatementSeparator) or first_token:
+        if not can_format or flags & STATEMENT_SEPARATOR or first_token:
             # except between statements
             # no new whitespace when formatting is disabled
             # no space before statement separator
             # no space before first token
             pass
-        elif isinstance(token, Comment):
+        elif flags & COMMENT:
             # blank line before comments only if they start on their own line
             # and come after a statement separator
             if token.value.startswith("\n") and prev_was_statement_separator:
-                yield Whitespace("\n")
+                yield newline
         elif (
             require_newline_before_next_token
-            or isinstance(token, (NewlineKeyword, ClosingBracket, BlockKeyword))
+            or flags & NEWLINE_BEFORE
             or prev_was_statement_separator
         ):
             if prev_was_statement_separator:
-                yield Whitespace("\n")
-            yield Whitespace("\n" + indent * len(indent_types))
+                yield newline
+            depth = len(indent_types)
+            if depth not in indents:
+                indents[depth] = Whitespace("\n" + indent * depth)
+            yield indents[depth]
         elif (
             allow_space_before_next_token
-            and (
-                allow_space_before_next_bracket or not isinstance(token, OpeningBracket)
-            )
-            and not isinstance(token, (FieldAccessOperator, ExpressionSeparator))
-            and not (
-                prev_was_unary_operator and isinstance(token, (Literal, Identifier))
-            )
+            and (allow_space_before_next_bracket or not flags & OPENING_BRACKET)
+            and not flags & NO_SPACE_BEFORE
+            and not (prev_was_unary_operator and flags & OPERAND)
         ):
-            yield Whitespace(" ")
+            yield space
 
         # uppercase keywords and replace contained whitespace with single spaces
-        if isinstance(token, ReservedKeyword) and can_format:
-            token = replace(token, value=re.sub(r"\s+", " ", token.value.upper()))
+        if flags & CAPITALIZE and can_format:
+            token = type(token)(" ".join(token.value.upper().split()))
 
         yield token
 
         # update state for next token
-        require_newline_before_next_token = isinstance(
-            token,
-            (
-                Comment,
-                BlockKeyword,
-                TopLevelKeyword,
-                OpeningBracket,
-                ExpressionSeparator,
-                StatementSeparator,
-            ),
-        )
-        allow_space_before_next_token = not isinstance(token, FieldAccessOperator)
-        prev_was_statement_separator = isinstance(token, StatementSeparator)
-        prev_was_unary_operator = next_operator_is_unary and isinstance(token, Operator)
-        if not isinstance(token, Comment):
+        require_newline_before_next_token = bool(flags & NEWLINE_AFTER)
+        allow_space_before_next_token = not flags & FIELD_ACCESS_OPERATOR
+        prev_was_statement_separator = bool(flags & STATEMENT_SEPARATOR)
+        prev_was_unary_operator = next_operator_is_unary and bool(flags & OPERATOR)
+        if not flags & COMMENT:
             # format next operator as unary if there is no preceding argument
-            next_operator_is_unary = not isinstance(
-                token, (Literal, Identifier, ClosingBracket)
-            )
-        allow_space_before_next_bracket = isinstance(
-            token, (SpaceBeforeBracketKeyword, Operator)
-        )
-        if isinstance(token, TopLevelKeyword) and token.value == "WITH":
+            next_operator_is_unary = not flags & (OPERAND | CLOSING_BRACKET)
+        allow_space_before_next_bracket = bool(flags & SPACE_BEFORE_NEXT_BRACKET)
+        if flags & TOP_LEVEL_KEYWORD and token.value == "WITH":
             # don't indent CTE's and don't put the first one on a new line
             require_newline_before_next_token = False
-        elif isinstance(token, BlockStartKeyword):
+        elif flags & BLOCK_START_KEYWORD:
             # increase indent
             indent_types.append(BlockKeyword)
-        elif isinstance(token, (TopLevelKeyword, OpeningBracket)):
+        elif flags & (TOP_LEVEL_KEYWORD | OPENING_BRACKET):
             # increase indent
             indent_types.append(type(token))
-        elif isinstance(token, StatementSeparator):
+        elif flags & STATEMENT_SEPARATOR:
             # decrease for previous top level keyword
             if indent_types and indent_types[-1] is TopLevelKeyword:
                 indent_types.pop()
@@ -145,6 +205,14 @@ def simple_format(tokens, indent="  "):
 class Line:
     """Container for a line of tokens."""
 
+    __slots__ = (
+        "indent_token",
+        "can_format",
+        "indent_level",
+        "inline_tokens",
+        "inline_length",
+    )
+
     def __init__(self, indent_token=None, can_format=True):
         """Initialize."""
         self.indent_token = indent_token
@@ -157,13 +225,15 @@ class Line:
                 self.indent_level -= 1
         self.inline_tokens = []
         self.inline_length = 0
-        self.can_format = can_format and not isinstance(indent_token, Comment)
+        self.can_format = can_format and not (
+            indent_token is not None and TOKEN_FLAGS[type(indent_token)] & COMMENT
+        )
 
     def add(self, token):
         """Add a token to this line."""
         self.inline_length += len(token.value)
         self.inline_tokens.append(token)
-        self.can_format = self.can_format and not isinstance(token, Comment)
+        self.can_format = self.can_format and not TOKEN_FLAGS[type(token)] & COMMENT
 
     @property
     def tokens(self):
@@ -189,19 +259,46 @@ class Line:
             and self.ends_with_opening_bracket
             and not (
                 len(self.inline_tokens) > 2
-                and isinstance(self.inline_tokens[-3], AliasSeparator)
+                and TOKEN_FLAGS[type(self.inline_tokens[-3])] & ALIAS_SEPARATOR
             )
         )
 
     @property
     def ends_with_opening_bracket(self):
         """Determine if this line ends with an OpeningBracket."""
-        return self.inline_tokens and isinstance(self.inline_tokens[-1], OpeningBracket)
+        return bool(
+            self.inline_tokens
+            and TOKEN_FLAGS[type(self.inline_tokens[-1])] & OPENING_BRACKET
+        )
 
     @property
     def starts_with_closing_bracket(self):
         """Determine if this line starts with a ClosingBracket."""
-        return self.inline_tokens and isinstance(self.inline_tokens[0], ClosingBracket)
+        return bool(
+            self.inline_tokens
+            and TOKEN_FLAGS[type(self.inline_tokens[0])] & CLOSING_BRACKET
+        )
+
+
+def group_lines(tokens):
+    """Group tokens into lines, starting a new line for each newline token."""
+    line = Line()
+    can_format = True
+    for token in tokens:
+        if token.value.startswith("\n"):
+            yield line
+            line = Line(token, can_format)
+        else:
+            line.add(token)
+        if TOKEN_FLAGS[type(token)] & COMMENT:
+            if can_format and token.format_off:
+                # disable formatting for current and following lines
+                line.can_format = False
+                can_format = False
+            elif not can_format and token.format_on:
+                # enable formatting for following lines
+                can_format = True
+    yield line
 
 
 def inline_block_format(tokens, max_line_length=100):
@@ -230,46 +327,46 @@ def inline_block_format(tokens, max_line_length=100):
     Implementation requires simple_format to put opening brackets at the end of
     the line and closing brackets at the beginning of the line, unless there is
     a comment between them.
+
+    Lines are read lazily, and only the lines following a block start that fit
+    in max_line_length are buffered, so output is produced incrementally.
     """
     # format tokens using simple_format, then group into lines
-    lines = [Line()]
-    can_format = True
-    for token in simple_format(tokens):
-        if token.value.startswith("\n"):
-            lines.append(Line(token, can_format))
-        else:
-            lines[-1].add(token)
-        if isinstance(token, Comment):
-            if can_format and token.format_off:
-                # disable formatting for current and following lines
-                lines[-1].can_format = False
-                can_format = False
-            elif not can_format and token.format_on:
-                # enable formatting for following lines
-                can_format = True
-
+    lines = group_lines(simple_format(tokens))
+    # lines that have been read to check whether a block can be inlined
+    lookahead = deque()
+
+    def peek(index):
+        """Get the line at index in lookahead, reading more lines if needed."""
+        while len(lookahead) <= index:
+            line = next(lines, None)
+            if line is None:
+                return None
+            lookahead.append(line)
+        return lookahead[index]
+
+    space = Whitespace(" ")
     # combine all lines in each bracket block that fits in max_line_length
-    skip_lines = 0
-    for index, line in enumerate(lines):
-        if skip_lines > 0:
-            skip_lines -= 1
-            continue
+    while peek(0) is not None:
+        line = lookahead.popleft()
         yield from line.tokens
         if line.can_start_inline_block:
             indent_level = line.indent_level
             line_length = indent_level + line.inline_length
-            pending_lines = 0
+            skip_lines = pending_lines = 0
             pending = []
             last_token_was_opening_bracket = line.ends_with_opening_bracket
-            index += 1  # start on the next line
-            for line in lines[index:]:
+            index = 0  # start on the next line
+            while peek(index) is not None:
+                line = lookahead[index]
+                index += 1
                 if not line.can_format:
                     break
                 if (
                     not last_token_was_opening_bracket
                     and not line.starts_with_closing_bracket
                 ):
-                    pending.append(Whitespace(" "))
+                    pending.append(space)
                     line_length += 1
                 pending_lines += 1
                 pending.extend(line.inline_tokens)
@@ -286,9 +383,282 @@ def inline_block_format(tokens, max_line_length=100):
                     else:
                         break
                 last_token_was_opening_bracket = line.ends_with_opening_bracket
+            for _ in range(skip_lines):
+                lookahead.popleft()
+
+
+def _continues_statement(flags, token):
+    """Determine whether token after a split point stays with the statement."""
+    return bool(
+        flags & (WHITESPACE | STATEMENT_SEPARATOR)
+        or (flags & COMMENT and not token.value.startswith("\n"))
+    )
+
+
+def split_statements(tokens):
+    """Split tokens into statements that can be formatted independently.
+
+    Split after each StatementSeparator where formatting is enabled and no
+    brackets, blocks or top level keywords are left open, because there both
+    simple_format and the tokenizer are in the same state as at the start of a
+    query. Comments and separators on the same line as the separator stay with
+    it, because they are part of the same line when inlining blocks.
+
+    Formatting each statement and joining them with statement_whitespace
+    produces the same result as formatting all tokens at once. Indentation is
+    tracked the same way as in simple_format, which this must be kept in sync
+    with.
+    """
+    statement = []
+    indent_types = []
+    can_format = True
+    open_angle_brackets = 0
+    split = False
+    for token in tokens:
+        flags = TOKEN_FLAGS[type(token)]
+        if split and not _continues_statement(flags, token):
+            yield statement
+            statement = []
+        statement.append(token)
+        if flags & WHITESPACE:
+            continue
+        split = False
+        if flags & COMMENT:
+            if can_format and token.format_off:
+                can_format = False
+            elif not can_format and token.format_on:
+                can_format = True
+        elif flags & CLOSING_BRACKET:
+            while indent_types and indent_types.pop() is not OpeningBracket:
+                pass
+            if token.value == ">":
+                open_angle_brackets -= 1
+        elif flags & TOP_LEVEL_KEYWORD:
+            if indent_types and indent_types[-1] is TopLevelKeyword:
+                indent_types.pop()
+        elif flags & BLOCK_END_KEYWORD:
+            while indent_types and indent_types.pop() is not BlockKeyword:
+                pass
+        if flags & TOP_LEVEL_KEYWORD and (
+            (" ".join(token.value.upper().split()) if can_format else token.value)
+            == "WITH"
+        ):
+            pass
+        elif flags & BLOCK_START_KEYWORD:
+            indent_types.append(BlockKeyword)
+        elif flags & (TOP_LEVEL_KEYWORD | OPENING_BRACKET):
+            indent_types.append(type(token))
+            if token.value == "<":
+                open_angle_brackets += 1
+        elif flags & STATEMENT_SEPARATOR:
+            if indent_types and indent_types[-1] is TopLevelKeyword:
+                indent_types.pop()
+            split = can_format and not indent_types and not open_angle_brackets
+    if statement:
+        yield statement
+
+
+def _trailing_comments(tokens):
+    """Get the comments after the last StatementSeparator in tokens."""
+    trailing = []
+    for token in reversed(tokens):
+        flags = TOKEN_FLAGS[type(token)]
+        if flags & STATEMENT_SEPARATOR:
+            break
+        if flags & COMMENT:
+            trailing.insert(0, token)
+    return trailing
+
 
+def _separator_whitespace(trailing, token):
+    """Get the whitespace simple_format puts before token after a separator.
 
-def reformat(query, format_=inline_block_format):
-    """Reformat query and return as a string."""
+    Trailing must be the comments between the separator and token.
+    """
+    preceding = [StatementSeparator(";"), *trailing]
+    formatted = list(simple_format(preceding + [token]))
+    start = len(preceding)
+    return "".join(token.value for token in formatted[start:-1])
+
+
+def _first_token(tokens):
+    """Get the first token that isn't whitespace, or None."""
+    for token in tokens:
+        if not TOKEN_FLAGS[type(token)] & WHITESPACE:
+            return token
+    return None
+
+
+def statement_whitespace(previous, statement):
+    """Get the whitespace between two consecutive statements from split_statements.
+
+    This is the whitespace simple_format puts before the first token of
+    statement that isn't whitespace, which depends on any comments that follow
+    the last StatementSeparator in previous.
+    """
+    token = _first_token(statement)
+    if token is None:
+        return ""
+    return _separator_whitespace(_trailing_comments(previous), token)
+
+
+def reformat(query, format_=inline_block_format, cache=None, jobs=1):
+    """Reformat query and return as a string.
+
+    If cache is a StatementCache, statements found in it are not tokenized or
+    formatted again, and new statements are added to it.
+
+    If jobs is more than 1, large queries are split into chunks of statements
+    that are tokenized and formatted in a pool of that many processes. The
+    result is identical to formatting the whole query at once.
+    """
+    if jobs > 1:
+        if cache is not None:
+            raise ValueError("cache can't be used with more than one job")
+        return _reformat_parallel(query, format_, jobs)
+    if cache is not None:
+        return "".join(_reformat_cached(query, format_, cache))
     tokens = format_(tokenize(query))
     return "".join(token.value for token in tokens)
+
+
+def _reformat_cached(query, format_, cache):
+    """Reformat query one statement at a time using cache, and yield the result."""
+    pos, previous, statements = 0, None, None
+    while pos < len(query):
+        entry = cache.match(query, pos)
+        if entry is not None:
+            # the rest of the query must be tokenized from the end of the entry
+            statements = None
+        else:
+            if statements is None:
+                statements = split_statements(tokenize(query[pos:]))
+            tokens = next(statements)
+            end, terminated = pos, True
+            for token in tokens:
+                terminated = terminated and is_terminated(query, end, token)
+                end += len(token.value)
+            # unterminated tokens depend on all of the following text
+            following = lookahead(query, end) if terminated else None
+            entry = cache.add(
+                query[pos:end],
+                tokens,
+                query[end:] if following is None else following,
+                following is None,
+            )
+        if format_ not in entry.formatted:
+            entry.formatted[format_] = "".join(
+                token.value for token in format_(entry.tokens)
+            )
+        if previous is not None:
+            yield statement_whitespace(previous, entry.tokens)
+        yield entry.formatted[format_]
+        previous = entry.tokens
+        pos += len(entry.text)
+
+
+def _statement_start(query, pos):
+    """Find where split_statements starts a statement after a separator at pos."""
+    for token in tokenize(query[pos:]):
+        if not _continues_statement(TOKEN_FLAGS[type(token)], token):
+            break
+        pos += len(token.value)
+    return pos
+
+
+def _format_statements(query, start, stop, format_):
+    """Format statements from a statement boundary at start.
+
+    Stop after the first statement that ends at or after stop. Return where the
+    last statement ends, the first token of the first statement that isn't
+    whitespace, the comments after the last statement separator, and the
+    formatted text of the statements.
+    """
+    parts, end, first, previous = [], start, None, []
+    for tokens in split_statements(tokenize(query[start:])):
+        if end == start:
+            first = _first_token(tokens)
+        else:
+            parts.append(statement_whitespace(previous, tokens))
+        parts.append("".join(token.value for token in format_(tokens)))
+        end += sum(len(token.value) for token in tokens)
+        previous = tokens
+        if end >= stop:
+            break
+    return end, first, _trailing_comments(previous), "".join(parts)
+
+
+# minimum average size of chunks when formatting a query in parallel
+PARALLEL_CHUNK_SIZE = 2 ** 16
+
+
+# arguments for _format_chunk in worker processes, set by _init_worker
+_worker_args = None
+
+
+def _init_worker(query, format_):
+    """Initialize a worker process for _reformat_parallel."""
+    global _worker_args
+    _worker_args = query, format_
+
+
+def _format_chunk(chunk):
+    """Format statements from the first statement after chunk start until stop.
+
+    Return where the first statement starts, followed by the result of
+    _format_statements.
+    """
+    query, format_ = _worker_args
+    start, stop = chunk
+    if start > 0:
+        start = _statement_start(query, start)
+    return (start, *_format_statements(query, start, stop, format_))
+
+
+def _reformat_parallel(query, format_, jobs):
+    """Reformat query by formatting chunks of statements in parallel.
+
+    Chunks start after a statement separator, which is only known to be at a
+    statement boundary once the previous chunk is formatted. Chunks that don't
+    start where the previous chunk ended are formatted again from there.
+    """
+    # imported here because it is slow to import and rarely needed
+    from multiprocessing import Pool
+
+    num_chunks = min(jobs * 4, len(query) // PARALLEL_CHUNK_SIZE)
+    chunks, start = [], 0
+    for index in range(1, num_chunks):
+        stop = query.find(";", len(query) * index // num_chunks) + 1
+        if stop > start:
+            chunks.append((start, stop))
+            start = stop
+    chunks.append((start, len(query)))
+    if len(chunks) < 2:
+        return reformat(query, format_)
+    parts, pos, trailing = [], 0, None
+    with Pool(jobs, _init_worker, (query, format_)) as pool:
+        for (_, stop), result in zip(chunks, pool.imap(_format_chunk, chunks)):
+            if pos >= stop:
+                # already formatted while correcting a previous chunk
+                continue
+            start, *result = result
+            if start != pos:
+                result = _format_statements(query, pos, stop, format_)
+            end, first, chunk_trailing, text = result
+            if end > pos:
+                if trailing is not None:
+                    parts.append(_separator_whitespace(trailing, first))
+                parts.append(text)
+                trailing = chunk_trailing
+            pos = end
+    return "".join(parts)
+
+
+def reformat_stream(file_obj, format_=inline_block_format):
+    """Reformat a query read from file_obj and yield the result incrementally.
+
+    Output is identical to reformat(file_obj.read()), but memory use does not
+    grow with the size of the query.
+    """
+    for token in format_(tokenize_stream(file_obj)):
+        yield token.value
@@ -0,0 +1,167 @@
+"""Reformat queries incrementally as they are edited."""
+
+from dataclasses import dataclass
+from typing import List
+
+from .formatter import inline_block_format, split_statements, statement_whitespace
+from .tokenizer import is_terminated, tokenize
+
+
+@dataclass(frozen=True)
+class TextEdit:
+    """Replacement of text[start:end] with new text."""
+
+    start: int
+    end: int
+    text: str
+
+    def apply(self, text):
+        """Apply this edit to text."""
+        start, end = self.start, self.end
+        return text[:start] + self.text + text[end:]
+
+
+class _Statement:
+    """Statement from split_statements and its formatted text."""
+
+    __slots__ = ("tokens", "length", "terminated", "whitespace", "formatted")
+
+    def __init__(self, tokens, length, terminated, whitespace, formatted):
+        """Initialize."""
+        self.tokens = tokens
+        # length of the statement in the query
+        self.length = length
+        # whether edits after the statement can't change its tokens
+        self.terminated = terminated
+        # formatted whitespace between the previous statement and this one
+        self.whitespace = whitespace
+        self.formatted = formatted
+
+    @property
+    def text(self):
+        """Get the formatted text of this statement, including whitespace."""
+        return self.whitespace + self.formatted
+
+
+class IncrementalFormatter:
+    """Keep the formatted version of a query up to date as the query is edited.
+
+    The query is split into statements that can be formatted independently, and
+    an edit only re-tokenizes and reformats statements from the one where the
+    edit starts until tokenizing reaches a statement boundary after the edit
+    that matches a boundary in the previous version of the query. Everything
+    after that is unchanged, so the previous tokens and formatted text are
+    reused.
+
+    The formatted query is always identical to reformat(query, format_).
+    """
+
+    def __init__(self, query, format_=inline_block_format):
+        """Initialize by formatting query."""
+        self.query = query
+        self.format_ = format_
+        self.statements = list(self._format(query))
+
+    @property
+    def tokens(self):
+        """Get the tokens of the query."""
+        return [token for statement in self.statements for token in statement.tokens]
+
+    @property
+    def formatted(self):
+        """Get the formatted query."""
+        return "".join(statement.text for statement in self.statements)
+
+    def _format(self, query, pos=0, previous=None):
+        """Split query[pos:] into statements and format them lazily.
+
+        Previous must be the tokens of the statement before pos, if any.
+        """
+        for tokens in split_statements(tokenize(query[pos:])):
+            start, terminated = pos, True
+            for token in tokens:
+                terminated = terminated and is_terminated(query, pos, token)
+                pos += len(token.value)
+            yield _Statement(
+                tokens,
+                pos - start,
+                terminated,
+                statement_whitespace(previous, tokens) if previous else "",
+                "".join(token.value for token in self.format_(tokens)),
+            )
+            previous = tokens
+
+    def edit(self, start, end, text) -> List[TextEdit]:
+        """Replace query[start:end] with text and update the formatted query.
+
+        Return edits that update the previous formatted query to the new one,
+        which are empty if the formatted query did not change.
+        """
+        if not 0 <= start <= end <= len(self.query):
+            raise ValueError(f"Invalid edit range {start}:{end}")
+        query = self.query[:start] + text + self.query[end:]
+        delta = len(text) - (end - start)
+        # Tokens only depend on the text up to the end of their statement, so
+        # statements that end before the edit are unchanged. The exception is
+        # unterminated comments, strings and quoted identifiers, which depend
+        # on all of the following text.
+        first, offset, unterminated, index_at_offset = 0, 0, False, {}
+        for index, statement in enumerate(self.statements):
+            if offset >= start:
+                index_at_offset[offset] = index
+            elif not unterminated:
+                first = index
+            unterminated = unterminated or not statement.terminated
+            offset += statement.length
+        offset = sum(statement.length for statement in self.statements[:first])
+        previous = self.statements[first - 1].tokens if first else None
+        # statements after the edit are reused once tokenizing reaches a boundary
+        # from the previous version, because the rest of the query is the same
+        new_statements = []
+        stop = len(self.statements)
+        for statement in self._format(query, offset, previous):
+            new_statements.append(statement)
+            offset += statement.length
+            if offset >= start + len(text) and offset - delta in index_at_offset:
+                stop = index_at_offset[offset - delta]
+                break
+        old = [statement.text for statement in self.statements[first:stop]]
+        new = [statement.text for statement in new_statements]
+        if stop < len(self.statements):
+            # whitespace depends on comments at the end of the previous statement
+            reused = self.statements[stop]
+            old.append(reused.whitespace)
+            reused.whitespace = statement_whitespace(
+                new_statements[-1].tokens, reused.tokens
+            )
+            new.append(reused.whitespace)
+        old_start = sum(len(statement.text) for statement in self.statements[:first])
+        self.query = query
+        self.statements[first:stop] = new_statements
+        return _diff("".join(old), "".join(new), old_start)
+
+
+def _common_prefix_length(a, b):
+    """Get the length of the longest common prefix of a and b.
+
+    Binary search compares slices, which is much faster than comparing
+    characters one at a time in Python for long strings.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _diff(old, new, offset=0):
+    """Get the minimal single edit that changes old to new, offset by offset."""
+    if old == new:
+        return []
+    prefix = _common_prefix_length(old, new)
+    suffix = _common_prefix_length(old[prefix:][::-1], new[prefix:][::-1])
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    return [TextEdit(offset + prefix, offset + old_end, new[prefix:new_end])]
@@ -1,11 +1,15 @@
 """Tokenize SQL so that it can be formatted."""
 
-from dataclasses import dataclass, field
+from functools import lru_cache
 import re
 import sys
+from typing import List, Sequence, Tuple, Union
+
+# a keyword phrase, optionally with a pattern that must match after the phrase
+KeywordSpec = Union[str, Tuple[str, str]]
 
 # These words get their own line followed by increased indent
-TOP_LEVEL_KEYWORDS = [
+TOP_LEVEL_KEYWORDS: List[KeywordSpec] = [
     # DDL
     "ALTER TABLE IF EXISTS",
     "ALTER TABLE",
@@ -67,7 +71,7 @@ TOP_LEVEL_KEYWORDS = [
     "USING",
     "VALUES",
     "WHERE",
-    "WITH(?! OFFSET)",
+    ("WITH", r"(?!\s+OFFSET)"),
     "WINDOW",
 ]
 # These words start a new line at the current indent
@@ -196,29 +200,40 @@ QUOTE = "\"\"\"|'''|\"|'"
 STRING_CONTENT = r"\\.|[^\\]"
 
 
-def _keyword_pattern(words):
-    """
-    Compile a regex that will match the given list of keywords.
+class _TokenType(type):
+    """Metaclass that gives token classes empty __slots__ unless specified.
 
-    Match one or more whitespace characters between words patterns, and only
-    match whole words.
+    A token is created for every word, space and symbol in a query, so tokens
+    only store their value, without a per-instance __dict__.
     """
-    return re.compile(
-        "(?:" + "|".join(pattern.replace(" ", r"\s+") for pattern in words) + r")\b",
-        re.IGNORECASE,
-    )
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        """Create a token class."""
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
 
 
-@dataclass
-class Token:
+class Token(metaclass=_TokenType):
     """Abstract token class."""
 
-    value: str
-    pattern: re.Pattern = field(init=False, repr=False)
+    __slots__ = ("value",)
+    pattern: re.Pattern
+
+    def __init__(self, value):
+        """Initialize."""
+        self.value = value
+
+    def __repr__(self):
+        """Represent token as its type and value."""
+        return f"{type(self).__name__}(value={self.value!r})"
+
+    def __eq__(self, other):
+        """Compare tokens by type and value."""
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.value == other.value
 
-    def __post_init__(self):
-        """Enable post-init for child classes."""
-        pass
+    __hash__ = None  # type: ignore
 
 
 class Comment(Token):
@@ -231,10 +246,15 @@ class Comment(Token):
     _format_off = re.compile(r"\bformat\s*:?\s*off\b")
     _format_on = re.compile(r"\bformat\s*:?\s*on\b")
 
-    def __post_init__(self):
-        """Detect format off/on comments."""
-        self.format_off = self._format_off.search(self.value) is not None
-        self.format_on = self._format_on.search(self.value) is not None
+    @property
+    def format_off(self):
+        """Detect format off comments."""
+        return "format" in self.value and bool(self._format_off.search(self.value))
+
+    @property
+    def format_on(self):
+        """Detect format on comments."""
+        return "format" in self.value and bool(self._format_on.search(self.value))
 
 
 class LineComment(Comment):
@@ -256,15 +276,21 @@ class Whitespace(Token):
 
 
 class ReservedKeyword(Token):
-    """Token that gets capitalized and separates words with a single space."""
+    """Token that gets capitalized and separates words with a single space.
+
+    Instead of a pattern, keyword types list keywords to match in priority
+    order. Each keyword is a phrase of whole words separated by whitespace, or
+    a tuple of a phrase and a pattern that must match after the phrase, e.g. a
+    negative lookahead. Words are matched case insensitively.
+    """
 
-    pattern = _keyword_pattern(RESERVED_KEYWORDS)
+    keywords: Sequence[KeywordSpec] = RESERVED_KEYWORDS
 
 
 class SpaceBeforeBracketKeyword(ReservedKeyword):
     """Keyword that should be separated by a space from a following opening bracket."""
 
-    pattern = _keyword_pattern(["IN", r"\* EXCEPT", r"\* REPLACE", "NOT", "OVER"])
+    keywords: Sequence[KeywordSpec] = ["IN", "* EXCEPT", "* REPLACE", "NOT", "OVER"]
 
 
 class BlockKeyword(ReservedKeyword):
@@ -274,32 +300,36 @@ class BlockKeyword(ReservedKeyword):
 class BlockStartKeyword(BlockKeyword):
     """Keyword that gets its own line followed by increased indent."""
 
-    pattern = _keyword_pattern(
-        [
-            "CREATE OR REPLACE PROCEDURE",
-            "CREATE PROCEDURE IF NOT EXISTS",
-            "CREATE PROCEDURE",
-            # negative lookahead prevents matching IF function
-            r"IF(?!(\s|\n)*[(])",
-            "WHILE",
-            "LOOP",
-            "CASE",
-        ]
-    )
+    keywords = [
+        "CREATE OR REPLACE PROCEDURE",
+        "CREATE PROCEDURE IF NOT EXISTS",
+        "CREATE PROCEDURE",
+        # negative lookahead prevents matching IF function
+        ("IF", r"(?!\s*[(])"),
+        "WHILE",
+        "LOOP",
+        "CASE",
+    ]
 
 
 class BlockEndKeyword(BlockKeyword):
     """Keyword that gets its own line preceded by decreased indent."""
 
-    pattern = _keyword_pattern(["END( (WHILE|LOOP|IF))?"])
+    keywords = ["END WHILE", "END LOOP", "END IF", "END"]
 
 
 class BlockMiddleKeyword(BlockStartKeyword, BlockEndKeyword):
     """Keyword that ends one indented block and starts another."""
 
-    pattern = _keyword_pattern(
-        ["BEGIN", "EXCEPTION WHEN ERROR THEN", "ELSEIF", "ELSE", "THEN", "DO", "WHEN"]
-    )
+    keywords = [
+        "BEGIN",
+        "EXCEPTION WHEN ERROR THEN",
+        "ELSEIF",
+        "ELSE",
+        "THEN",
+        "DO",
+        "WHEN",
+    ]
 
 
 class AliasSeparator(SpaceBeforeBracketKeyword):
@@ -310,27 +340,25 @@ class AliasSeparator(SpaceBeforeBracketKeyword):
     Must not be followed by the keyword WITH, SELECT, STRUCT or ARRAY.
     """
 
-    pattern = re.compile(
-        r"AS(?=\s+(?!WITH|SELECT|STRUCT|ARRAY)[a-z_`(])", re.IGNORECASE
-    )
+    keywords = [("AS", r"(?=\s+(?!WITH|SELECT|STRUCT|ARRAY)[a-z_`(])")]
 
 
 class NewlineKeyword(SpaceBeforeBracketKeyword):
     """Keyword that should start a new line."""
 
-    pattern = _keyword_pattern(NEWLINE_KEYWORDS)
+    keywords: Sequence[KeywordSpec] = NEWLINE_KEYWORDS
 
 
 class TopLevelKeyword(NewlineKeyword):
     """Keyword that should get its own line followed by increased indent."""
 
-    pattern = _keyword_pattern(TOP_LEVEL_KEYWORDS)
+    keywords = TOP_LEVEL_KEYWORDS
 
 
 class AngleBracketKeyword(ReservedKeyword):
     """Keyword indicating that if the next token is '<' it is a bracket."""
 
-    pattern = _keyword_pattern(["ARRAY", "STRUCT"])
+    keywords = ["ARRAY", "STRUCT"]
 
 
 class Identifier(Token):
@@ -344,7 +372,7 @@ class Literal(Token):
 
     pattern = re.compile(
         # String literal
-        fr"(?:r?b|b?r)?({QUOTE})(?:{STRING_CONTENT})*?\1"
+        fr"(?:r?b|b?r)?(?P<quote>{QUOTE})(?:{STRING_CONTENT})*?(?P=quote)"
         # Hexadecimal integer literal
         "|0[xX][0-9a-fA-F]+"
         # Decimal integer or float literal
@@ -446,52 +474,287 @@ BIGQUERY_TOKEN_PRIORITY = [
 ]
 
 
-def tokenize(query, token_priority=BIGQUERY_TOKEN_PRIORITY):
-    """Split query into a series of tokens."""
-    open_angle_brackets = 0
-    angle_bracket_is_operator = True
-    reserved_keyword_is_identifier = False
-    while query:
-        for token_type in token_priority:
-            match = token_type.pattern.match(query)
-            if not match:
-                continue
-            token = token_type(match.group())
+# inline flags used to embed a token pattern in a combined pattern
+_INLINE_FLAGS = {re.IGNORECASE: "i", re.DOTALL: "s", re.MULTILINE: "m"}
+# first word of a keyword phrase
+_KEYWORD_START = re.compile(r"[A-Za-z]\w*|\*")
+# whitespace and the next word of a keyword phrase
+_KEYWORD_NEXT = re.compile(r"\s+(\w+)")
+
+
+def _is_keyword_type(token_type):
+    """Determine whether token_type is matched by keywords instead of a pattern."""
+    return hasattr(token_type, "keywords")
+
+
+@lru_cache(maxsize=None)
+def _keyword_table(token_priority, start):
+    """
+    Index keywords for consecutive keyword types in token_priority[start:].
+
+    Map the upper case first word of each keyword to a list of candidates in
+    priority order, so that a word is classified with a single dict lookup.
+    Each candidate is the index of the token type, the remaining words of the
+    phrase, and the compiled pattern to match after the phrase, if any.
+
+    Return the table and the index of the first token type after the run.
+    """
+    table = {}
+    index = start
+    while index < len(token_priority) and _is_keyword_type(token_priority[index]):
+        for keyword in token_priority[index].keywords:
+            phrase, after = keyword if isinstance(keyword, tuple) else (keyword, None)
+            first, *rest = phrase.upper().split()
+            table.setdefault(first, []).append(
+                (index, rest, after and re.compile(after, re.IGNORECASE))
+            )
+        index += 1
+    return table, index
+
+
+def _match_keyword(candidates, query, end):
+    """Match the first of candidates for a keyword whose first word ends at end.
+
+    Return the index of the matched token type and the position where the
+    keyword ends, or None if no candidate matches.
+    """
+    following = []  # upper case words after the first word, read as needed
+    for index, rest, after in candidates:
+        keyword_end = end
+        for position, word in enumerate(rest):
+            if position == len(following):
+                match = _KEYWORD_NEXT.match(query, keyword_end)
+                if match is None:
+                    break
+                following.append((match.group(1).upper(), match.end()))
+            if following[position][0] != word:
+                break
+            keyword_end = following[position][1]
+        else:
+            if after is None or after.match(query, keyword_end):
+                return index, keyword_end
+    return None
+
+
+@lru_cache(maxsize=None)
+def _combined_pattern(token_priority, start=0):
+    """
+    Compile a single regex that matches the first of token_priority[start:].
+
+    Each token pattern becomes a named group "_{index}" in an alternation, so
+    that match.lastgroup identifies the matched token type. Alternation tries
+    patterns left to right, which preserves the priority order of the original
+    token types. Pattern flags are applied as inline flags scoped to the group.
+
+    Consecutive keyword types share a single group that matches the first word
+    of a keyword, which is then classified via _keyword_table.
+    """
+    groups = []
+    for index, token_type in enumerate(token_priority[start:], start):
+        if _is_keyword_type(token_type):
+            if index == start or not _is_keyword_type(token_priority[index - 1]):
+                groups.append(f"(?P<_{index}>{_KEYWORD_START.pattern})")
+            continue
+        pattern = token_type.pattern
+        flags = pattern.flags & ~re.UNICODE
+        unsupported = flags & ~sum(_INLINE_FLAGS)
+        if unsupported:
+            raise ValueError(
+                f"Unsupported flags {re.RegexFlag(unsupported)!r} "
+                f"in pattern for {token_type.__name__}"
+            )
+        inline = "".join(char for flag, char in _INLINE_FLAGS.items() if flags & flag)
+        source = f"(?{inline}:{pattern.pattern})" if inline else pattern.pattern
+        groups.append(f"(?P<_{index}>{source})")
+    # never match when there are no remaining token types
+    return re.compile("|".join(groups) or "(?!)")
+
+
+class _TokenizerState:
+    """State for matching tokens that depend on preceding tokens."""
+
+    def __init__(self, token_priority):
+        """Initialize."""
+        self.token_priority = tuple(token_priority)
+        self.open_angle_brackets = 0
+        self.angle_bracket_is_operator = True
+        self.reserved_keyword_is_identifier = False
+
+    def match(self, query, pos):
+        """Match the next token in query at pos, without updating state.
+
+        Token types are matched in priority order using a single combined
+        pattern, so that each token is found in one regex call without copying
+        the rest of the query. When a match is rejected due to state, matching
+        resumes with the next token type in priority order at the same position.
+
+        Return the token and the position where it ends.
+        """
+        start = 0
+        while True:
+            match = _combined_pattern(self.token_priority, start).match(query, pos)
+            if match is None:
+                raise ValueError(f"Could not determine next token in {query[pos:]!r}")
+            index = int(match.lastgroup[1:])
+            end = match.end()
+            if _is_keyword_type(self.token_priority[index]):
+                table, after_keywords = _keyword_table(self.token_priority, index)
+                keyword = _match_keyword(
+                    table.get(match.group().upper(), ()), query, end
+                )
+                if keyword is None:
+                    start = after_keywords
+                    continue  # not a keyword, so match the following types
+                index, end = keyword
+            value = query[pos:end]
+            if len(value) <= 32:
+                # share repeated values such as keywords and indentation
+                value = sys.intern(value)
+            token = self.token_priority[index](value)
+            start = index + 1
             # handle stateful matches
             if isinstance(token, MaybeOpeningAngleBracket):
-                if angle_bracket_is_operator:
+                if self.angle_bracket_is_operator:
                     continue  # prevent matching operator as opening bracket
                 token = OpeningBracket(token.value)
-                open_angle_brackets += 1
             elif isinstance(token, MaybeClosingAngleBracket):
-                if angle_bracket_is_operator:
+                if self.angle_bracket_is_operator:
                     continue  # prevent matching operator as closing bracket
                 token = ClosingBracket(token.value)
-                open_angle_brackets -= 1
             elif (
-                reserved_keyword_is_identifier
+                self.reserved_keyword_is_identifier
                 and isinstance(token, ReservedKeyword)
                 and Identifier.pattern.match(token.value) is not None
             ):
                 continue  # prevent matching identifier as keyword
-            yield token
-            length = len(token.value)
-            query = query[length:]
-            # update stateful conditions for next token
-            if not isinstance(token, (Comment, Whitespace)):
-                # angle brackets are operators unless already in angle bracket
-                # block or preceded by an AngleBracketKeyword
-                angle_bracket_is_operator = not (
-                    open_angle_brackets > 0 or isinstance(token, AngleBracketKeyword)
-                )
-                # field access operator may be followed by an identifier that
-                # would otherwise be a reserved keyword.
-                reserved_keyword_is_identifier = isinstance(
-                    token, (FieldAccessOperator, AliasSeparator)
-                )
-            break
-        else:
-            raise ValueError(f"Could not determine next token in {query!r}")
+            return token, end
+
+    def update(self, token):
+        """Update state used to match the next token after token."""
+        if isinstance(token, (Comment, Whitespace)):
+            return
+        if token.value == "<" and isinstance(token, OpeningBracket):
+            self.open_angle_brackets += 1
+        elif token.value == ">" and isinstance(token, ClosingBracket):
+            self.open_angle_brackets -= 1
+        # angle brackets are operators unless already in angle bracket
+        # block or preceded by an AngleBracketKeyword
+        self.angle_bracket_is_operator = not (
+            self.open_angle_brackets > 0 or isinstance(token, AngleBracketKeyword)
+        )
+        # field access operator may be followed by an identifier that
+        # would otherwise be a reserved keyword.
+        self.reserved_keyword_is_identifier = isinstance(
+            token, (FieldAccessOperator, AliasSeparator)
+        )
+
+
+def tokenize(query, token_priority=BIGQUERY_TOKEN_PRIORITY):
+    """Split query into a series of tokens."""
+    state = _TokenizerState(token_priority)
+    pos = 0
+    while pos < len(query):
+        token, pos = state.match(query, pos)
+        state.update(token)
+        yield token
+
+
+# text that starts with one of these must match the whole construct, or the
+# token may change when more of the query is read, e.g. when a closing quote
+# hasn't been read yet, or when '""' would become the start of '"""'.
+_UNTERMINATED = {
+    BlockComment: re.compile(r"\n?[^\S\n]*/\*"),
+    Literal: re.compile(f"(?:r?b|b?r)?(?:{QUOTE})"),
+    Identifier: re.compile("`"),
+}
+# first characters of text that may match _UNTERMINATED, besides whitespace
+_UNTERMINATED_FIRST = set("/'\"rb`")
+# token patterns look ahead at most a few words past the end of a token, for
+# multi-word keywords, word boundaries, and lookahead assertions
+_LOOKAHEAD = re.compile(r"(?:\s*(?:\w+\b|[^\w\s])){6}")
+_LOOKAHEAD_UNIT = re.compile(r"\w+|[^\w\s]")
+
+
+def _lookahead_limit(query, window=4096):
+    """Get a position in query before which every token has enough lookahead.
+
+    Tokens that end at or before the start of the 7th to last word in query
+    are followed by at least 6 complete words.
+    """
+    tail_start = max(0, len(query) - window)
+    units = [match.start() for match in _LOOKAHEAD_UNIT.finditer(query, tail_start)]
+    # the first unit may be part of a longer word that starts before the window
+    if len(units) < 8:
+        return -1
+    return units[-7]
+
+
+def is_terminated(query, pos, token):
+    """Determine whether token, found at pos in query, ends where it must end.
+
+    Tokens starting with the opening of a comment, string or quoted identifier
+    that was never closed depend on all of the text after them, because adding
+    the closing text anywhere after them would change the token.
+    """
+    if query[pos] in _UNTERMINATED_FIRST or query[pos].isspace():
+        for token_type, pattern in _UNTERMINATED.items():
+            opening = pattern.match(query, pos)
+            if opening and not (
+                isinstance(token, token_type)
+                and token.value.startswith(opening.group())
+            ):
+                return False
+    return True
+
+
+def lookahead(query, end):
+    """Get the text after end that tokens ending at or before end may depend on.
+
+    Return None if that text might continue past the end of query, in which case
+    the tokens may depend on whatever follows query.
+    """
+    match = _LOOKAHEAD.match(query, end)
+    if match is None or match.end() >= len(query):
+        return None
+    # include the next character, which ends the last word of the lookahead
+    stop = match.end() + 1
+    return query[end:stop]
+
+
+def _is_complete(query, pos, end, token, lookahead_limit=-1):
+    """Determine whether token could change if more text was appended to query."""
+    if not is_terminated(query, pos, token):
+        return False
+    if end <= lookahead_limit:
+        return True
+    match = _LOOKAHEAD.match(query, end)
+    return match is not None and match.end() < len(query)
+
+
+def tokenize_stream(
+    file_obj, token_priority=BIGQUERY_TOKEN_PRIORITY, chunk_size=2 ** 16
+):
+    """Split text read from file_obj into a series of tokens.
+
+    Produces the same tokens as tokenize(file_obj.read()), but only buffers
+    enough text to determine the next token, so that arbitrarily large queries
+    can be tokenized in constant memory.
+    """
+    state = _TokenizerState(token_priority)
+    query, pos, eof, lookahead_limit = "", 0, False, -1
+    while pos < len(query) or not eof:
+        if pos < len(query):
+            token, end = state.match(query, pos)
+            if eof or _is_complete(query, pos, end, token, lookahead_limit):
+                state.update(token)
+                yield token
+                pos = end
+                continue
+        # drop text that was already tokenized and read more
+        chunk = file_obj.read(chunk_size)
+        eof = not chunk
+        query, pos = query[pos:] + chunk, 0
+        lookahead_limit = _lookahead_limit(query)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,311 @@
+"""Parse the structure of SQL from tokens in a single pass.
+
+Builds a lightweight tree of statements and bracket blocks with their top level
+clauses, common table expressions and table references. This is not a full
+SQL parser, but it is consistent with the formatter and fast enough to use on
+every query in the repository.
+"""
+
+from .tokenizer import (
+    ClosingBracket,
+    Comment,
+    ExpressionSeparator,
+    FieldAccessOperator,
+    Identifier,
+    Literal,
+    OpeningBracket,
+    Operator,
+    ReservedKeyword,
+    StatementSeparator,
+    TopLevelKeyword,
+    Whitespace,
+    tokenize,
+)
+
+# top level keywords that are followed by a table name
+TABLE_KEYWORDS = {
+    "ALTER TABLE IF EXISTS",
+    "ALTER TABLE",
+    "CREATE OR REPLACE TABLE",
+    "CREATE OR REPLACE VIEW",
+    "CREATE TABLE IF NOT EXISTS",
+    "CREATE VIEW IF NOT EXISTS",
+    "CREATE TEMP TABLE",
+    "CREATE TABLE",
+    "CREATE VIEW",
+    "DROP TABLE",
+    "DROP VIEW",
+    "DELETE FROM",
+    "DELETE",
+    "INSERT INTO",
+    "INSERT",
+    "MERGE INTO",
+    "MERGE",
+    "UPDATE",
+    "CROSS JOIN",
+    "FROM",
+    "FULL JOIN",
+    "FULL OUTER JOIN",
+    "INNER JOIN",
+    "JOIN",
+    "LEFT JOIN",
+    "LEFT OUTER JOIN",
+    "OUTER JOIN",
+    "RIGHT JOIN",
+    "RIGHT OUTER JOIN",
+    "USING",
+}
+# top level keywords where a comma is followed by another table name
+TABLE_LIST_KEYWORDS = {"FROM"}
+# operators that may be part of an unquoted table name, e.g. in project ids or
+# wildcard tables
+NAME_OPERATORS = {"-", "*"}
+
+
+def normalize(keyword):
+    """Normalize keyword to upper case, with words separated by single spaces."""
+    return " ".join(keyword.upper().split())
+
+
+class Clause:
+    """Top level keyword and the children that follow it in a node."""
+
+    __slots__ = ("token", "keyword", "children", "table_references")
+
+    def __init__(self, token):
+        """Initialize."""
+        self.token = token
+        self.keyword = normalize(token.value)
+        # tokens and nodes up to the next clause
+        self.children = []
+        # names of tables that follow this clause's keyword, or commas in it
+        self.table_references = []
+
+    def __repr__(self):
+        """Represent clause as its keyword."""
+        return f"Clause({self.keyword!r})"
+
+
+class Cte:
+    """Common table expression."""
+
+    __slots__ = ("name", "node")
+
+    def __init__(self, name, node):
+        """Initialize."""
+        self.name = name
+        self.node = node
+
+    def __repr__(self):
+        """Represent CTE as its name."""
+        return f"Cte({self.name!r})"
+
+
+class Node:
+    """Tokens between a pair of brackets, grouped into clauses.
+
+    Children are the tokens and nested nodes between the brackets, except for
+    whitespace and comments.
+    """
+
+    __slots__ = ("opening", "closing", "children", "clauses")
+
+    def __init__(self, opening=None):
+        """Initialize."""
+        self.opening = opening
+        self.closing = None
+        self.children = []
+        self.clauses = []
+
+    def walk(self):
+        """Yield this node and all nested nodes, depth first."""
+        yield self
+        for child in self.children:
+            if isinstance(child, Node):
+                yield from child.walk()
+
+    @property
+    def ctes(self):
+        """Get common table expressions defined directly in this node."""
+        result = []
+        for clause in self.clauses:
+            if clause.keyword != "WITH":
+                continue
+            children = clause.children
+            for name, keyword, node in zip(children, children[1:], children[2:]):
+                if (
+                    isinstance(name, Identifier)
+                    and isinstance(keyword, ReservedKeyword)
+                    and normalize(keyword.value) == "AS"
+                    and isinstance(node, Node)
+                ):
+                    result.append(Cte(name.value.strip("`"), node))
+        return result
+
+    @property
+    def table_references(self):
+        """Get names of tables referenced in this node or nested nodes.
+
+        Names of common table expressions are excluded, and each table is only
+        included once, in order of first reference.
+        """
+        nodes = list(self.walk())
+        ctes = {cte.name for node in nodes for cte in node.ctes}
+        references = {}
+        for node in nodes:
+            for clause in node.clauses:
+                for reference in clause.table_references:
+                    if reference not in ctes:
+                        references.setdefault(reference, None)
+        return list(references)
+
+
+class Statement(Node):
+    """Statement, which is the root of a tree of nodes.
+
+    Tokens are all of the tokens in the statement, including whitespace,
+    comments, and the separator, if present.
+    """
+
+    __slots__ = ("tokens", "separator")
+
+    def __init__(self):
+        """Initialize."""
+        super().__init__()
+        self.tokens = []
+        self.separator = None
+
+    @property
+    def text(self):
+        """Get the text of this statement."""
+        return "".join(token.value for token in self.tokens)
+
+    @property
+    def first_clause(self):
+        """Get the first clause if the statement starts with it, otherwise None."""
+        if self.clauses and self.children[0] is self.clauses[0].token:
+            return self.clauses[0]
+        return None
+
+
+def _is_name_part(token, name):
+    """Determine whether token is part of a table name that starts with name."""
+    if isinstance(token, Identifier):
+        return True
+    if not name:
+        return False
+    return (
+        isinstance(token, (FieldAccessOperator, Literal))
+        or isinstance(token, Operator)
+        and token.value in NAME_OPERATORS
+    )
+
+
+def parse_tokens(tokens):
+    """Parse tokens and yield a Statement for each statement.
+
+    Statements end at each StatementSeparator and at the end of tokens.
+    Brackets that are still open at the end of a statement are left without a
+    closing token, and unmatched closing brackets are treated like other tokens.
+    """
+    statement = Statement()
+    nodes = [statement]
+    name = None  # parts of the table name being read, if any
+    for token in tokens:
+        statement.tokens.append(token)
+        node = nodes[-1]
+        clause = node.clauses[-1] if node.clauses else None
+        # read table names until the first token that isn't part of the name
+        if name is not None:
+            if not isinstance(token, (Whitespace, Comment)) and _is_name_part(
+                token, name
+            ):
+                name.append(token.value)
+                node.children.append(token)
+                clause.children.append(token)
+                continue
+            if name:
+                clause.table_references.append("".join(name))
+                name = None
+            elif not isinstance(token, (Whitespace, Comment)):
+                name = None
+        if isinstance(token, (Whitespace, Comment)):
+            continue
+        if isinstance(token, StatementSeparator):
+            statement.separator = token
+            yield statement
+            statement = Statement()
+            nodes = [statement]
+            continue
+        if isinstance(token, ClosingBracket) and len(nodes) > 1:
+            node.closing = token
+            nodes.pop()
+            continue
+        if isinstance(token, TopLevelKeyword):
+            node.children.append(token)
+            node.clauses.append(Clause(token))
+            if node.clauses[-1].keyword in TABLE_KEYWORDS:
+                name = []
+            continue
+        if isinstance(token, OpeningBracket):
+            child = Node(token)
+            nodes.append(child)
+        else:
+            child = token
+        node.children.append(child)
+        if clause is not None:
+            clause.children.append(child)
+            if (
+                isinstance(token, ExpressionSeparator)
+                and clause.keyword in TABLE_LIST_KEYWORDS
+            ):
+                name = []
+    if name:
+        nodes[-1].clauses[-1].table_references.append("".join(name))
+    if statement.tokens:
+        yield statement
+
+
+def parse(query):
+    """Parse query into a list of statements."""
+    return list(parse_tokens(tokenize(query)))
+
+
+def _without_comments(tokens):
+    """Remove comments from tokens, keeping the tokens around them apart."""
+    # whether the last token wasn't whitespace, and whether a comment followed it
+    after_token = separate = False
+    for token in tokens:
+        if isinstance(token, Comment):
+            separate = separate or after_token
+            continue
+        if separate and not isinstance(token, Whitespace):
+            yield Whitespace(" ")
+        after_token = not isinstance(token, Whitespace)
+        separate = False
+        yield token
+
+
+def strip_comments(query):
+    """Remove comments from query."""
+    return "".join(token.value for token in _without_comments(tokenize(query)))
+
+
+def split(query, strip_comments=False):
+    """Split query into a list of statements, without surrounding whitespace.
+
+    Statements that are empty, or only contain comments when strip_comments is
+    true, are omitted.
+    """
+    tokens = tokenize(query)
+    if strip_comments:
+        tokens = _without_comments(tokens)
+    # same statements as parse_tokens, without building a tree
+    statements, values = [], []
+    for token in tokens:
+        values.append(token.value)
+        if isinstance(token, StatementSeparator):
+            statements.append("".join(values).strip())
+            values = []
+    statements.append("".join(values).strip())
+    return [statement for statement in statements if statement]
@@ -0,0 +1,222 @@
+"""Generate queries that include the definitions of the temporary UDFs they use.
+
+Each template in the SQL directory is written to the same relative path in the
+destination, with the definitions of the UDFs it uses prepended. A manifest
+records the inputs of each generated query, so that queries can be regenerated
+incrementally: only queries whose template or UDFs changed are generated again.
+"""
+
+from functools import partial
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+import shutil
+import tempfile
+from typing import Dict
+
+from .format_sql.cache import content_hash, formatter_version
+from .parse_udf import get_udf_graph, parser_version, udf_usages_in_text
+
+MANIFEST_PATH = ".generate_sql_manifest.json"
+
+
+def generator_version():
+    """Hash the source code that determines the content of generated queries."""
+    digest = hashlib.sha256()
+    digest.update(parser_version().encode())
+    digest.update(formatter_version().encode())
+    with open(__file__, "rb") as fp:
+        digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def udf_hash(raw_udf):
+    """Hash the definitions of raw_udf, which are prepended to queries."""
+    return content_hash("\n\n".join(raw_udf.definitions))
+
+
+def udf_hashes(graph):
+    """Hash the definitions of each UDF in graph, by name."""
+    return {udf_name: udf_hash(raw_udf) for udf_name, raw_udf in graph.raw_udfs.items()}
+
+
+class GenerateManifest:
+    """Persistent record of the inputs of each generated query.
+
+    Entries are keyed by the path of the template relative to the SQL directory,
+    and hold the hash of the template, the UDFs it uses directly, the hash of
+    each UDF that was prepended to it, and the size of the generated query.
+    Entries expire when the generator changes, or when it is configured with
+    different directories.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, config=None):
+        """Initialize, discarding entries from other versions or configurations."""
+        self.path = path
+        self.version = generator_version()
+        self.config = config
+        self.outputs: Dict[str, dict] = {}
+        self.modified = False
+        try:
+            with open(path) as fp:
+                manifest = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        if (
+            isinstance(manifest, dict)
+            and manifest.get("version") == self.version
+            and manifest.get("config") == config
+        ):
+            self.outputs = manifest.get("outputs", {})
+
+    def is_current(self, relpath, template_hash, output_path, graph, hashes):
+        """Determine whether the query generated for relpath is up to date.
+
+        hashes must be udf_hashes(graph).
+        """
+        entry = self.outputs.get(relpath)
+        if entry is None or entry["template"] != template_hash:
+            return False
+        try:
+            if os.stat(output_path).st_size != entry["size"]:
+                return False
+        except FileNotFoundError:
+            return False
+        udfs = [(name, hashes[name]) for name in graph.resolve(entry["usages"])]
+        return list(entry["udfs"].items()) == udfs
+
+    def record(self, relpath, entry, output_path):
+        """Record entry from generate_query for relpath, generated at output_path."""
+        entry["size"] = os.stat(output_path).st_size
+        self.outputs[relpath] = entry
+        self.modified = True
+
+    def remove(self, relpath):
+        """Remove the entry for relpath."""
+        del self.outputs[relpath]
+        self.modified = True
+
+    def save(self):
+        """Atomically write the manifest to disk if it was modified."""
+        if not self.modified:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {
+                    "version": self.version,
+                    "config": self.config,
+                    "outputs": self.outputs,
+                },
+                fp,
+            )
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+
+def generate_query(paths, udf_dirs):
+    """Generate the query for paths, a pair of template path and output path.
+
+    Return a manifest entry for the inputs of the query.
+    """
+    template_path, output_path = paths
+    graph = get_udf_graph(*udf_dirs)
+    with open(template_path) as fp:
+        text = fp.read()
+    usages = udf_usages_in_text(text)
+    udf_names = graph.resolve(usages)
+    statements = graph.definitions(usages)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as fp:
+        fp.write("\n\n".join(statements + [text]))
+    return {
+        "template": content_hash(text),
+        "usages": usages,
+        "udfs": {
+            udf_name: udf_hash(graph.raw_udfs[udf_name]) for udf_name in udf_names
+        },
+    }
+
+
+def _generate_queries(paths, udf_dirs, jobs):
+    """Generate queries for a list of paths, and yield their manifest entries."""
+    worker = partial(generate_query, udf_dirs=udf_dirs)
+    if jobs > 1 and len(paths) > 1:
+        with Pool(jobs) as pool:
+            yield from pool.imap(worker, paths, chunksize=8)
+    else:
+        yield from map(worker, paths)
+
+
+def _templates(sql_dir):
+    """Get paths of templates in sql_dir, relative to sql_dir."""
+    return sorted(
+        os.path.relpath(os.path.join(root, filename), sql_dir)
+        for root, dirs, files in os.walk(sql_dir)
+        for filename in files
+        if filename.endswith(".sql")
+    )
+
+
+def generate(sql_dir, destination, udf_dirs, jobs=1, manifest=None):
+    """Generate queries from the templates in sql_dir into destination.
+
+    If manifest is a GenerateManifest with entries, only queries whose inputs
+    changed are generated, and generated queries whose template was removed are
+    deleted. Otherwise destination is replaced with newly generated queries, and
+    the manifest is filled in if given.
+
+    Return the number of queries generated, up to date, and removed.
+    """
+    udf_dirs = tuple(udf_dirs)
+    # loaded before starting worker processes, so that they don't each load it
+    graph = get_udf_graph(*udf_dirs)
+    templates = _templates(sql_dir)
+    if manifest is None or not manifest.outputs:
+        with tempfile.TemporaryDirectory() as d:
+            paths = [
+                (os.path.join(sql_dir, relpath), os.path.join(d, relpath))
+                for relpath in templates
+            ]
+            entries = list(_generate_queries(paths, udf_dirs, jobs))
+            if os.path.exists(destination):
+                shutil.rmtree(destination, ignore_errors=True)
+            shutil.copytree(d, destination)
+        if manifest is not None:
+            for relpath, entry in zip(templates, entries):
+                manifest.record(relpath, entry, os.path.join(destination, relpath))
+        return len(templates), 0, 0
+
+    hashes = udf_hashes(graph)
+    pending = []
+    for relpath in templates:
+        with open(os.path.join(sql_dir, relpath)) as fp:
+            template_hash = content_hash(fp.read())
+        output_path = os.path.join(destination, relpath)
+        if not manifest.is_current(relpath, template_hash, output_path, graph, hashes):
+            pending.append(relpath)
+    paths = [
+        (os.path.join(sql_dir, relpath), os.path.join(destination, relpath))
+        for relpath in pending
+    ]
+    for relpath, entry in zip(pending, _generate_queries(paths, udf_dirs, jobs)):
+        manifest.record(relpath, entry, os.path.join(destination, relpath))
+
+    removed = sorted(set(manifest.outputs) - set(templates))
+    for relpath in removed:
+        output_path = os.path.join(destination, relpath)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        # remove directories that are left empty, like a full regeneration
+        output_dir = os.path.dirname(output_path)
+        while os.path.relpath(output_dir, destination) != "." and not os.listdir(
+            output_dir
+        ):
+            os.rmdir(output_dir)
+            output_dir = os.path.dirname(output_dir)
+        manifest.remove(relpath)
+    return len(pending), len(templates) - len(pending), len(removed)
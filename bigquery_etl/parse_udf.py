@@ -5,19 +5,28 @@ This should eventually be refactored to a more general library for
 parsing UDF dependencies in queries as well.
 """
 
-from dataclasses import dataclass, astuple
+from dataclasses import dataclass, astuple, asdict
+import hashlib
+import json
 import re
 import os
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
-import sqlparse
+from .format_sql.cache import formatter_version
+from .format_sql.tree import split, strip_comments
 
 
 UDF_DIRS = ("udf", "udf_js")
-UDF_CHAR = "[a-zA-z0-9_]"
+UDF_CHAR = "[a-zA-Z0-9_]"
 UDF_RE = re.compile(f"(?:udf|assert)_{UDF_CHAR}+")
 PRESISTENT_UDF_RE = re.compile(fr"((?:udf|assert){UDF_CHAR}*)\.({UDF_CHAR}+)")
 UDF_NAME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9_]{0,255}$")
+UDF_INDEX_PATH = ".udf_index.json"
+XFAIL_RE = re.compile(r"^#xfail\b", re.MULTILINE)
+UDF_USAGE_INDEX_PATH = ".udf_usage_index.json"
+QUERY_DIRS = ("templates", "sql", "tests", "stored_procedures", "script")
+# extensions of files that may use UDFs, in addition to scripts without one
+QUERY_EXTENSIONS = (".sql", ".py")
 
 
 @dataclass
@@ -33,6 +42,13 @@ class RawUdf:
     @staticmethod
     def from_file(filepath):
         """Read in a RawUdf from a SQL file on disk."""
+        with open(filepath) as f:
+            text = f.read()
+        return RawUdf.from_text(text, filepath)
+
+    @staticmethod
+    def from_text(text, filepath):
+        """Parse a RawUdf from the text of the SQL file at filepath."""
         dirpath, basename = os.path.split(filepath)
         prod_name = basename.replace(".sql", "")
         internal_name = os.path.basename(dirpath) + "_" + prod_name
@@ -44,11 +60,14 @@ class RawUdf:
                     f"limited to chars {UDF_CHAR}, and be at most 256 chars long"
                 )
 
-        with open(filepath) as f:
-            text = f.read()
-
-        sql = sqlparse.format(text, strip_comments=True)
-        statements = [s for s in sqlparse.split(sql) if s.strip()]
+        statements = []
+        for statement in split(text):
+            stripped = strip_comments(statement).strip()
+            if stripped:
+                # keep markers for tests that are expected to fail
+                if XFAIL_RE.search(statement):
+                    stripped = "#xfail\n" + stripped
+                statements.append(stripped)
         definitions = [
             s for s in statements if s.lower().startswith("create temp function")
         ]
@@ -86,47 +105,324 @@ class ParsedUdf(RawUdf):
         return ParsedUdf(*astuple(raw_udf), tests_full_sql)
 
 
-def read_udf_dirs(*udf_dirs):
-    """Read contents of udf_dirs into dict of RawUdf instances."""
+class UdfIndex:
+    """Persistent index of RawUdf instances parsed from files.
+
+    Entries are keyed by file path, and are reused without reading the file
+    while its modification time and size are unchanged, or without parsing it
+    while its content hash is unchanged. Entries expire when this module
+    changes.
+    """
+
+    def __init__(self, path=UDF_INDEX_PATH):
+        """Initialize, discarding entries from other versions of this module."""
+        self.path = path
+        self.version = parser_version()
+        self.files: Dict[str, dict] = {}
+        self.modified = False
+        try:
+            with open(path) as fp:
+                index = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        if isinstance(index, dict) and index.get("version") == self.version:
+            self.files = index.get("files", {})
+
+    def get(self, filepath):
+        """Get the RawUdf for the file at filepath, parsing it only if changed."""
+        stat = os.stat(filepath)
+        entry = self.files.get(filepath)
+        if (
+            entry is None
+            or entry["mtime_ns"] != stat.st_mtime_ns
+            or entry["size"] != stat.st_size
+        ):
+            with open(filepath) as f:
+                text = f.read()
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            if entry is None or entry["sha256"] != digest:
+                entry = {
+                    "sha256": digest,
+                    "udf": asdict(RawUdf.from_text(text, filepath)),
+                }
+            entry["mtime_ns"], entry["size"] = stat.st_mtime_ns, stat.st_size
+            self.files[filepath] = entry
+            self.modified = True
+        return RawUdf(**entry["udf"])
+
+    def save(self):
+        """Atomically write the index to disk if it was modified.
+
+        Entries for files that no longer exist are removed.
+        """
+        if not self.modified:
+            return
+        files = {
+            filepath: entry
+            for filepath, entry in self.files.items()
+            if os.path.exists(filepath)
+        }
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump({"version": self.version, "files": files}, fp)
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+
+def parser_version():
+    """Hash the source code that determines how UDFs are parsed.
+
+    That is this module and format_sql, which splits statements and strips
+    comments.
+    """
+    digest = hashlib.sha256()
+    with open(__file__, "rb") as fp:
+        digest.update(fp.read())
+    digest.update(formatter_version().encode())
+    return digest.hexdigest()
+
+
+def read_udf_dirs(*udf_dirs, index=None):
+    """Read contents of udf_dirs into dict of RawUdf instances.
+
+    If index is a UdfIndex, only files that changed since they were added to it
+    are parsed.
+    """
+    read = RawUdf.from_file if index is None else index.get
     return {
         raw_udf.name: raw_udf
         for udf_dir in (udf_dirs or UDF_DIRS)
         for root, dirs, files in os.walk(udf_dir)
         for filename in files
         if not filename.startswith(".") and filename.endswith(".sql")
-        for raw_udf in (RawUdf.from_file(os.path.join(root, filename)),)
+        for raw_udf in (read(os.path.join(root, filename)),)
     }
 
 
+# RawUdf instances loaded by get_raw_udfs, by UDF directories
+_raw_udfs: Dict[Tuple[str, ...], Dict[str, RawUdf]] = {}
+
+
+def get_raw_udfs(*udf_dirs):
+    """Get contents of udf_dirs as a dict of RawUdf instances.
+
+    UDFs are loaded on first use in each process, using the UdfIndex at
+    UDF_INDEX_PATH so that only files that changed since the last load are
+    parsed. Callers must not modify the result.
+    """
+    udf_dirs = udf_dirs or UDF_DIRS
+    if udf_dirs not in _raw_udfs:
+        index = UdfIndex()
+        _raw_udfs[udf_dirs] = read_udf_dirs(*udf_dirs, index=index)
+        index.save()
+    return _raw_udfs[udf_dirs]
+
+
 def parse_udf_dirs(*udf_dirs):
     """Read contents of udf_dirs into ParsedUdf instances."""
     # collect udfs to parse
-    raw_udfs = read_udf_dirs(*udf_dirs)
+    graph = get_udf_graph(*udf_dirs)
     # prepend udf definitions to tests
-    for raw_udf in raw_udfs.values():
+    for raw_udf in graph.raw_udfs.values():
         tests_full_sql = [
-            prepend_udf_usage_definitions(test, raw_udfs) for test in raw_udf.tests
+            prepend_udf_usage_definitions(test, graph) for test in raw_udf.tests
         ]
         yield ParsedUdf.from_raw(raw_udf, tests_full_sql)
 
 
-def accumulate_dependencies(deps, raw_udfs, udf_name):
+class UdfGraph:
+    """Dependency graph of UDFs.
+
+    The transitive dependencies of each UDF are computed once, in topological
+    order, so that assembling the definitions needed by a query only merges
+    precomputed lists. Dependencies on names that aren't UDFs are ignored.
     """
-    Accumulate a list of dependent UDF names.
 
-    Given a dict of raw_udfs and a udf_name string, recurse into the
-    UDF's dependencies, adding the names to deps in depth-first order.
+    def __init__(self, raw_udfs):
+        """Build the graph for a dict of RawUdf instances by name.
+
+        Raise ValueError if UDFs depend on each other in a cycle.
+        """
+        self.raw_udfs = raw_udfs
+        # UDF name to the UDF and its transitive dependencies, dependencies first
+        self.closures: Dict[str, Tuple[str, ...]] = {}
+        # UDF name to its topological level: 0 for UDFs without dependencies,
+        # otherwise one more than the highest level of its dependencies
+        self.levels: Dict[str, int] = {}
+        for udf_name in raw_udfs:
+            self._visit(udf_name, [])
+        # UDF name to the UDFs whose closure includes it, built on first use
+        self._dependents: Optional[Dict[str, Tuple[str, ...]]] = None
+
+    def _visit(self, udf_name, path):
+        """Compute the closure of udf_name, which is depended on via path."""
+        if udf_name in path:
+            start = path.index(udf_name)
+            cycle = " -> ".join(path[start:] + [udf_name])
+            raise ValueError(f"Circular UDF dependency: {cycle}")
+        if udf_name not in self.closures:
+            path.append(udf_name)
+            closure = {}
+            level = 0
+            for dep in self.raw_udfs[udf_name].dependencies:
+                if dep in self.raw_udfs:
+                    closure.update(dict.fromkeys(self._visit(dep, path)))
+                    level = max(level, self.levels[dep] + 1)
+            closure[udf_name] = None
+            self.closures[udf_name] = tuple(closure)
+            self.levels[udf_name] = level
+            path.pop()
+        return self.closures[udf_name]
+
+    def closure(self, udf_name):
+        """Get udf_name and its transitive dependencies, dependencies first."""
+        return self.closures.get(udf_name, ())
+
+    def resolve(self, udf_names):
+        """Get the closures of udf_names merged in order, without duplicates."""
+        deps = {}
+        for udf_name in udf_names:
+            deps.update(dict.fromkeys(self.closure(udf_name)))
+        return list(deps)
+
+    def dependents(self, udf_name):
+        """Get udf_name and the UDFs that transitively depend on it, sorted."""
+        if self._dependents is None:
+            dependents: Dict[str, Set[str]] = {name: set() for name in self.raw_udfs}
+            for name, closure in self.closures.items():
+                for dep in closure:
+                    dependents[dep].add(name)
+            self._dependents = {
+                name: tuple(sorted(names)) for name, names in dependents.items()
+            }
+        return self._dependents.get(udf_name, ())
+
+    def definitions(self, udf_names):
+        """Get the definitions of the UDFs in resolve(udf_names), in order."""
+        return [
+            statement
+            for udf_name in self.resolve(udf_names)
+            for statement in self.raw_udfs[udf_name].definitions
+        ]
+
+
+# UdfGraph instances built by get_udf_graph, by UDF directories
+_udf_graphs: Dict[Tuple[str, ...], UdfGraph] = {}
+
+
+def get_udf_graph(*udf_dirs):
+    """Get the UdfGraph of get_raw_udfs(*udf_dirs), built on first use."""
+    udf_dirs = udf_dirs or UDF_DIRS
+    if udf_dirs not in _udf_graphs:
+        _udf_graphs[udf_dirs] = UdfGraph(get_raw_udfs(*udf_dirs))
+    return _udf_graphs[udf_dirs]
+
+
+class UdfUsageIndex:
+    """Persistent reverse index from UDFs to the query files that depend on them.
+
+    The UDFs used directly by each query file are recorded, and reused while the
+    file's modification time and size are unchanged. Temporary and persistent
+    UDF references are both usages. The reverse index, which includes queries
+    that only depend on a UDF through other UDFs, is derived from the usages
+    and a UdfGraph by update(), and saved along with them for other tools.
+    Entries expire when this module changes.
     """
-    if udf_name not in raw_udfs:
-        return deps
-
-    raw_udf = raw_udfs[udf_name]
-    for dep in raw_udf.dependencies:
-        deps = accumulate_dependencies(deps, raw_udfs, dep)
-    if udf_name in deps:
-        return deps
-    else:
-        return deps + [udf_name]
+
+    def __init__(self, path=UDF_USAGE_INDEX_PATH):
+        """Initialize, discarding entries from other versions of this module."""
+        self.path = path
+        self.version = parser_version()
+        self.files: Dict[str, dict] = {}
+        # UDF name to the query files that depend on it, directly or through
+        # other UDFs, as of the last update
+        self.queries: Dict[str, List[str]] = {}
+        self.modified = False
+        try:
+            with open(path) as fp:
+                index = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        if isinstance(index, dict) and index.get("version") == self.version:
+            self.files = index.get("files", {})
+            self.queries = index.get("queries", {})
+
+    def get(self, filepath):
+        """Get the UDFs used in the file at filepath, reading it only if changed."""
+        stat = os.stat(filepath)
+        entry = self.files.get(filepath)
+        if (
+            entry is None
+            or entry["mtime_ns"] != stat.st_mtime_ns
+            or entry["size"] != stat.st_size
+        ):
+            with open(filepath) as f:
+                text = f.read()
+            entry = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "usages": udf_usages_in_text(sub_persisent_udfs_as_temp(text)),
+            }
+            self.files[filepath] = entry
+            self.modified = True
+        return entry["usages"]
+
+    def update(self, graph, *query_dirs):
+        """Index the query files in query_dirs, and derive the reverse index.
+
+        Entries for files that aren't in query_dirs are removed.
+        """
+        files = {
+            filepath: self.get(filepath)
+            for query_dir in (query_dirs or QUERY_DIRS)
+            for root, dirs, filenames in os.walk(query_dir)
+            for filename in sorted(filenames)
+            if filename.endswith(QUERY_EXTENSIONS) or "." not in filename
+            for filepath in (os.path.join(root, filename),)
+        }
+        if files.keys() != self.files.keys():
+            self.files = {filepath: self.files[filepath] for filepath in files}
+            self.modified = True
+        queries: Dict[str, List[str]] = {}
+        for filepath, usages in sorted(files.items()):
+            for udf_name in graph.resolve(usages):
+                queries.setdefault(udf_name, []).append(filepath)
+        if queries != self.queries:
+            self.queries = queries
+            self.modified = True
+
+    def save(self):
+        """Atomically write the index to disk if it was modified."""
+        if not self.modified:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {"version": self.version, "files": self.files, "queries": self.queries},
+                fp,
+            )
+        os.replace(tmp_path, self.path)
+        self.modified = False
+
+
+def find_unused_udfs(graph, *query_dirs, index=None):
+    """Get the names of UDFs in graph that no query file depends on, sorted.
+
+    Query files are searched for in query_dirs, which default to QUERY_DIRS.
+    UDFs that are only used by the tests in UDF files, or by other unused UDFs,
+    are unused. index defaults to the UdfUsageIndex at UDF_USAGE_INDEX_PATH.
+    """
+    if index is None:
+        index = UdfUsageIndex()
+    index.update(graph, *query_dirs)
+    index.save()
+    return sorted(set(graph.raw_udfs) - set(index.queries))
 
 
 def udf_usages_in_file(filepath):
@@ -138,25 +434,30 @@ def udf_usages_in_file(filepath):
 
 def udf_usages_in_text(text):
     """Return a list of UDF names used in the provided SQL text."""
-    sql = sqlparse.format(text, strip_comments=True)
-    udf_usages = UDF_RE.findall(sql)
+    udf_usages = UDF_RE.findall(strip_comments(text))
     return sorted(set(udf_usages))
 
 
 def udf_usage_definitions(text, raw_udfs=None):
-    """Return a list of definitions of UDFs used in provided SQL text."""
+    """Return a list of definitions of UDFs used in provided SQL text.
+
+    raw_udfs may be a dict of RawUdf instances, or a UdfGraph to avoid building
+    one on each call, and defaults to get_udf_graph().
+    """
     if raw_udfs is None:
-        raw_udfs = read_udf_dirs()
-    deps = []
-    for udf_usage in udf_usages_in_text(text):
-        deps = accumulate_dependencies(deps, raw_udfs, udf_usage)
-    return [
-        statement for udf_name in deps for statement in raw_udfs[udf_name].definitions
-    ]
+        graph = get_udf_graph()
+    elif isinstance(raw_udfs, UdfGraph):
+        graph = raw_udfs
+    else:
+        graph = UdfGraph(raw_udfs)
+    return graph.definitions(udf_usages_in_text(text))
 
 
 def prepend_udf_usage_definitions(text, raw_udfs=None):
-    """Prepend definitions of UDFs used to provided SQL text."""
+    """Prepend definitions of UDFs used to provided SQL text.
+
+    raw_udfs is the same as for udf_usage_definitions.
+    """
     statements = udf_usage_definitions(text, raw_udfs)
     return "\n\n".join(statements + [text])
 
@@ -0,0 +1,254 @@
+"""Publish temporary UDFs as persistent UDFs.
+
+UDFs are published by topological level, so that each UDF is published after
+the UDFs it depends on, and all UDFs in a level are published concurrently. A
+manifest records a hash of the definitions last published for each UDF, so
+that unchanged UDFs can be skipped.
+
+JavaScript libraries are uploaded to GCS at paths that include a hash of their
+content, so that unchanged libraries aren't uploaded again, and UDFs only
+change when a library they use changes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List
+
+from .format_sql.cache import content_hash
+from .parse_udf import UDF_CHAR
+
+UDF_RE = re.compile(f"udf_(?:js_|legacy_)?({UDF_CHAR}+)")
+# captures the path of a library in the bucket that UDFs are tested with
+OPTIONS_LIB_RE = re.compile(r'library = "gs://[^"/]+/([^"]+)"')
+MANIFEST_PATH = ".publish_udfs_manifest.json"
+
+
+def persistent_udf_queries(
+    raw_udf, dataset, project_id, gcs_bucket, gcs_path, libraries=None
+):
+    """Transform the definitions of a temporary UDF into persistent UDF queries.
+
+    libraries maps the paths of libraries in the bucket UDFs are tested with to
+    the names of their objects in gcs_bucket, as returned by upload_libraries.
+    Other libraries are expected at the same path under gcs_path.
+    """
+    libraries = libraries or {}
+
+    def library(match):
+        name = libraries.get(match.group(1), gcs_path + match.group(1))
+        return f'library = "gs://{gcs_bucket}/{name}"'
+
+    queries = []
+    for definition in raw_udf.definitions:
+        # Within a standard SQL function, references to other entities require
+        # explicit project IDs
+        query_with_renamed_udfs = UDF_RE.sub(
+            "`" + project_id + "`." + dataset + "." + r"\1", definition
+        )
+
+        query_with_renamed_udfs = query_with_renamed_udfs.replace(
+            "CREATE TEMP FUNCTION", "CREATE OR REPLACE FUNCTION"
+        )
+
+        # adjust paths for dependencies stored in GCS
+        queries.append(OPTIONS_LIB_RE.sub(library, query_with_renamed_udfs))
+    return queries
+
+
+def library_object_name(gcs_path, relpath, filepath):
+    """Get the content addressed object name for the library file at filepath."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(2 ** 16), b""):
+            digest.update(chunk)
+    return f"{gcs_path}{digest.hexdigest()}/{relpath}"
+
+
+def _upload_library(bucket, name, filepath):
+    """Upload filepath to name in bucket unless it exists, and return whether it did.
+
+    Object names are content addressed, so an existing object already matches.
+    """
+    blob = bucket.blob(name)
+    if blob.exists():
+        return False
+    blob.upload_from_filename(filepath)
+    return True
+
+
+def upload_libraries(bucket, gcs_path, dep_dir, parallelism=8, log=print):
+    """Upload the library files in dep_dir to content addressed paths in bucket.
+
+    bucket is a GCS bucket, or any object with the same blob() method, whose
+    blobs have exists() and upload_from_filename() methods. Libraries that are
+    already in bucket are skipped, and the rest are uploaded concurrently.
+
+    Return a dict of library paths relative to dep_dir, which are the paths that
+    UDFs refer to in the bucket they are tested with, to object names.
+    """
+    uploads = {}
+    for root, dirs, files in os.walk(dep_dir):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            relpath = os.path.relpath(filepath, dep_dir).replace(os.sep, "/")
+            uploads[relpath] = (
+                library_object_name(gcs_path, relpath, filepath),
+                filepath,
+            )
+    with ThreadPoolExecutor(parallelism) as executor:
+        uploaded = sum(
+            executor.map(
+                lambda upload: _upload_library(bucket, *upload), uploads.values()
+            )
+        )
+    log(f"uploaded {uploaded} of {len(uploads)} libraries")
+    return {relpath: name for relpath, (name, _) in uploads.items()}
+
+
+def topological_levels(graph, udf_names):
+    """Group udf_names by topological level in graph.
+
+    UDFs in level 0 don't depend on other UDFs, and UDFs in each later level
+    only depend on UDFs in earlier levels. Levels without any of udf_names are
+    omitted, and UDFs within a level are sorted.
+    """
+    result: Dict[int, List[str]] = {}
+    for udf_name in sorted(udf_names):
+        result.setdefault(graph.levels[udf_name], []).append(udf_name)
+    return [result[level] for level in sorted(result)]
+
+
+class PublishManifest:
+    """Record of the hash of the queries last published for each persistent UDF.
+
+    The manifest is stored in a local file, or in GCS when path is a gs:// URL.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, storage_client=None):
+        """Initialize, loading published hashes from path if it exists."""
+        self.path = path
+        self.storage_client = storage_client
+        self.published: Dict[str, str] = {}
+        self.modified = False
+        try:
+            manifest = json.loads(self._read())
+        except (FileNotFoundError, ValueError):
+            return
+        if isinstance(manifest, dict):
+            self.published = manifest.get("published", {})
+
+    def _blob(self):
+        """Get the GCS blob for path."""
+        bucket, _, name = self.path.replace("gs://", "", 1).partition("/")
+        if self.storage_client is None:
+            from gcloud import storage
+
+            self.storage_client = storage.Client()
+        return self.storage_client.bucket(bucket).blob(name)
+
+    def _read(self):
+        """Read the content of the manifest."""
+        if self.path.startswith("gs://"):
+            blob = self._blob()
+            if not blob.exists():
+                raise FileNotFoundError(self.path)
+            return blob.download_as_string()
+        with open(self.path) as fp:
+            return fp.read()
+
+    def is_published(self, udf_id, queries):
+        """Determine whether queries were last published for udf_id."""
+        return self.published.get(udf_id) == content_hash("\n".join(queries))
+
+    def add(self, udf_id, queries):
+        """Record that queries were published for udf_id."""
+        self.published[udf_id] = content_hash("\n".join(queries))
+        self.modified = True
+
+    def save(self):
+        """Write the manifest if it was modified."""
+        if not self.modified:
+            return
+        content = json.dumps({"published": self.published}, sort_keys=True)
+        if self.path.startswith("gs://"):
+            self._blob().upload_from_string(content)
+        else:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as fp:
+                fp.write(content)
+            os.replace(tmp_path, self.path)
+        self.modified = False
+
+
+def publish_queries(client, queries):
+    """Run queries in order, waiting for each to finish."""
+    for query in queries:
+        client.query(query).result()
+
+
+def publish(
+    client,
+    graph,
+    udf_names,
+    dataset,
+    project_id,
+    gcs_bucket,
+    gcs_path,
+    manifest=None,
+    parallelism=8,
+    libraries=None,
+    log=print,
+):
+    """Publish udf_names from graph as persistent UDFs in project_id.dataset.
+
+    UDFs whose queries are unchanged in manifest are skipped, and the manifest
+    is saved after each level. libraries are the uploaded library objects, as
+    for persistent_udf_queries. If publishing any UDF in a level fails, the
+    error is raised after the rest of the level is published. Timings for each
+    level are reported via log.
+
+    Return the names of the UDFs that were published.
+    """
+    published = []
+    with ThreadPoolExecutor(parallelism) as executor:
+        for level, level_udf_names in enumerate(topological_levels(graph, udf_names)):
+            start = time.monotonic()
+            pending = {}
+            for udf_name in level_udf_names:
+                queries = persistent_udf_queries(
+                    graph.raw_udfs[udf_name],
+                    dataset,
+                    project_id,
+                    gcs_bucket,
+                    gcs_path,
+                    libraries,
+                )
+                udf_id = f"{project_id}.{dataset}." + UDF_RE.sub(r"\1", udf_name)
+                if manifest is None or not manifest.is_published(udf_id, queries):
+                    pending[udf_name] = udf_id, queries
+            futures = {
+                udf_name: executor.submit(publish_queries, client, queries)
+                for udf_name, (_, queries) in pending.items()
+            }
+            for udf_name, future in futures.items():
+                if future.exception() is None:
+                    published.append(udf_name)
+                    if manifest is not None:
+                        manifest.add(*pending[udf_name])
+            if manifest is not None:
+                manifest.save()
+            # raise the first error, after recording the UDFs that were published
+            for future in futures.values():
+                future.result()
+            log(
+                f"level {level}: published {len(pending)} of {len(level_udf_names)}"
+                f" UDFs in {time.monotonic() - start:.1f}s"
+            )
+    return published
@@ -1,13 +1,38 @@
-"""PyTest plugin for running udf tests."""
+"""PyTest plugin for running udf tests.
+
+With --udf-batch-size, the tests of that many UDF files are combined into one
+scripted query, which defines the UDFs they use once and records the error of
+each test that fails, so that tests need fewer round trips and less inlined
+SQL. Tests that are expected to fail are run on their own.
+"""
+
+import json
+import os
 
 from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
 import pytest
 
-from ..parse_udf import UDF_DIRS, parse_udf_dirs
+from ..parse_udf import (
+    UDF_DIRS,
+    find_unused_udfs,
+    get_udf_graph,
+    parse_udf_dirs,
+    udf_usages_in_text,
+)
 
 TEST_UDF_DIRS = {"assert"}.union(UDF_DIRS)
 _parsed_udfs = None
+_unused_udf_files = None
+_client = None
+
+
+def client():
+    """Get a client shared by all tests in this process."""
+    global _client
+    if _client is None:
+        _client = bigquery.Client()
+    return _client
 
 
 def parsed_udfs():
@@ -20,6 +45,89 @@ def parsed_udfs():
     return _parsed_udfs
 
 
+def unused_udf_files():
+    """Get cached paths of UDF files that no query depends on."""
+    global _unused_udf_files
+    if _unused_udf_files is None:
+        graph = get_udf_graph()
+        _unused_udf_files = {
+            os.path.normpath(graph.raw_udfs[udf_name].filepath)
+            for udf_name in find_unused_udfs(graph)
+        }
+    return _unused_udf_files
+
+
+def pytest_addoption(parser):
+    """Add options to skip tests of unused UDFs and to run tests in batches."""
+    parser.addoption(
+        "--skip-unused-udfs",
+        action="store_true",
+        help="Skip tests of UDFs that no query, view, or script depends on.",
+    )
+    parser.addoption(
+        "--udf-batch-size",
+        type=int,
+        default=0,
+        help="Run the tests of this many UDF files in one query; 0 runs each test"
+        " in its own query. With pytest-xdist, batches only contain the tests of"
+        " one file, and require --dist=loadfile.",
+    )
+
+
+def batch_script(tests, graph):
+    """Combine tests, a dict of tests by label, into one scripted query.
+
+    The UDFs used by tests are defined once, and the script's result is the
+    label and error message of each test that failed.
+    """
+    statements = [
+        "DECLARE udf_test_failures ARRAY<STRUCT<test STRING, message STRING>>"
+        " DEFAULT [];"
+    ]
+    statements.extend(
+        graph.definitions(
+            sorted({udf for test in tests.values() for udf in udf_usages_in_text(test)})
+        )
+    )
+    for label, test in tests.items():
+        statements.append(
+            f"BEGIN\n{test.rstrip().rstrip(';')};\nEXCEPTION WHEN ERROR THEN\n"
+            "  SET udf_test_failures = ARRAY_CONCAT(udf_test_failures,"
+            f" [STRUCT({json.dumps(label)} AS test, @@error.message AS message)]);"
+            "\nEND;"
+        )
+    statements.append("SELECT test, message FROM UNNEST(udf_test_failures);")
+    return "\n\n".join(statements)
+
+
+class UdfBatch:
+    """Tests of one or more UDF files that are run together in one query."""
+
+    def __init__(self):
+        """Initialize."""
+        self.tests = {}
+        self.ran = False
+        self.failures = None
+
+    def run(self):
+        """Run the tests on first use, and get error messages by label.
+
+        Return None if the script failed as a whole, e.g. because a test has a
+        syntax error, so that tests can be run on their own.
+        """
+        if not self.ran:
+            self.ran = True
+            job_config = bigquery.QueryJobConfig(use_legacy_sql=False)
+            query = batch_script(self.tests, get_udf_graph("tests/assert", *UDF_DIRS))
+            try:
+                rows = client().query(query, job_config=job_config).result()
+            except BadRequest:
+                pass
+            else:
+                self.failures = {row.test: row.message for row in rows}
+        return self.failures
+
+
 def pytest_configure(config):
     """Register a custom marker."""
     config.addinivalue_line("markers", "udf: mark udf tests.")
@@ -28,9 +136,50 @@ def pytest_configure(config):
 def pytest_collect_file(parent, path):
     """Collect non-python query tests."""
     if path.basename.endswith(".sql") and path.dirpath().basename in TEST_UDF_DIRS:
+        if parent.config.getoption("skip_unused_udfs") and (
+            path.relto(parent.config.rootdir) in unused_udf_files()
+        ):
+            return None
         return UdfFile(path, parent)
 
 
+def assign_batches(tests, batch_size):
+    """Add tests to batches of the tests of batch_size UDF files each.
+
+    Tests that are expected to fail or are marked to skip aren't batched.
+    """
+    batch = None
+    files = set()
+    for test in tests:
+        if test.xfail or test.get_closest_marker("skip"):
+            continue
+        if batch is None or (test.parent not in files and len(files) >= batch_size):
+            batch = UdfBatch()
+            files = set()
+        files.add(test.parent)
+        batch.tests[test.name] = test.test
+        test.batch = batch
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(config, items):
+    """Batch the UDF tests that will run, if batching is enabled.
+
+    This runs after tests are deselected, e.g. with -k or -m, so that batches
+    only contain tests that run. pytest-xdist distributes tests after this, so
+    on workers batches only contain the tests of one file, and --dist=loadfile
+    is required to run all of them on the same worker.
+    """
+    batch_size = config.getoption("udf_batch_size")
+    if batch_size <= 0:
+        return
+    if hasattr(config, "workerinput"):
+        if config.getoption("dist", None) != "loadfile":
+            return
+        batch_size = 1
+    assign_batches([item for item in items if isinstance(item, UdfTest)], batch_size)
+
+
 class UdfFile(pytest.File):
     """UDF File."""
 
@@ -42,18 +191,22 @@ class UdfFile(pytest.File):
 
     def collect(self):
         """Collect."""
-        for i, query in enumerate(self.udf.tests_full_sql):
-            yield UdfTest(f"{self.udf.name}#{i+1}", self, query)
+        for i, (test, query) in enumerate(zip(self.udf.tests, self.udf.tests_full_sql)):
+            yield UdfTest(f"{self.udf.name}#{i+1}", self, test, query)
 
 
 class UdfTest(pytest.Item):
     """UDF Test."""
 
-    def __init__(self, name, parent, query):
+    def __init__(self, name, parent, test, query):
         """Initialize."""
         super().__init__(name, parent)
+        self.test = test
         self.query = query
-        if "#xfail" in query:
+        # batch that runs this test, assigned after collection if enabled
+        self.batch = None
+        self.xfail = "#xfail" in query
+        if self.xfail:
             self.add_marker(pytest.mark.xfail(strict=True))
 
     def reportinfo(self):
@@ -74,6 +227,12 @@ class UdfTest(pytest.Item):
 
     def runtest(self):
         """Run Test."""
+        if self.batch is not None:
+            failures = self.batch.run()
+            if failures is not None:
+                if self.name in failures:
+                    raise BadRequest(failures[self.name])
+                return
         job_config = bigquery.QueryJobConfig(use_legacy_sql=False)
-        job = bigquery.Client().query(self.query, job_config=job_config)
+        job = client().query(self.query, job_config=job_config)
         job.result()
@@ -0,0 +1,631 @@
+"""Generate and validate cluster conditions for shredder targets.
+
+Every row of a target with cluster conditions must match exactly one of them,
+because rows that match none are dropped and rows that match more than one are
+duplicated. Conditions are validated by evaluating them with SQL three valued
+logic over representative values of each field they compare, which cover every
+combination of outcomes of comparisons with the literals in the conditions.
+
+Conditions are generated from the bytes in a partition for each combination of
+values of the clustering fields. Values of the first clustering field are
+packed into balanced conditions of at most --max-bytes, values that are too big
+on their own are split by the next clustering field, and the smallest condition
+at each level excludes the other values instead of listing its own, so that
+values that weren't in the partition are covered too.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from textwrap import dedent
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import ast
+import itertools
+import logging
+import math
+import operator
+import sys
+import warnings
+
+from google.cloud import bigquery
+
+from ..format_sql.tokenizer import (
+    Comment,
+    FieldAccessOperator,
+    Identifier,
+    Literal,
+    Whitespace,
+    tokenize,
+)
+from ..util.table_filter import add_table_filter_arguments, get_table_filter
+from .config import ClusterCondition, DELETE_TARGETS
+from .delete import get_partition_expr
+
+
+parser = ArgumentParser(description=__doc__)
+parser.add_argument(
+    "--generate",
+    action="store_true",
+    help="Generate cluster conditions for the selected targets from the sizes of "
+    "clusters in --partition-date, instead of validating configured conditions",
+)
+parser.add_argument(
+    "--partition-date",
+    "--partition_date",
+    default=datetime.utcnow().date() - timedelta(days=1),
+    type=lambda x: datetime.strptime(x, "%Y-%m-%d").date(),
+    help="Partition used to measure the size of clusters; defaults to yesterday in "
+    "UTC",
+)
+parser.add_argument(
+    "--max-bytes",
+    "--max_bytes",
+    default=100 * 2 ** 30,
+    type=int,
+    help="Maximum number of bytes each generated condition should select, unless a "
+    "single cluster is bigger; defaults to 100 GiB",
+)
+parser.add_argument(
+    "-l",
+    "--log-level",
+    "--log_level",
+    default=logging.getLevelName(logging.INFO),
+    type=str.upper,
+)
+add_table_filter_arguments(parser)
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# fields that only have a known set of non-null values
+FIELD_VALUES = {
+    # crc32 of client_id modulo 100
+    "sample_id": range(100)
+}
+
+Evaluate = Callable[[Dict], Optional[bool]]
+
+
+def _and(values):
+    """Combine values with SQL AND."""
+    if False in values:
+        return False
+    if None in values:
+        return None
+    return True
+
+
+def _or(values):
+    """Combine values with SQL OR."""
+    if True in values:
+        return True
+    if None in values:
+        return None
+    return False
+
+
+def _not(value):
+    """Negate value with SQL NOT."""
+    return None if value is None else not value
+
+
+def _in(value, values):
+    """Evaluate SQL value IN values."""
+    if value is None:
+        return None
+    if value in values:
+        return True
+    return None if None in values else False
+
+
+class _ConditionParser:
+    """Parser for the boolean expressions used as cluster conditions.
+
+    Supports AND, OR, NOT, parentheses, TRUE, FALSE, and comparisons of fields
+    with literals via IS [NOT] NULL, [NOT] IN, [NOT] BETWEEN, and comparison
+    operators.
+    """
+
+    def __init__(self, condition):
+        """Initialize."""
+        self.condition = condition
+        self.tokens = [
+            token
+            for token in tokenize(condition)
+            if not isinstance(token, (Whitespace, Comment))
+        ]
+        self.pos = 0
+        self.literals: Dict[str, Set] = {}
+
+    def error(self, message):
+        """Get an error for message at the current token."""
+        remaining = " ".join(token.value for token in self.tokens[self.pos :])  # noqa
+        return ValueError(f"{message} at {remaining!r} in {self.condition!r}")
+
+    def accept(self, *values):
+        """Consume the next token if it is not a literal or identifier in values."""
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if (
+                not isinstance(token, (Literal, Identifier))
+                and token.value.upper() in values
+            ):
+                self.pos += 1
+                return token.value.upper()
+        return None
+
+    def expect(self, *values):
+        """Consume the next token, which must be in values."""
+        value = self.accept(*values)
+        if value is None:
+            raise self.error(f"Expected {' or '.join(values)}")
+        return value
+
+    def parse(self):
+        """Parse the condition, and return a function that evaluates it for a row."""
+        result = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise self.error("Unexpected token")
+        return result
+
+    def parse_or(self) -> Evaluate:
+        """Parse expressions separated by OR."""
+        terms = [self.parse_and()]
+        while self.accept("OR"):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda row: _or([term(row) for term in terms])
+
+    def parse_and(self) -> Evaluate:
+        """Parse expressions separated by AND."""
+        terms = [self.parse_not()]
+        while self.accept("AND"):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda row: _and([term(row) for term in terms])
+
+    def parse_not(self) -> Evaluate:
+        """Parse an expression that may be negated."""
+        if self.accept("NOT"):
+            term = self.parse_not()
+            return lambda row: _not(term(row))
+        return self.parse_predicate()
+
+    def parse_predicate(self) -> Evaluate:
+        """Parse an expression in parentheses, a boolean, or a comparison."""
+        if self.accept("("):
+            result = self.parse_or()
+            self.expect(")")
+            return result
+        boolean = self.accept("TRUE", "FALSE")
+        if boolean:
+            return lambda row: boolean == "TRUE"
+        field = self.parse_field()
+        if self.accept("IS"):
+            negate = self.accept("NOT")
+            self.expect("NULL")
+            return lambda row: (row[field] is None) != bool(negate)
+        negate = self.accept("NOT")
+        if self.accept("IN"):
+            self.expect("(")
+            values = [self.parse_literal(field)]
+            while self.accept(","):
+                values.append(self.parse_literal(field))
+            self.expect(")")
+            if negate:
+                return lambda row: _not(_in(row[field], values))
+            return lambda row: _in(row[field], values)
+        if self.accept("BETWEEN"):
+            low = self.parse_literal(field)
+            self.expect("AND")
+            high = self.parse_literal(field)
+
+            def between(row):
+                value = row[field]
+                if value is None or low is None or high is None:
+                    return None
+                return (low <= value <= high) != bool(negate)
+
+            return between
+        if negate:
+            raise self.error("Expected IN or BETWEEN")
+        compare = COMPARISONS[self.expect(*COMPARISONS)]
+        literal = self.parse_literal(field)
+        return lambda row: (
+            None
+            if row[field] is None or literal is None
+            else compare(row[field], literal)
+        )
+
+    def parse_field(self):
+        """Parse a possibly nested field name."""
+        parts = []
+        while True:
+            if self.pos >= len(self.tokens) or not isinstance(
+                self.tokens[self.pos], Identifier
+            ):
+                raise self.error("Expected a field")
+            parts.append(self.tokens[self.pos].value.strip("`"))
+            self.pos += 1
+            if self.pos < len(self.tokens) and isinstance(
+                self.tokens[self.pos], FieldAccessOperator
+            ):
+                self.pos += 1
+            else:
+                return ".".join(parts)
+
+    def parse_literal(self, field):
+        """Parse a literal that is compared to field, and record it for field."""
+        if self.accept("NULL"):
+            return None
+        boolean = self.accept("TRUE", "FALSE")
+        if boolean:
+            value = boolean == "TRUE"
+        else:
+            sign = -1 if self.accept("-") else 1
+            if self.pos >= len(self.tokens) or not isinstance(
+                self.tokens[self.pos], Literal
+            ):
+                raise self.error("Expected a literal")
+            text = self.tokens[self.pos].value
+            self.pos += 1
+            if text[0] in "'\"":
+                if sign == -1:
+                    raise self.error("Unexpected - before string")
+                value = ast.literal_eval(text)
+            elif text[0] in "rRbB":
+                raise self.error("Unsupported raw or bytes literal")
+            elif text.lower().startswith("0x"):
+                value = sign * int(text, 16)
+            elif any(c in text for c in ".eE"):
+                value = sign * float(text)
+            else:
+                value = sign * int(text)
+        self.literals.setdefault(field, set()).add(value)
+        return value
+
+
+def parse_condition(condition):
+    """Parse a cluster condition.
+
+    Return a function that evaluates condition for a dict of field values, with
+    None for NULL, and a dict of fields to the set of literals compared to them.
+    """
+    condition_parser = _ConditionParser(condition)
+    return condition_parser.parse(), condition_parser.literals
+
+
+def representative_values(field, literals):
+    """Get values of field that cover every outcome of comparisons with literals.
+
+    That is one value equal to each literal, one between each pair of adjacent
+    literals, one below and one above all literals, and NULL.
+    """
+    values: List = [None]
+    if not literals:
+        return values + [0]
+    if all(isinstance(value, bool) for value in literals):
+        return values + [False, True]
+    if all(isinstance(value, int) for value in literals):
+        return values + sorted(
+            {v for literal in literals for v in (literal - 1, literal, literal + 1)}
+        )
+    if all(isinstance(value, (int, float)) for value in literals):
+        ordered = sorted(literals)
+        return values + sorted(
+            {
+                ordered[0] - 1,
+                ordered[-1] + 1,
+                *ordered,
+                *((a + b) / 2 for a, b in zip(ordered, ordered[1:])),
+            }
+        )
+    if all(isinstance(value, str) for value in literals):
+        # "" is below every other string, and literal + "\0" is the next string
+        return values + sorted(
+            {"", *literals, *(literal + "\0" for literal in literals)}
+        )
+    raise ValueError(f"Can't compare {field} to values of different types: {literals}")
+
+
+def validate_conditions(cluster_conditions, field_values=FIELD_VALUES, max_examples=3):
+    """Check that every row matches exactly one of cluster_conditions.
+
+    Also check that conditions where needs_clustering is False match a single
+    value of every field. Fields in field_values are only checked for NULL and
+    the values given. Return a list of problems, which is empty if
+    cluster_conditions are valid.
+    """
+    parsed = [parse_condition(cluster.condition) for cluster in cluster_conditions]
+    literals: Dict[str, Set] = {}
+    for _, condition_literals in parsed:
+        for field, values in condition_literals.items():
+            literals.setdefault(field, set()).update(values)
+    fields = sorted(literals)
+    domains = [
+        [None, *field_values[field]]
+        if field in field_values
+        else representative_values(field, literals[field])
+        for field in fields
+    ]
+    gaps = []
+    overlaps = []
+    matched_values = [
+        [set() for _ in fields] if cluster.needs_clustering is False else None
+        for cluster in cluster_conditions
+    ]
+    for values in itertools.product(*domains):
+        row = dict(zip(fields, values))
+        matches = [i for i, (evaluate, _) in enumerate(parsed) if evaluate(row)]
+        if not matches:
+            gaps.append(row)
+        elif len(matches) > 1:
+            overlaps.append((row, matches))
+        for i in matches:
+            if matched_values[i] is not None:
+                for field_values, value in zip(matched_values[i], values):
+                    field_values.add(value)
+    problems = []
+    if gaps:
+        problems.append(
+            f"{len(gaps)} combinations of values match no condition, such as "
+            + "; ".join(map(str, gaps[:max_examples]))
+        )
+    if overlaps:
+        problems.append(
+            f"{len(overlaps)} combinations of values match more than one condition, "
+            "such as "
+            + "; ".join(
+                f"{row} matches "
+                + " and ".join(repr(cluster_conditions[i].condition) for i in matches)
+                for row, matches in overlaps[:max_examples]
+            )
+        )
+    for cluster, field_values in zip(cluster_conditions, matched_values):
+        for field, values in zip(fields, field_values or []):
+            if len(values) > 1:
+                problems.append(
+                    f"needs_clustering is False but {cluster.condition!r} matches "
+                    f"more than one value of {field}"
+                )
+    return problems
+
+
+def sql_literal(value):
+    """Format value as a SQL literal."""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+        return f"'{escaped}'"
+    raise ValueError(f"Unsupported cluster value: {value!r}")
+
+
+def _sort_key(value):
+    """Sort NULL after other values."""
+    return (value is None, value if value is not None else 0)
+
+
+def member_condition(field, values):
+    """Get a condition for field being one of values, which may include None."""
+    non_null = sorted((value for value in values if value is not None), key=_sort_key)
+    parts = []
+    if None in values:
+        parts.append(f"{field} IS NULL")
+    if len(non_null) == 1:
+        parts.append(f"{field} = {sql_literal(non_null[0])}")
+    elif non_null:
+        parts.append(f"{field} IN ({', '.join(map(sql_literal, non_null))})")
+    if len(parts) == 1:
+        return parts[0]
+    return f"({' OR '.join(parts)})"
+
+
+def non_member_condition(field, values):
+    """Get a condition for field not being one of values, which may include None.
+
+    Return None if that doesn't exclude anything.
+    """
+    non_null = sorted((value for value in values if value is not None), key=_sort_key)
+    if not non_null:
+        return f"{field} IS NOT NULL" if None in values else None
+    if len(non_null) == 1:
+        condition = f"{field} != {sql_literal(non_null[0])}"
+    else:
+        condition = f"{field} NOT IN ({', '.join(map(sql_literal, non_null))})"
+    if None in values:
+        return condition
+    # comparisons with NULL are never true
+    return f"({field} IS NULL OR {condition})"
+
+
+def pack(sizes, max_bytes):
+    """Pack values into balanced bins of at most max_bytes.
+
+    sizes maps values to their size. Values bigger than max_bytes get a bin of
+    their own, and the rest use the fewest bins that the longest processing time
+    first heuristic can fit them into. Return bins of values, largest first.
+    """
+    bins: List[Tuple[int, List]] = [
+        (size, [value]) for value, size in sizes.items() if size > max_bytes
+    ]
+    ordered = sorted(
+        ((value, size) for value, size in sizes.items() if size <= max_bytes),
+        key=lambda item: (-item[1], _sort_key(item[0])),
+    )
+    if ordered:
+        num_bins = max(1, math.ceil(sum(size for _, size in ordered) / max_bytes))
+        while True:
+            packed: List[Tuple[int, List]] = [(0, []) for _ in range(num_bins)]
+            for value, size in ordered:
+                i = min(range(num_bins), key=lambda i: packed[i][0])
+                packed[i] = packed[i][0] + size, packed[i][1] + [value]
+            if max(size for size, _ in packed) <= max_bytes:
+                break
+            num_bins += 1
+        bins.extend(packed)
+    bins.sort(key=lambda item: -item[0])
+    return [sorted(values, key=_sort_key) for _, values in bins if values]
+
+
+def generate_conditions(clustering_fields, cluster_bytes, max_bytes):
+    """Generate cluster conditions of at most max_bytes each where possible.
+
+    cluster_bytes is a list of (values, bytes) with a tuple of values for each
+    of clustering_fields. Conditions are covering and disjoint by construction.
+    Return a list of (ClusterCondition, bytes).
+    """
+    result: List[Tuple[ClusterCondition, int]] = []
+
+    def generate(groups, fields, prefix, fixed):
+        field, *rest = fields
+        by_value: Dict = {}
+        for values, num_bytes in groups:
+            total, subgroups = by_value.setdefault(values[0], [0, []])
+            by_value[values[0]][0] = total + num_bytes
+            subgroups.append((values[1:], num_bytes))
+        sizes = {}
+        for value in sorted(by_value, key=_sort_key):
+            total, subgroups = by_value[value]
+            if total > max_bytes and rest:
+                generate(
+                    subgroups,
+                    rest,
+                    prefix + [member_condition(field, [value])],
+                    fixed and value is not None,
+                )
+            else:
+                sizes[value] = total
+
+        def add(parts, num_bytes, single_cluster):
+            condition = " AND ".join(part for part in parts if part) or "TRUE"
+            result.append((ClusterCondition(condition, not single_cluster), num_bytes))
+
+        bins = pack(sizes, max_bytes)
+        for values in bins[:-1]:
+            add(
+                prefix + [member_condition(field, values)],
+                sum(sizes[value] for value in values),
+                fixed and not rest and len(values) == 1 and values[0] is not None,
+            )
+        # the last and smallest bin excludes other values, to cover unseen values
+        last = bins[-1] if bins else []
+        add(
+            prefix
+            + [non_member_condition(field, [v for v in by_value if v not in last])],
+            sum(sizes[value] for value in last),
+            False,
+        )
+
+    generate(cluster_bytes, list(clustering_fields), [], True)
+    return result
+
+
+def get_cluster_bytes(client, target, partition_date):
+    """Get the clustering fields of target and the bytes of each cluster.
+
+    Return the clustering fields and a list of (values, bytes) for each
+    combination of clustering field values in the partition for partition_date.
+    Bytes are estimated from the number of rows in each cluster and the bytes in
+    the partition.
+    """
+    table = client.get_table(target.sql_table_id)
+    fields = table.clustering_fields
+    where = f"{get_partition_expr(table)} = '{partition_date}'"
+    partition_bytes = client.query(
+        f"SELECT * FROM `{target.sql_table_id}` WHERE {where}",
+        bigquery.QueryJobConfig(dry_run=True),
+    ).total_bytes_processed
+    rows = list(
+        client.query(
+            dedent(
+                f"""
+                SELECT
+                  {', '.join(fields)},
+                  COUNT(*) AS num_rows
+                FROM
+                  `{target.sql_table_id}`
+                WHERE
+                  {where}
+                GROUP BY
+                  {', '.join(fields)}
+                """
+            ).strip()
+        ).result()
+    )
+    total_rows = sum(row["num_rows"] for row in rows) or 1
+    return (
+        fields,
+        [
+            (
+                tuple(row[field] for field in fields),
+                partition_bytes * row["num_rows"] // total_rows,
+            )
+            for row in rows
+        ],
+    )
+
+
+def main():
+    """Validate or generate cluster conditions for selected DELETE_TARGETS."""
+    args = parser.parse_args()
+    logging.root.setLevel(args.log_level)
+    table_filter = get_table_filter(args)
+    targets = [target for target in DELETE_TARGETS if table_filter(target.table)]
+    if args.generate:
+        client = bigquery.Client()
+        for target in targets:
+            fields, cluster_bytes = get_cluster_bytes(
+                client, target, args.partition_date
+            )
+            conditions = generate_conditions(fields, cluster_bytes, args.max_bytes)
+            problems = validate_conditions([cluster for cluster, _ in conditions])
+            for problem in problems:
+                logging.error(f"{target.table}: {problem}")
+            print(
+                f"# {target.table}: {len(conditions)} conditions for "
+                f"{sum(num_bytes for _, num_bytes in cluster_bytes)} bytes in "
+                f"{args.partition_date}, with at most "
+                f"{max(num_bytes for _, num_bytes in conditions)} bytes each"
+            )
+            print("cluster_conditions=(")
+            for cluster, _ in conditions:
+                print(
+                    f"    ClusterCondition({cluster.condition!r}, "
+                    f"{cluster.needs_clustering}),"
+                )
+            print("),")
+            if problems:
+                sys.exit(1)
+    else:
+        invalid = False
+        for target in targets:
+            if not target.cluster_conditions:
+                continue
+            problems = validate_conditions(target.cluster_conditions)
+            for problem in problems:
+                logging.error(f"{target.table}: {problem}")
+            if problems:
+                invalid = True
+            else:
+                logging.info(
+                    f"{target.table}: {len(target.cluster_conditions)} cluster "
+                    "conditions cover every row exactly once"
+                )
+        if invalid:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore", module="google.auth._default")
+    main()
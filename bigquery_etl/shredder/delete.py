@@ -1,7 +1,6 @@
 """Delete user data from long term storage."""
 
 from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor
 from dataclasses import replace
 from datetime import datetime, timedelta
 from functools import partial
@@ -10,13 +9,17 @@ import asyncio
 import logging
 import warnings
 
+from google.api_core.exceptions import GoogleAPICallError
 from google.cloud import bigquery
 
 from ..util.client_queue import ClientQueue
+from ..util.job_tracker import JobTracker, to_thread
 from ..util.temp_table import get_temporary_table
 from ..util.table_filter import add_table_filter_arguments, get_table_filter
 from ..util.sql_table_id import sql_table_id
-from .config import ClusterCondition, DELETE_TARGETS
+from .config import ClusterCondition, DeleteSource, DELETE_TARGETS
+from .schedule import Scheduler, simulate
+from .state import BigQueryState, SqliteState
 
 
 parser = ArgumentParser(description=__doc__)
@@ -99,13 +102,29 @@ parser.add_argument(
     "down queries if reserved slots are not enabled for the billing project; "
     "INTERACTIVE priority is limited to 100 concurrent queries per project",
 )
-parser.add_argument(
+state_group = parser.add_mutually_exclusive_group()
+state_group.add_argument(
     "--state-table",
     "--state_table",
     metavar="TABLE",
     help="Table for recording state; Used to avoid repeating deletes if interrupted; "
     "Create it if it does not exist; By default state is not recorded",
 )
+state_group.add_argument(
+    "--state-file",
+    "--state_file",
+    metavar="PATH",
+    help="SQLite database for recording state locally instead of in --state-table",
+)
+parser.add_argument(
+    "--state-flush-interval",
+    "--state_flush_interval",
+    default=60,
+    type=int,
+    help="Maximum number of seconds to buffer finished jobs before recording them; "
+    "Started jobs are recorded immediately, so finished jobs that were not recorded "
+    "before an interruption are looked up from BigQuery instead of repeated",
+)
 parser.add_argument(
     "--ignore-cluster-conditions",
     "--ignore_cluster_conditions",
@@ -113,6 +132,29 @@ parser.add_argument(
     help="Ignore cluster conditions; Used to process main_v4 using DELETE queries; "
     "Should be combined with --billing-projects that use on-demand pricing",
 )
+parser.add_argument(
+    "--no-materialize-sources",
+    "--no_materialize_sources",
+    dest="materialize_sources",
+    action="store_false",
+    help="Read deletion requests from source tables in every query, instead of "
+    "materializing the ids from each source table once into a temp table that "
+    "all queries read from",
+)
+parser.add_argument(
+    "--bytes-per-second",
+    "--bytes_per_second",
+    default=2 ** 29,
+    type=int,
+    help="Estimated number of bytes each query processes per second; Used to "
+    "estimate completion time before any queries finish; defaults to 512 MiB",
+)
+parser.add_argument(
+    "--simulate",
+    action="store_true",
+    help="Do not run any queries, only list partitions and log the estimated time "
+    "to process them with and without scheduling the largest queries first",
+)
 add_table_filter_arguments(parser)
 
 WHERE_CLAUSE = """
@@ -152,46 +194,49 @@ FROM
   AND {{cluster_condition}}
 """
 
+MATERIALIZE_TEMPLATE = """
+CREATE TABLE
+  `{destination.project}.{destination.dataset_id}.{destination.table_id}`
+CLUSTER BY
+  id
+OPTIONS (
+  expiration_timestamp = '{expiration_timestamp}'
+)
+AS
+SELECT DISTINCT
+  {source.field} AS id
+FROM
+  `{source.sql_table_id}`
+WHERE
+  {source_condition}
+"""
+
 
-def record_state(client, state_table, task_id, job, dry_run, start_date, end_date):
-    """Record the job for task_id in state_table."""
-    if state_table is not None:
+def record_state(state, task_id, job, dry_run):
+    """Record that the job for task_id started in state."""
+    if state is not None:
         job_id = "a job_id" if dry_run else f"{job.project}.{job.location}.{job.job_id}"
-        insert_tense = "Would insert" if dry_run else "Inserting"
-        logging.info(f"{insert_tense} {job_id} in {state_table} for task: {task_id}")
+        record_tense = "Would record" if dry_run else "Recording"
+        logging.info(f"{record_tense} {job_id} in {state} for task: {task_id}")
         if not dry_run:
-            client.query(
-                dedent(
-                    f"""
-                    INSERT INTO
-                      `{state_table}`(
-                        task_id,
-                        job,
-                        job_started,
-                        start_date,
-                        end_date
-                      )
-                    VALUES
-                      (
-                        "{task_id}",
-                        "{job_id}",
-                        TIMESTAMP "{job.started:%Y-%m-%d %H:%M:%S} UTC",
-                        DATE "{start_date}",
-                        DATE "{end_date}"
-                      )
-                    """
-                ).strip()
-            ).result()
-
-
-def wait_for_job(
-    client, state_table, states, task_id, dry_run, start_date, end_date, create_job
-):
-    """Get a job from state or create a new job, and wait for the job to complete."""
-    job = states.get(task_id)
-    if job:
-        project, location, job_id = job.split(".")
-        job = client.get_job(job_id, project, location)
+            state.started(task_id, job)
+
+
+async def wait_for_job(client, state, tracker, task_id, dry_run, create_job):
+    """Get a job from state or create a new job, and wait for the job to complete.
+
+    Jobs that finished in a previous attempt are reused from state without
+    getting them from BigQuery. Waiting is done by tracker, without blocking a
+    thread.
+    """
+    job = None
+    task = None if state is None else state.get(task_id)
+    if task is not None and task.job_ended is not None:
+        logging.info(f"Previous attempt succeeded, reusing result: {task_id}")
+        return task.completed_job()
+    if task is not None:
+        project, location, job_id = task.job.split(".")
+        job = await to_thread(client.get_job, job_id, project, location)
         if job.errors:
             logging.info(f"Previous attempt failed, retrying: {task_id}")
             job = None
@@ -200,11 +245,13 @@ def wait_for_job(
         else:
             logging.info(f"Previous attempt still running: {task_id}")
     if job is None:
-        job = create_job(client)
-        record_state(client, state_table, task_id, job, dry_run, start_date, end_date)
+        job = await to_thread(create_job, client)
+        await to_thread(record_state, state, task_id, job, dry_run)
     if not dry_run and not job.ended:
         logging.info(f"Waiting on {job.project}.{job.location}.{job.job_id}: {task_id}")
-        job.result()
+        job = await tracker.wait(job)
+    if state is not None and not dry_run:
+        await to_thread(state.finished, task_id, job)
     return job
 
 
@@ -218,23 +265,80 @@ def get_task_id(job_type, target, partition_id=None, cluster_condition=None):
     return task_id
 
 
+async def materialize_source(
+    client,
+    source,
+    source_condition,
+    dry_run,
+    priority,
+    expiration_timestamp,
+    state,
+    tracker,
+):
+    """Materialize the distinct ids in source for source_condition into a temp table.
+
+    The temp table is clustered on id, so that queries against it only scan the
+    ids, and only once per run instead of once per query. It is recorded in
+    state like other jobs, so that a resumed run reuses it.
+
+    Return the job and a DeleteSource for the temp table, or None for dry runs,
+    because then the temp table is not created.
+    """
+    # noqa: D202
+
+    def create_job(client):
+        query = MATERIALIZE_TEMPLATE.format(
+            destination=get_temporary_table(client),
+            source=source,
+            source_condition=source_condition,
+            expiration_timestamp=expiration_timestamp,
+        )
+        run_tense = "Would run" if dry_run else "Running"
+        logging.debug(f"{run_tense} query: {query}")
+        return client.query(
+            query, bigquery.QueryJobConfig(dry_run=dry_run, priority=priority)
+        )
+
+    job = await wait_for_job(
+        client=client,
+        state=state,
+        tracker=tracker,
+        task_id=get_task_id("materialize", source),
+        dry_run=dry_run,
+        create_job=create_job,
+    )
+    if dry_run:
+        return job, None
+    table = job.ddl_target_table
+    return (
+        job,
+        DeleteSource(
+            table=f"{table.dataset_id}.{table.table_id}",
+            field="id",
+            project=table.project,
+        ),
+    )
+
+
 async def delete_from_cluster(
-    executor,
     client_q,
+    scheduler,
+    num_bytes,
     dry_run,
     priority,
-    states,
-    state_table,
+    state,
+    tracker,
     target,
     partition_id,
     cluster_condition,
     clustering_fields,
     update_clustering,
-    start_date,
-    end_date,
     **template_kwargs,
 ):
-    """Process deletion requests for a cluster condition on a partition."""
+    """Process deletion requests for a cluster condition on a partition.
+
+    The query is run by scheduler, where num_bytes is its estimated size.
+    """
     # noqa: D202
 
     def create_job(client):
@@ -253,16 +357,14 @@ async def delete_from_cluster(
             query, bigquery.QueryJobConfig(dry_run=dry_run, priority=priority)
         )
 
-    job = await client_q.async_with_client(
-        executor,
+    job = await scheduler.run(
+        num_bytes,
         partial(
             wait_for_job,
-            state_table=state_table,
-            states=states,
+            state=state,
+            tracker=tracker,
             task_id=get_task_id("delete", target, partition_id, cluster_condition),
             dry_run=dry_run,
-            start_date=start_date,
-            end_date=end_date,
             create_job=create_job,
         ),
     )
@@ -271,11 +373,13 @@ async def delete_from_cluster(
         if dry_run:
             logging.debug(f"Would update clustering on {destination}")
         else:
-            table = client_q.default_client.get_table(job.destination)
+            table = await to_thread(client_q.default_client.get_table, job.destination)
             if table.clustering_fields != clustering_fields:
                 logging.debug(f"Updating clustering on {destination}")
                 table.clustering_fields = clustering_fields
-                client_q.default_client.update_table(table, ["clustering"])
+                await to_thread(
+                    client_q.default_client.update_table, table, ["clustering"]
+                )
     return job
 
 
@@ -284,15 +388,21 @@ async def delete_from_partition(
     dry_run,
     target,
     partition_id,
+    partition_bytes,
     clustering,
-    start_date,
-    end_date,
-    state_table,
-    states,
+    state,
+    tracker,
     **kwargs,
 ):
     """Process deletion requests for a single partition of a target table."""
     client = client_q.default_client
+    clusters = target.cluster_conditions or [ClusterCondition(None, None)]
+    copy_task_id = get_task_id(
+        job_type="copy", target=target, partition_id=partition_id
+    )
+    copy_task = None if state is None else state.get(copy_task_id)
+    # temp tables are deleted after a copy succeeds, so they can't be updated
+    copied = copy_task is not None and copy_task.job_ended is not None
     jobs = await asyncio.gather(
         *[
             delete_from_cluster(
@@ -301,15 +411,14 @@ async def delete_from_partition(
                 target=target,
                 partition_id=partition_id,
                 clustering=(clustering if cluster.needs_clustering else ""),
-                start_date=start_date,
-                end_date=end_date,
-                state_table=state_table,
-                states=states,
-                update_clustering=cluster.needs_clustering is False,
+                state=state,
+                tracker=tracker,
+                update_clustering=cluster.needs_clustering is False and not copied,
                 cluster_condition=cluster.condition,
+                num_bytes=partition_bytes // len(clusters),
                 **kwargs,
             )
-            for cluster in (target.cluster_conditions or [ClusterCondition(None, None)])
+            for cluster in clusters
         ]
     )
     if target.cluster_conditions:
@@ -330,24 +439,25 @@ async def delete_from_partition(
                     ),
                 )
 
-            wait_for_job(
+            await wait_for_job(
                 client=client_q.default_client,
-                state_table=state_table,
-                states=states,
-                task_id=get_task_id(
-                    job_type="copy", target=target, partition_id=partition_id
-                ),
+                state=state,
+                tracker=tracker,
+                task_id=copy_task_id,
                 dry_run=dry_run,
-                start_date=start_date,
-                end_date=end_date,
                 create_job=create_job,
             )
         delete_tense = "Would delete" if dry_run else "Deleting"
         logging.info(f"{delete_tense} {len(sources)} temp tables")
         for table in sources:
             logging.debug(f"{delete_tense} {table}")
-            if not dry_run:
-                client.delete_table(table)
+        if not dry_run:
+            await asyncio.gather(
+                *[
+                    to_thread(client.delete_table, table, not_found_ok=True)
+                    for table in sources
+                ]
+            )
     return sum(
         job.total_bytes_processed
         for job in jobs
@@ -384,12 +494,76 @@ def list_partitions(client, target):
     ]
 
 
+def get_partition_bytes(client, target, partition_id):
+    """Get the number of bytes in a partition, or None if it can't be found."""
+    try:
+        return client.get_table(f"{target.sql_table_id}${partition_id}").num_bytes
+    except GoogleAPICallError as e:
+        logging.warning(f"Failed to get size of {target.table}${partition_id}: {e}")
+        return None
+
+
+async def plan_table(client, target, end_date, max_single_dml_bytes):
+    """Get a target table and the partitions to process with their estimated bytes.
+
+    Partitions are only processed individually if the table is larger than
+    max_single_dml_bytes or has cluster conditions, otherwise the whole table
+    is processed at once and the partition is None. __PARTITIONS_SUMMARY__
+    doesn't report the size of partitions, so they are fetched for each
+    partition, and table bytes are divided evenly for any that can't be.
+    """
+    table = await to_thread(client.get_table, target.sql_table_id)
+    if table.num_bytes <= max_single_dml_bytes and not target.cluster_conditions:
+        return table, [(None, None, table.num_bytes)]
+    partitions = [
+        (partition_id, partition_date)
+        for partition_id, partition_date in await to_thread(
+            list_partitions, client=client, target=target
+        )
+        if partition_date < end_date
+    ]
+    sizes = await asyncio.gather(
+        *[
+            to_thread(get_partition_bytes, client, target, partition_id)
+            for partition_id, _ in partitions
+        ]
+    )
+    default_bytes = table.num_bytes // max(len(partitions), 1)
+    return (
+        table,
+        [
+            (
+                partition_id,
+                partition_date,
+                default_bytes if partition_bytes is None else partition_bytes,
+            )
+            for (partition_id, partition_date), partition_bytes in zip(
+                partitions, sizes
+            )
+        ],
+    )
+
+
+def get_job_bytes(plans):
+    """Get the estimated bytes of each query in plans from plan_table, in order."""
+    return [
+        partition_bytes // len(target.cluster_conditions or [None])
+        for target, (_, partitions) in plans
+        for _, _, partition_bytes in partitions
+        for _ in target.cluster_conditions or [None]
+    ]
+
+
 async def delete_from_table(
-    client_q, target, dry_run, end_date, max_single_dml_bytes, **kwargs
+    client_q, target, table, partitions, dry_run, end_date, **kwargs
 ):
-    """Process deletion requests for a single target table."""
+    """Process deletion requests for a single target table.
+
+    table and partitions are from plan_table.
+
+    Return the bytes processed, the bytes deleted, and the number of queries.
+    """
     client = client_q.default_client
-    table = client.get_table(target.sql_table_id)
     clustering = f"CLUSTER BY {', '.join(table.clustering_fields)}"
     partition_expr = get_partition_expr(table)
     bytes_deleted = 0
@@ -408,31 +582,27 @@ async def delete_from_table(
                     ),
                     partition_expr=partition_expr,
                     partition_id=partition_id,
+                    partition_bytes=partition_bytes,
                     target=target,
-                    end_date=end_date,
                     **kwargs,
                 )
-                for partition_id, partition_date in (
-                    list_partitions(client=client, target=target)
-                    if table.num_bytes > max_single_dml_bytes
-                    or target.cluster_conditions
-                    else [(None, None)]
-                )
-                if partition_date is None or partition_date < end_date
+                for partition_id, partition_date, partition_bytes in partitions
             ]
         )
     )
+    num_queries = len(partitions) * len(target.cluster_conditions or [None])
     if dry_run:
         logging.info(f"Would scan {bytes_processed} bytes from {target.table}")
     else:
         bytes_deleted = (
-            table.num_bytes - client.get_table(target.sql_table_id).num_bytes
+            table.num_bytes
+            - (await to_thread(client.get_table, target.sql_table_id)).num_bytes
         )
         logging.info(
             f"Scanned {bytes_processed} bytes and "
             f"deleted {bytes_deleted} from {target.table}"
         )
-    return bytes_processed, bytes_deleted
+    return bytes_processed, bytes_deleted, num_queries
 
 
 async def main():
@@ -450,79 +620,161 @@ async def main():
     expiration_date = datetime.utcnow().date() + timedelta(days=15)
     expiration_timestamp = f"{expiration_date} 00:00:00 UTC"
     client_q = ClientQueue(args.billing_projects, args.parallelism)
-    states = {}
+    state = None
     if args.state_table:
-        client_q.default_client.query(
-            dedent(
-                f"""
-                CREATE TABLE IF NOT EXISTS
-                  `{args.state_table}`(
-                    task_id STRING,
-                    job STRING,
-                    job_started TIMESTAMP,
-                    start_date DATE,
-                    end_date DATE
-                  )
-                """
-            ).strip()
+        state = BigQueryState(
+            client_q.default_client,
+            args.state_table,
+            args.start_date,
+            args.end_date,
+            flush_interval=args.state_flush_interval,
+        )
+    elif args.state_file:
+        state = SqliteState(
+            args.state_file,
+            args.start_date,
+            args.end_date,
+            flush_interval=args.state_flush_interval,
+        )
+    if state is not None:
+        state.load()
+    tasks = [
+        (
+            replace(
+                target,
+                project=args.target_project or target.project,
+                cluster_conditions=(
+                    None
+                    if args.ignore_cluster_conditions
+                    else target.cluster_conditions
+                ),
+            ),
+            replace(source, project=args.source_project or source.project),
+        )
+        for target, source in DELETE_TARGETS.items()
+        if table_filter(target.table)
+    ]
+    if not tasks:
+        logging.error("No tables selected")
+        parser.exit(1)
+    kwargs = dict(
+        dry_run=args.dry_run,
+        priority=args.priority,
+        state=state,
+        tracker=JobTracker(client_q.default_client),
+        expiration_timestamp=expiration_timestamp,
+    )
+    try:
+        plans = await asyncio.gather(
+            *[
+                plan_table(
+                    client=client_q.default_client,
+                    target=target,
+                    end_date=args.end_date,
+                    max_single_dml_bytes=args.max_single_dml_bytes,
+                )
+                for target, _ in tasks
+            ]
+        )
+        job_bytes = get_job_bytes(
+            [(target, plan) for (target, _), plan in zip(tasks, plans)]
+        )
+        if args.simulate:
+            for longest_first in (False, True):
+                simulation = simulate(
+                    job_bytes,
+                    len(args.billing_projects),
+                    args.parallelism,
+                    args.bytes_per_second,
+                    longest_first,
+                )
+                order = "longest first" if longest_first else "in order"
+                logging.info(
+                    f"Running {len(job_bytes)} queries {order} would take "
+                    f"{timedelta(seconds=round(simulation.makespan))} and process "
+                    f"{simulation.project_bytes} bytes in each billing project"
+                )
+            return
+        sources = []
+        if args.materialize_sources:
+            sources = sorted({source for _, source in tasks}, key=str)
+        # sources aren't sized, so they are scheduled in order
+        source_scheduler = Scheduler(
+            client_q.clients, args.parallelism, len(sources), args.bytes_per_second
+        )
+        materialize_results = await asyncio.gather(
+            *[
+                source_scheduler.run(
+                    0,
+                    partial(
+                        materialize_source,
+                        source=source,
+                        source_condition=source_condition,
+                        **kwargs,
+                    ),
+                )
+                for source in sources
+            ]
         )
-        states = {
-            row["task_id"]: row["job"]
-            for row in client_q.default_client.query(
-                dedent(
-                    f"""
-                    SELECT
-                      task_id,
-                      job,
-                    FROM
-                      `{args.state_table}`
-                    WHERE
-                      start_date = '{args.start_date}'
-                      AND end_date = '{args.end_date}'
-                    ORDER BY
-                      job_started
-                    """
-                ).strip()
-            ).result()
+        materialize_jobs = {
+            source: job for source, (job, _) in zip(sources, materialize_results)
         }
-    with ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+        # dry runs can't read from temp tables that weren't created
+        materialized = {
+            source: table
+            for source, (_, table) in zip(sources, materialize_results)
+            if table is not None
+        }
+        scheduler = Scheduler(
+            client_q.clients, args.parallelism, len(job_bytes), args.bytes_per_second
+        )
         results = await asyncio.gather(
             *[
                 delete_from_table(
                     client_q=client_q,
-                    executor=executor,
-                    target=replace(
-                        target,
-                        project=args.target_project or target.project,
-                        cluster_conditions=(
-                            None
-                            if args.ignore_cluster_conditions
-                            else target.cluster_conditions
-                        ),
-                    ),
-                    source=replace(
-                        source, project=args.source_project or source.project
-                    ),
-                    source_condition=source_condition,
-                    dry_run=args.dry_run,
-                    priority=args.priority,
-                    start_date=args.start_date,
+                    scheduler=scheduler,
+                    target=target,
+                    table=table,
+                    partitions=partitions,
                     end_date=args.end_date,
-                    max_single_dml_bytes=args.max_single_dml_bytes,
-                    state_table=args.state_table,
-                    states=states,
-                    expiration_timestamp=expiration_timestamp,
+                    source=materialized.get(source, source),
+                    source_condition=(
+                        "TRUE" if source in materialized else source_condition
+                    ),
+                    **kwargs,
                 )
-                for target, source in DELETE_TARGETS.items()
-                if table_filter(target.table)
+                for (target, source), (table, partitions) in zip(tasks, plans)
             ]
         )
-    if not results:
-        logging.error("No tables selected")
-        parser.exit(1)
-    bytes_processed, bytes_deleted = map(sum, zip(*results))
+    finally:
+        if state is not None:
+            state.flush()
+    bytes_processed, bytes_deleted, _ = map(sum, zip(*results))
+    # without materialization, every query scans its source
+    source_queries = {source: 0 for source in materialize_jobs}
+    for (_, source), (_, _, num_queries) in zip(tasks, results):
+        if source in source_queries:
+            source_queries[source] += num_queries
+    bytes_saved = 0
+    for source, job in materialize_jobs.items():
+        source_bytes = job.total_bytes_processed or 0
+        bytes_processed += source_bytes
+        if args.dry_run:
+            # dry run queries scanned source instead of a materialized table
+            bytes_processed -= source_bytes * source_queries[source]
+            bytes_saved += source_bytes * (source_queries[source] - 1)
+        scan_tense = "Would scan" if args.dry_run else "Scanned"
+        logging.info(
+            f"{scan_tense} {source_bytes} bytes to materialize {source.sql_table_id} "
+            f"once instead of in each of {source_queries[source]} queries"
+        )
     if args.dry_run:
         logging.info(f"Would scan {bytes_processed} in total")
+        if materialize_jobs:
+            logging.info(
+                f"Materializing sources would scan {bytes_saved} fewer bytes, "
+                "not counting scans of materialized tables"
+            )
     else:
         logging.info(f"Scanned {bytes_processed} and deleted {bytes_deleted} in total")
 
@@ -0,0 +1,191 @@
+"""Schedule shredder jobs longest first, balancing bytes across billing projects.
+
+Without scheduling, jobs start in the order of DELETE_TARGETS and use billing
+projects round robin, so the largest partitions may start last and dominate
+the time it takes to finish. Jobs are instead started in descending order of
+their estimated bytes, each on the billing project that has been assigned the
+fewest bytes so far, which is the longest processing time first heuristic for
+minimizing makespan.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+
+def project_capacity(parallelism, num_projects):
+    """Get the maximum number of concurrent jobs per billing project.
+
+    This matches how ClientQueue distributes parallelism across projects.
+    """
+    return math.ceil(parallelism / num_projects)
+
+
+def choose_project(assigned_bytes, running, capacity):
+    """Choose the project with a free slot that has been assigned the fewest bytes."""
+    return min(
+        (i for i in range(len(assigned_bytes)) if running[i] < capacity),
+        key=lambda i: (assigned_bytes[i], running[i]),
+    )
+
+
+@dataclass
+class Simulation:
+    """Result of simulating a schedule."""
+
+    # seconds until the last job finishes
+    makespan: float
+    # bytes processed by each billing project
+    project_bytes: List[int]
+
+
+def simulate(job_bytes, num_projects, parallelism, bytes_per_second, longest_first):
+    """Simulate running jobs that process job_bytes each at bytes_per_second.
+
+    With longest_first jobs are run the way Scheduler runs them. Otherwise they
+    are run in the order given, on slots that are assigned to projects round
+    robin, the way ClientQueue runs them.
+    """
+    project_bytes = [0] * num_projects
+    makespan = 0.0
+    if longest_first:
+        capacity = project_capacity(parallelism, num_projects)
+        running = [0] * num_projects
+        # (end time, project) for each running job
+        events: List = []
+        now = 0.0
+        for num_bytes in sorted(job_bytes, reverse=True):
+            while sum(running) >= parallelism:
+                now, project = heapq.heappop(events)
+                running[project] -= 1
+            project = choose_project(project_bytes, running, capacity)
+            project_bytes[project] += num_bytes
+            running[project] += 1
+            end = now + num_bytes / bytes_per_second
+            heapq.heappush(events, (end, project))
+            makespan = max(makespan, end)
+    else:
+        # (time free, slot, project) for each slot
+        slots = [(0.0, slot, slot % num_projects) for slot in range(parallelism)]
+        for num_bytes in job_bytes:
+            free, slot, project = heapq.heappop(slots)
+            project_bytes[project] += num_bytes
+            end = free + num_bytes / bytes_per_second
+            heapq.heappush(slots, (end, slot, project))
+            makespan = max(makespan, end)
+    return Simulation(makespan, project_bytes)
+
+
+class Scheduler:
+    """Run jobs longest first, balancing bytes across billing projects.
+
+    No job starts until num_jobs have been submitted, so that the largest job
+    overall starts first, rather than the largest of the jobs that happened to
+    be submitted before a slot was free.
+
+    Estimated completion time is logged when jobs start, from a simulation at
+    bytes_per_second, and as jobs finish, from their observed throughput.
+    """
+
+    def __init__(
+        self, clients, parallelism, num_jobs, bytes_per_second, log_interval=60
+    ):
+        """Initialize."""
+        self.clients = clients
+        self.parallelism = parallelism
+        self.capacity = project_capacity(parallelism, len(clients))
+        self.num_jobs = num_jobs
+        self.bytes_per_second = bytes_per_second
+        self.log_interval = log_interval
+        self.assigned_bytes = [0] * len(clients)
+        self.running = [0] * len(clients)
+        self.submitted = 0
+        self.finished = 0
+        self.total_bytes = 0
+        self.finished_bytes = 0
+        self.started = None
+        self._last_log = 0.0
+        self._waiting: List = []
+        self._seq = itertools.count()
+
+    async def run(self, num_bytes, func):
+        """Await func with a client once scheduled, and return the result.
+
+        func is a coroutine function, and num_bytes is the estimated number of
+        bytes its job will process.
+        """
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (-num_bytes, next(self._seq), granted))
+        self.submitted += 1
+        self.total_bytes += num_bytes
+        self._dispatch()
+        project = await granted
+        try:
+            return await func(self.clients[project])
+        finally:
+            self.running[project] -= 1
+            self.finished += 1
+            self.finished_bytes += num_bytes
+            self._log_progress()
+            self._dispatch()
+
+    def _dispatch(self):
+        """Start the largest waiting jobs while there are free slots."""
+        if self.submitted < self.num_jobs:
+            return
+        if self.started is None:
+            self.started = self._last_log = time.monotonic()
+            if self.total_bytes:
+                simulation = simulate(
+                    [-num_bytes for num_bytes, _, _ in self._waiting],
+                    len(self.clients),
+                    self.parallelism,
+                    self.bytes_per_second,
+                    longest_first=True,
+                )
+                logging.info(
+                    f"Scheduled {self.num_jobs} jobs to process {self.total_bytes} "
+                    "bytes; estimated to finish at "
+                    f"{self._finish_time(simulation.makespan)}"
+                )
+        while self._waiting and sum(self.running) < self.parallelism:
+            neg_bytes, _, granted = heapq.heappop(self._waiting)
+            if granted.cancelled():
+                continue
+            project = choose_project(self.assigned_bytes, self.running, self.capacity)
+            self.assigned_bytes[project] -= neg_bytes
+            self.running[project] += 1
+            granted.set_result(project)
+
+    def eta(self):
+        """Estimate when all jobs will finish from the throughput so far."""
+        if self.started is None or not self.finished_bytes:
+            return None
+        elapsed = time.monotonic() - self.started
+        remaining_bytes = self.total_bytes - self.finished_bytes
+        return self._finish_time(elapsed * remaining_bytes / self.finished_bytes)
+
+    @staticmethod
+    def _finish_time(seconds):
+        """Format the UTC time that is seconds from now."""
+        return f"{datetime.utcnow() + timedelta(seconds=seconds):%Y-%m-%d %H:%M} UTC"
+
+    def _log_progress(self):
+        """Log progress and estimated completion time, at most every log_interval."""
+        now = time.monotonic()
+        if not self.total_bytes:
+            return
+        if self.finished < self.num_jobs and now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        logging.info(
+            f"Finished {self.finished} of {self.num_jobs} jobs and "
+            f"{self.finished_bytes} of {self.total_bytes} bytes; "
+            f"estimated to finish at {self.eta()}"
+        )
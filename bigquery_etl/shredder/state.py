@@ -0,0 +1,305 @@
+"""Journal of shredder jobs, used to avoid repeating work if interrupted.
+
+Each task records a row when its job starts, and another when the job
+finishes with the job's destination and bytes processed. A resumed run can
+then reuse finished tasks directly from the journal, and only has to look up
+jobs that were still running when it was interrupted.
+
+Rows for started jobs are written immediately, so that a run that is killed
+without cleaning up doesn't lose track of jobs that may still be running and
+resubmit them. Rows for finished jobs are buffered and written in batches,
+because a resumed run can still look up a job that was recorded as started.
+"""
+
+from dataclasses import asdict, dataclass, fields
+from datetime import date, datetime
+from textwrap import dedent
+from threading import RLock
+from typing import Dict, List, Optional
+import logging
+import sqlite3
+import time
+
+from google.cloud import bigquery
+
+
+@dataclass
+class TaskState:
+    """Row in the journal for a task."""
+
+    task_id: str
+    # job id in the format project.location.job_id
+    job: str
+    job_started: datetime
+    start_date: date
+    end_date: date
+    job_ended: Optional[datetime] = None
+    # standard sql table id of the destination of the job, if any
+    destination: Optional[str] = None
+    total_bytes_processed: Optional[int] = None
+
+    def completed_job(self):
+        """Get a stand in for the finished job of this task."""
+        project, location, job_id = self.job.split(".")
+        destination = None
+        if self.destination is not None:
+            destination = bigquery.TableReference.from_string(self.destination)
+        return CompletedJob(
+            project=project,
+            location=location,
+            job_id=job_id,
+            started=self.job_started,
+            ended=self.job_ended,
+            destination=destination,
+            total_bytes_processed=self.total_bytes_processed,
+        )
+
+
+@dataclass
+class CompletedJob:
+    """Job that finished in a previous run, with the attributes used by delete."""
+
+    project: str
+    location: str
+    job_id: str
+    started: datetime
+    ended: datetime
+    destination: Optional[bigquery.TableReference]
+    total_bytes_processed: Optional[int]
+    errors = None
+
+    @property
+    def ddl_target_table(self):
+        """Get the table created by a DDL job, which is recorded as the destination."""
+        return self.destination
+
+
+def job_destination(job):
+    """Get the standard sql table id of the destination of job, if any."""
+    table = getattr(job, "ddl_target_table", None) or job.destination
+    if table is None:
+        return None
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+class State:
+    """Journal of shredder jobs, kept in memory.
+
+    Subclasses persist the journal by implementing _read and _write. Rows for
+    started jobs are written immediately, along with any buffered rows. Rows for
+    finished jobs are written when batch_size rows are buffered, when
+    flush_interval seconds have passed since the last write, and on flush.
+    """
+
+    def __init__(self, start_date, end_date, batch_size=500, flush_interval=60):
+        """Initialize."""
+        self.start_date = start_date
+        self.end_date = end_date
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.tasks: Dict[str, TaskState] = {}
+        self._buffer: List[TaskState] = []
+        self._last_flush = time.monotonic()
+        # jobs are recorded from executor threads
+        self._lock = RLock()
+
+    def __str__(self):
+        """Describe where state is recorded, for logging."""
+        return "memory"
+
+    def load(self):
+        """Load the latest row for each task for start_date and end_date."""
+        for row in self._read():
+            # rows are in the order they were written, so later rows win
+            self.tasks[row.task_id] = row
+        return self
+
+    def get(self, task_id):
+        """Get the latest row for task_id, or None."""
+        return self.tasks.get(task_id)
+
+    def started(self, task_id, job):
+        """Record that job was started for task_id."""
+        self._add(
+            TaskState(
+                task_id=task_id,
+                job=f"{job.project}.{job.location}.{job.job_id}",
+                job_started=job.started,
+                start_date=self.start_date,
+                end_date=self.end_date,
+            ),
+            flush=True,
+        )
+
+    def finished(self, task_id, job):
+        """Record that job finished successfully for task_id."""
+        self._add(
+            TaskState(
+                task_id=task_id,
+                job=f"{job.project}.{job.location}.{job.job_id}",
+                job_started=job.started,
+                start_date=self.start_date,
+                end_date=self.end_date,
+                job_ended=job.ended,
+                destination=job_destination(job),
+                total_bytes_processed=getattr(job, "total_bytes_processed", None),
+            )
+        )
+
+    def _add(self, row, flush=False):
+        """Buffer row, and write buffered rows if flush is set or a batch is due."""
+        with self._lock:
+            self.tasks[row.task_id] = row
+            self._buffer.append(row)
+            if (
+                flush
+                or len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self.flush()
+
+    def flush(self):
+        """Write buffered rows."""
+        with self._lock:
+            if self._buffer:
+                logging.debug(f"Recording {len(self._buffer)} rows in {self}")
+                self._write(self._buffer)
+                self._buffer = []
+            self._last_flush = time.monotonic()
+
+    def _read(self):
+        """Read rows for start_date and end_date in the order they were written."""
+        return []
+
+    def _write(self, rows):
+        """Write rows."""
+
+
+class BigQueryState(State):
+    """Journal of shredder jobs in a BigQuery table, written via streaming inserts.
+
+    The table is created if it doesn't exist, and columns added since it was
+    created are added to it.
+    """
+
+    SCHEMA = [
+        bigquery.SchemaField("task_id", "STRING"),
+        bigquery.SchemaField("job", "STRING"),
+        bigquery.SchemaField("job_started", "TIMESTAMP"),
+        bigquery.SchemaField("start_date", "DATE"),
+        bigquery.SchemaField("end_date", "DATE"),
+        bigquery.SchemaField("job_ended", "TIMESTAMP"),
+        bigquery.SchemaField("destination", "STRING"),
+        bigquery.SchemaField("total_bytes_processed", "INTEGER"),
+    ]
+
+    def __init__(self, client, table_id, *args, **kwargs):
+        """Initialize."""
+        super().__init__(*args, **kwargs)
+        self.client = client
+        if table_id.count(".") == 1:
+            table_id = f"{client.project}.{table_id}"
+        self.table_id = table_id
+        self._table = None
+
+    def __str__(self):
+        """Describe where state is recorded, for logging."""
+        return self.table_id
+
+    def _get_table(self):
+        """Get the state table, creating it or adding missing columns as needed."""
+        if self._table is None:
+            table = self.client.create_table(
+                bigquery.Table(self.table_id, schema=self.SCHEMA), exists_ok=True
+            )
+            names = {field.name for field in table.schema}
+            missing = [field for field in self.SCHEMA if field.name not in names]
+            if missing:
+                table.schema = [*table.schema, *missing]
+                table = self.client.update_table(table, ["schema"])
+            self._table = table
+        return self._table
+
+    def _read(self):
+        """Read rows for start_date and end_date in the order they were written."""
+        self._get_table()
+        query = dedent(
+            f"""
+            SELECT
+              *
+            FROM
+              `{self.table_id}`
+            WHERE
+              start_date = '{self.start_date}'
+              AND end_date = '{self.end_date}'
+            ORDER BY
+              job_started,
+              job_ended IS NOT NULL
+            """
+        ).strip()
+        return [
+            TaskState(**{field.name: row[field.name] for field in fields(TaskState)})
+            for row in self.client.query(query).result()
+        ]
+
+    def _write(self, rows):
+        """Write rows via streaming inserts."""
+        errors = self.client.insert_rows(
+            self._get_table(), [asdict(row) for row in rows]
+        )
+        if errors:
+            raise ValueError(f"Failed to record state in {self}: {errors}")
+
+
+class SqliteState(State):
+    """Journal of shredder jobs in a local SQLite database.
+
+    Useful for testing and for small runs that don't need a shared state table.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        """Initialize."""
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        columns = ", ".join(field.name for field in fields(TaskState))
+        with self._connection:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS state ({columns})")
+
+    def __str__(self):
+        """Describe where state is recorded, for logging."""
+        return self.path
+
+    def _read(self):
+        """Read rows for start_date and end_date in the order they were written."""
+        rows = self._connection.execute(
+            "SELECT * FROM state WHERE start_date = ? AND end_date = ? ORDER BY rowid",
+            (str(self.start_date), str(self.end_date)),
+        )
+        columns = [column for column, *_ in rows.description]
+        result = []
+        for values in rows:
+            row = dict(zip(columns, values))
+            for key in ("job_started", "job_ended"):
+                if row[key] is not None:
+                    row[key] = datetime.fromisoformat(row[key])
+            for key in ("start_date", "end_date"):
+                row[key] = date.fromisoformat(row[key])
+            result.append(TaskState(**row))
+        return result
+
+    def _write(self, rows):
+        """Write rows in a single transaction."""
+        names = [field.name for field in fields(TaskState)]
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT INTO state ({', '.join(names)}) "
+                f"VALUES ({', '.join('?' for _ in names)})",
+                [
+                    tuple(
+                        value if value is None or isinstance(value, int) else str(value)
+                        for value in (getattr(row, name) for name in names)
+                    )
+                    for row in rows
+                ],
+            )
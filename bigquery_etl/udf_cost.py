@@ -0,0 +1,124 @@
+"""Measure the cost of inlining temporary UDF definitions into queries.
+
+Queries are generated with the definitions of every UDF they use, and the
+UDFs those depend on, prepended as temporary UDFs. This measures the size of
+those definitions for each query, so that large queries can reference
+persistent UDFs instead, and produces that persistent variant of a query.
+"""
+
+from dataclasses import dataclass
+import os
+import re
+from typing import Dict, List
+
+from .parse_udf import udf_usages_in_text
+
+# temporary UDF names, not including those that are part of another name
+TEMP_UDF_RE = re.compile(r"\b(?:udf|assert)_[a-zA-Z0-9_]+")
+JS_UDF_RE = re.compile(r"\bLANGUAGE\s+js\b", re.IGNORECASE)
+
+
+@dataclass
+class UdfCost:
+    """Cost of the UDF definitions inlined into a query."""
+
+    path: str
+    # size in bytes of the query, without inlined definitions
+    query_bytes: int
+    # size in bytes of the inlined definitions
+    inline_bytes: int
+    # names of the inlined UDFs, dependencies first
+    udfs: List[str]
+    # length of the longest chain of UDF dependencies
+    depth: int
+    # names of the inlined JavaScript UDFs
+    js_udfs: List[str]
+    # size in bytes of the inlined JavaScript UDF definitions
+    js_bytes: int
+    # size in bytes of inlined JavaScript UDF definitions that are also
+    # inlined into other queries, filled in by measure_files
+    duplicate_js_bytes: int = 0
+
+    def mode(self, threshold):
+        """Get the cheaper mode for this query, given a threshold in bytes.
+
+        Persistent UDFs are preferred when the inlined definitions are larger
+        than threshold.
+        """
+        return "persistent" if self.inline_bytes > threshold else "inline"
+
+
+def definition_bytes(raw_udf):
+    """Get the size in bytes of the definitions of raw_udf when inlined."""
+    return sum(len(definition.encode()) + 2 for definition in raw_udf.definitions)
+
+
+def measure(text, graph, path=None):
+    """Measure the cost of inlining the UDFs used in query text from graph."""
+    udf_names = graph.resolve(udf_usages_in_text(text))
+    js_udfs = [
+        udf_name
+        for udf_name in udf_names
+        if any(JS_UDF_RE.search(d) for d in graph.raw_udfs[udf_name].definitions)
+    ]
+    return UdfCost(
+        path=path,
+        query_bytes=len(text.encode()),
+        inline_bytes=sum(definition_bytes(graph.raw_udfs[n]) for n in udf_names),
+        udfs=udf_names,
+        depth=1 + max((graph.levels[n] for n in udf_names), default=-1),
+        js_udfs=js_udfs,
+        js_bytes=sum(definition_bytes(graph.raw_udfs[n]) for n in js_udfs),
+    )
+
+
+def measure_files(paths, graph):
+    """Measure the cost of inlining UDFs into each query file in paths.
+
+    Return a list of UdfCost in the same order as paths, including the bytes of
+    JavaScript UDFs that are duplicated across them.
+    """
+    costs = []
+    for path in paths:
+        with open(path) as fp:
+            costs.append(measure(fp.read(), graph, path))
+    queries: Dict[str, int] = {}
+    for cost in costs:
+        for udf_name in cost.js_udfs:
+            queries[udf_name] = queries.get(udf_name, 0) + 1
+    for cost in costs:
+        cost.duplicate_js_bytes = sum(
+            definition_bytes(graph.raw_udfs[udf_name])
+            for udf_name in cost.js_udfs
+            if queries[udf_name] > 1
+        )
+    return costs
+
+
+def persistent_udf_name(raw_udf, project_id=None):
+    """Get the name of the persistent UDF published for raw_udf.
+
+    Persistent UDFs are in a dataset named after the directory of the UDF file.
+    """
+    dirpath, basename = os.path.split(raw_udf.filepath)
+    dataset = os.path.basename(os.path.normpath(dirpath))
+    name = f"{dataset}.{basename.replace('.sql', '')}"
+    if project_id:
+        name = f"`{project_id}`.{name}"
+    return name
+
+
+def persistent_variant(text, graph, project_id=None):
+    """Replace references to temporary UDFs from graph with persistent UDFs.
+
+    This is the inverse of parse_udf.sub_persisent_udfs_as_temp, for query text
+    that doesn't need any UDF definitions to be prepended.
+    """
+
+    def sub(match):
+        raw_udf = graph.raw_udfs.get(match.group())
+        if raw_udf is None:
+            return match.group()
+        return persistent_udf_name(raw_udf, project_id)
+
+    return TEMP_UDF_RE.sub(sub, text)
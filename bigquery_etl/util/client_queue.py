@@ -19,6 +19,7 @@ class ClientQueue:
     def __init__(self, billing_projects, parallelism):
         """Initialize."""
         clients = [bigquery.Client(project) for project in billing_projects]
+        self.clients = clients
         self.default_client = clients[0]
         self._q = Queue(parallelism)
         for i in range(parallelism):
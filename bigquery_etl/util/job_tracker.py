@@ -0,0 +1,116 @@
+"""Wait for BigQuery jobs asynchronously, without a thread per job."""
+
+from functools import partial
+from typing import Dict, Tuple
+import asyncio
+import logging
+
+from google.api_core.exceptions import GoogleAPICallError
+
+
+async def to_thread(func, *args, **kwargs):
+    """Run a short blocking call in the default executor of the running loop."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, partial(func, *args, **kwargs)
+    )
+
+
+def active_job_ids(client, project):
+    """Get the ids of jobs in project that are pending or running."""
+    return {
+        job.job_id
+        for state_filter in ("pending", "running")
+        for job in client.list_jobs(project=project, state_filter=state_filter)
+    }
+
+
+class JobTracker:
+    """Wait for BigQuery jobs asynchronously by polling their status in batches.
+
+    Instead of a blocking job.result() per job, all pending jobs in a project are
+    checked with one list_jobs call per state, and only jobs that are no longer
+    pending or running are reloaded. Polling backs off from min_interval to
+    max_interval seconds while no jobs finish.
+    """
+
+    def __init__(self, client, min_interval=1, max_interval=60, backoff=1.5):
+        """Initialize, with client for listing jobs in any project."""
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._pending: Dict[Tuple[str, str], Tuple] = {}
+        self._poller = None
+
+    async def wait(self, job):
+        """Wait for job to finish, and return it reloaded.
+
+        Raise GoogleAPICallError if the job failed.
+        """
+        key = job.project, job.job_id
+        if key not in self._pending:
+            self._pending[key] = job, asyncio.get_running_loop().create_future()
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        # shield the shared future so a cancelled waiter doesn't cancel it
+        return await asyncio.shield(self._pending[key][1])
+
+    async def _poll(self):
+        """Poll pending jobs until there are none, backing off while none finish."""
+        interval = self.min_interval
+        while self._pending:
+            await asyncio.sleep(interval)
+            try:
+                finished = await self.poll()
+            except GoogleAPICallError as e:
+                logging.warning(f"Failed to check job status, retrying: {e}")
+                finished = 0
+            except Exception as e:
+                for _, future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(e)
+                self._pending.clear()
+                raise
+            if finished:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+    async def poll(self):
+        """Check the status of pending jobs, and return the number that finished."""
+        projects = {project for project, _ in self._pending}
+        active = dict(
+            zip(
+                projects,
+                await asyncio.gather(
+                    *[
+                        to_thread(active_job_ids, self.client, project)
+                        for project in projects
+                    ]
+                ),
+            )
+        )
+        candidates = [
+            job
+            for (project, job_id), (job, _) in self._pending.items()
+            if job_id not in active[project]
+        ]
+        # a job that was just created may not be listed yet, so check the state
+        await asyncio.gather(*[to_thread(job.reload) for job in candidates])
+        finished = 0
+        for job in candidates:
+            if job.state != "DONE":
+                continue
+            finished += 1
+            _, future = self._pending.pop((job.project, job.job_id))
+            if job.error_result:
+                future.set_exception(
+                    GoogleAPICallError(
+                        f"{job.project}.{job.location}.{job.job_id} failed: "
+                        f"{job.error_result.get('message')}",
+                        errors=job.errors or [job.error_result],
+                    )
+                )
+            else:
+                future.set_result(job)
+        return finished
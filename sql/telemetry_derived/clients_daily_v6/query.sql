@@ -50,7 +50,8 @@ CREATE TEMP FUNCTION udf_geo_struct(
   city STRING,
   geo_subdivision1 STRING,
   geo_subdivision2 STRING
-) AS ( IF(
+) AS (
+  IF(
     country IS NULL
     OR country = '??',
     NULL,
@@ -8,7 +8,7 @@ CREATE TEMP FUNCTION
     BIT_COUNT(x >> (7 * n) & udf_bitmask_lowest_7()) > 0
   );
 
-CREATE TEMP FUNCTION
+CREATE TEMP FUNCTION 
   udf_bitcount_lowest_7(x INT64) AS (
   	BIT_COUNT(x & udf_bitmask_lowest_7())
   );
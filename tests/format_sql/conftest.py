@@ -1,10 +1,12 @@
 """PyTest plugin for running sql tests."""
 
+from io import StringIO
 import os
 
 import pytest
 
-from bigquery_etl.format_sql.formatter import reformat
+from bigquery_etl.format_sql.formatter import reformat, reformat_stream
+from bigquery_etl.format_sql.incremental import IncrementalFormatter
 
 
 def pytest_configure(config):
@@ -49,3 +51,5 @@ class FormatTest(pytest.Item, pytest.File):
         except FileNotFoundError:
             query = expect
         assert reformat(query) + "\n" == expect
+        assert "".join(reformat_stream(StringIO(query))) + "\n" == expect
+        assert IncrementalFormatter(query).formatted + "\n" == expect
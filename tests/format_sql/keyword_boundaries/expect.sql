@@ -0,0 +1,50 @@
+-- keywords only match whole words
+SELECT
+  selected,
+  fromage,
+  end_date,
+  IFNULL(x, 0),
+  `select`,
+  t.from
+FROM
+  t;
+
+-- keywords match across whitespace
+SELECT
+  x
+FROM
+  t
+GROUP BY
+  x
+ORDER BY
+  x;
+
+-- lookahead conditions
+SELECT
+  x
+FROM
+  UNNEST([1])
+  WITH OFFSET AS off;
+
+WITH withdrawals AS (
+  SELECT
+    1
+)
+SELECT
+  x AS total,
+  x AS `y`
+FROM
+  withdrawals;
+
+SELECT
+  IF(x, 1, 2),
+  end_if
+FROM
+  t;
+
+IF
+  x
+THEN
+  SELECT
+    1;
+END IF;
@@ -0,0 +1,10 @@
+-- keywords only match whole words
+select selected, fromage, end_date, ifnull(x, 0), `select`, t.from from t;
+-- keywords match across whitespace
+select x from t group
+  by x order   by x;
+-- lookahead conditions
+select x from unnest([1]) with offset as off;
+with withdrawals as (select 1) select x as total, x as `y` from withdrawals;
+select if(x, 1, 2), end_if from t;
+if x then select 1; end if;
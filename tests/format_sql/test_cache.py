@@ -0,0 +1,34 @@
+from bigquery_etl.format_sql.cache import StatementCache
+from bigquery_etl.format_sql.formatter import reformat, simple_format
+
+UDF = """CREATE TEMP FUNCTION udf_f(x INT64) AS (
+  IF(x > 0, x, 0)
+);
+"""
+
+
+def test_statement_cache():
+    cache = StatementCache(prefix_length=16)
+    queries = [
+        UDF + "\nselect udf_f(1)",
+        UDF + "\n-- comment\nselect udf_f(2)",
+        # same text followed by a comment on the same line, which isn't reused
+        UDF[:-1] + " -- comment\nselect udf_f(3)",
+        "select 1;\n" + UDF + ";\nselect 2",
+        UDF[:-1],
+    ]
+    for query in queries:
+        for format_ in (simple_format, None):
+            kwargs = {"format_": format_} if format_ else {}
+            assert reformat(query, cache=cache, **kwargs) == reformat(query, **kwargs)
+    assert cache.hits > 0
+    assert "hit rate" in cache.report()
+
+
+def test_statement_cache_eviction():
+    cache = StatementCache(maxsize=1, prefix_length=16)
+    reformat(UDF + "select 1", cache=cache)
+    reformat("SELECT x FROM a_long_table_name;\nselect 1", cache=cache)
+    assert len(cache) == 1
+    assert cache.evictions == 1
+    assert cache.match(UDF + "select 1", 0) is None
@@ -0,0 +1,76 @@
+import pytest
+
+from bigquery_etl.format_sql.formatter import (
+    inline_block_format,
+    reformat,
+    simple_format,
+)
+from bigquery_etl.format_sql.incremental import IncrementalFormatter, TextEdit
+
+QUERY = """select 1; -- one
+select a, b from c where d group by a;
+/* block */
+if x then select 2; select 3; end if;
+create temp function f(x array<int64>) as (x);
+-- format:off
+select   4;
+-- format:on
+select case when e then f else g end from h"""
+
+EDITS = [
+    # inside a statement
+    (QUERY.index("a, b"), QUERY.index("a, b") + 1, "aa"),
+    # delete a statement separator, merging statements
+    (QUERY.index("; --"), QUERY.index("; --") + 1, ""),
+    # insert a statement separator, splitting a statement
+    (QUERY.index(" from c"), QUERY.index(" from c"), ";"),
+    # at the boundary between statements
+    (QUERY.index("/* block"), QUERY.index("/* block"), "-- "),
+    # comment on the same line as a statement separator
+    (QUERY.index("one"), QUERY.index("one") + 3, "/* format:off */"),
+    # unterminated strings and comments change the rest of the query
+    (QUERY.index("d group"), QUERY.index("d group"), "'"),
+    (QUERY.index("select 2"), QUERY.index("select 2"), "/*"),
+    # inside a block, where statements can't be formatted independently
+    (QUERY.index("select 3"), QUERY.index("select 3") + 8, "select 33"),
+    # inside disabled formatting
+    (QUERY.index("select   4"), QUERY.index("select   4"), "  "),
+    # start and end of the query
+    (0, 0, "with "),
+    (len(QUERY), len(QUERY), ";\nselect 5;\n"),
+    (0, len(QUERY), ""),
+]
+
+
+@pytest.mark.parametrize("start,end,text", EDITS)
+@pytest.mark.parametrize("format_", [simple_format, inline_block_format])
+def test_edit(start, end, text, format_):
+    formatter = IncrementalFormatter(QUERY, format_)
+    before = formatter.formatted
+    assert before == reformat(QUERY, format_)
+    edits = formatter.edit(start, end, text)
+    query = QUERY[:start] + text + QUERY[end:]
+    expect = reformat(query, format_)
+    assert formatter.query == query
+    assert formatter.formatted == expect
+    for edit in edits:
+        before = edit.apply(before)
+    assert before == expect
+
+
+def test_consecutive_edits():
+    formatter = IncrementalFormatter("")
+    query = ""
+    for position, text in [(0, "select 1"), (8, ";\nselect"), (9, " 2;"), (0, "'")]:
+        formatter.edit(position, position, text)
+        query = query[:position] + text + query[position:]
+        assert formatter.formatted == reformat(query)
+    assert "".join(token.value for token in formatter.tokens) == query
+
+
+def test_minimal_diff():
+    formatter = IncrementalFormatter("select a from b;\nselect c from d;\n")
+    assert formatter.edit(7, 8, "aa") == [TextEdit(10, 10, "a")]
+    assert formatter.edit(0, 0, "") == []
+    with pytest.raises(ValueError):
+        formatter.edit(5, 2, "")
@@ -0,0 +1,24 @@
+import pytest
+
+from bigquery_etl.format_sql import formatter
+from bigquery_etl.format_sql.cache import StatementCache
+from bigquery_etl.format_sql.formatter import reformat
+
+QUERY = """select a from b; -- one
+select 'c;d';
+/* e; */
+if x then select 1; select 2; end if;
+create temp function f(x array<int64>) as (x);
+-- format:off
+select   3;  select 4;
+-- format:on
+select case when e then f else g end from h;;
+select 5"""
+
+
+def test_parallel(monkeypatch):
+    # split into many small chunks, some of which don't start at a statement
+    monkeypatch.setattr(formatter, "PARALLEL_CHUNK_SIZE", 10)
+    assert reformat(QUERY * 3, jobs=2) == reformat(QUERY * 3)
+    with pytest.raises(ValueError):
+        reformat(QUERY, cache=StatementCache(), jobs=2)
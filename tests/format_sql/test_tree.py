@@ -0,0 +1,82 @@
+from bigquery_etl.format_sql.tree import parse, split, strip_comments
+
+
+def test_statements():
+    statements = parse("SELECT 1; -- comment\nSELECT (2;\nSELECT 3)")
+    assert [statement.text for statement in statements] == [
+        "SELECT 1;",
+        " -- comment\nSELECT (2;",
+        "\nSELECT 3)",
+    ]
+    assert statements[0].separator.value == ";"
+    assert statements[2].separator is None
+
+
+def test_view():
+    (statement,) = parse(
+        "-- comment\n"
+        "CREATE OR REPLACE VIEW\n"
+        "  `moz-fx-data-shared-prod.telemetry.main`\n"
+        "AS SELECT * FROM `moz-fx-data-shared-prod.telemetry_stable.main_v4`"
+    )
+    clause = statement.first_clause
+    assert clause.keyword == "CREATE OR REPLACE VIEW"
+    assert clause.table_references == ["`moz-fx-data-shared-prod.telemetry.main`"]
+    assert statement.table_references == [
+        "`moz-fx-data-shared-prod.telemetry.main`",
+        "`moz-fx-data-shared-prod.telemetry_stable.main_v4`",
+    ]
+
+
+def test_ctes_and_table_references():
+    (statement,) = parse(
+        "WITH a AS (SELECT * FROM p.d.t1 JOIN d.t2 USING (x)),\n"
+        "b AS (SELECT * FROM a, moz-fx-data.d.events_*)\n"
+        "SELECT ARRAY<STRUCT<x INT64>>[], (SELECT 1 FROM d.t3)\n"
+        "FROM b LEFT JOIN UNNEST(y)"
+    )
+    assert [cte.name for cte in statement.ctes] == ["a", "b"]
+    assert [clause.keyword for clause in statement.clauses] == [
+        "WITH",
+        "SELECT",
+        "FROM",
+        "LEFT JOIN",
+    ]
+    assert statement.table_references == [
+        "p.d.t1",
+        "d.t2",
+        "moz-fx-data.d.events_*",
+        "d.t3",
+    ]
+    assert statement.ctes[0].node.table_references == ["p.d.t1", "d.t2"]
+
+
+def test_first_clause():
+    (statement,) = parse("1 FROM a")
+    assert statement.first_clause is None
+
+
+def test_strip_comments():
+    assert strip_comments("SELECT a/* b */FROM c -- d\n  # e\n") == "SELECT a FROM c\n"
+    assert strip_comments('SELECT \'-- a\', """/* b */"""') == (
+        'SELECT \'-- a\', """/* b */"""'
+    )
+
+
+def test_split():
+    query = (
+        "-- only a comment;\n"
+        "CREATE TEMP FUNCTION f() AS (\n"
+        "  ''';'''  -- ;\n"
+        ");\n"
+        "/* ; */\n"
+        "SELECT f();\n"
+    )
+    assert split(query) == [
+        "-- only a comment;\nCREATE TEMP FUNCTION f() AS (\n  ''';'''  -- ;\n);",
+        "/* ; */\nSELECT f();",
+    ]
+    assert split(query, strip_comments=True) == [
+        "CREATE TEMP FUNCTION f() AS (\n  ''';'''\n);",
+        "SELECT f();",
+    ]
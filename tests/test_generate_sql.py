@@ -0,0 +1,44 @@
+from bigquery_etl.generate_sql import GenerateManifest, generate
+from bigquery_etl.parse_udf import _raw_udfs, _udf_graphs
+
+UDF_F = "CREATE TEMP FUNCTION udf_f(x INT64) AS (udf_g(x));"
+UDF_G = "CREATE TEMP FUNCTION udf_g(x INT64) AS (x);"
+
+
+def test_generate_incremental(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "udf").mkdir()
+    (tmp_path / "udf" / "f.sql").write_text(UDF_F)
+    (tmp_path / "udf" / "g.sql").write_text(UDF_G)
+    for dataset in ["a", "b"]:
+        (tmp_path / "templates" / dataset).mkdir(parents=True)
+    (tmp_path / "templates" / "a" / "f.sql").write_text("SELECT udf_f(1)")
+    (tmp_path / "templates" / "a" / "g.sql").write_text("SELECT udf_g(1)")
+    (tmp_path / "templates" / "b" / "x.sql").write_text("SELECT 1")
+
+    def run():
+        # reload UDFs, like a new process would
+        _raw_udfs.clear()
+        _udf_graphs.clear()
+        manifest = GenerateManifest("manifest.json")
+        result = generate("templates", "sql", ["udf"], manifest=manifest)
+        manifest.save()
+        return result
+
+    assert run() == (3, 0, 0)
+    assert (tmp_path / "sql" / "a" / "f.sql").read_text() == "\n\n".join(
+        [UDF_G, UDF_F, "SELECT udf_f(1)"]
+    )
+    assert run() == (0, 3, 0)
+    # changing a dependency regenerates the queries that use it
+    (tmp_path / "udf" / "g.sql").write_text(UDF_G.replace("(x)", "(x + 1)"))
+    assert run() == (2, 1, 0)
+    # changing a template or removing an output regenerates that query
+    (tmp_path / "templates" / "a" / "g.sql").write_text("SELECT udf_g(2)")
+    (tmp_path / "sql" / "b" / "x.sql").unlink()
+    assert run() == (2, 1, 0)
+    assert (tmp_path / "sql" / "b" / "x.sql").read_text() == "SELECT 1"
+    # removing a template removes its output
+    (tmp_path / "templates" / "b" / "x.sql").unlink()
+    assert run() == (0, 2, 1)
+    assert not (tmp_path / "sql" / "b").exists()
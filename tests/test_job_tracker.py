@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import asyncio
+
+from google.api_core.exceptions import GoogleAPICallError
+import pytest
+
+from bigquery_etl.util.job_tracker import JobTracker
+
+
+class FakeJob:
+    def __init__(self, job_id, polls, error_result=None):
+        self.project = "p"
+        self.location = "US"
+        self.job_id = job_id
+        self.state = "RUNNING"
+        self.polls = polls
+        self.error_result = error_result
+        self.errors = None
+        self.reloads = 0
+
+    def reload(self):
+        self.reloads += 1
+        if self.polls <= 0:
+            self.state = "DONE"
+
+
+class FakeClient:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.list_calls = 0
+
+    def list_jobs(self, project, state_filter):
+        self.list_calls += 1
+        if state_filter == "running":
+            for job in self.jobs:
+                job.polls -= 1
+        return [
+            SimpleNamespace(job_id=job.job_id)
+            for job in self.jobs
+            if job.polls > 0 and state_filter == "running"
+        ]
+
+
+def test_job_tracker():
+    jobs = [FakeJob("a", 1), FakeJob("b", 3), FakeJob("c", 2)]
+    client = FakeClient(jobs)
+    tracker = JobTracker(client, min_interval=0, max_interval=0)
+
+    async def run():
+        return await asyncio.gather(*[tracker.wait(job) for job in jobs])
+
+    assert asyncio.run(run()) == jobs
+    # one list call per state per poll, instead of a call per job per poll
+    assert client.list_calls == 6
+    # jobs are only reloaded once they aren't listed as pending or running
+    assert [job.reloads for job in jobs] == [1, 1, 1]
+
+
+def test_job_tracker_error():
+    job = FakeJob("a", 1, error_result={"message": "oops"})
+    tracker = JobTracker(FakeClient([job]), min_interval=0)
+    with pytest.raises(GoogleAPICallError, match="p.US.a failed: oops"):
+        asyncio.run(tracker.wait(job))
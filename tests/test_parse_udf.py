@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from bigquery_etl.parse_udf import (
+    RawUdf,
+    UdfIndex,
+    UdfUsageIndex,
+    find_unused_udfs,
+    read_udf_dirs,
+)
+from tests.udf_helpers import udf_graph
+
+UDF = """CREATE TEMP FUNCTION udf_f(x INT64) AS (udf_g(x));
+SELECT assert_equals(1, udf_f(1));
+"""
+
+
+def test_udf_index(tmp_path):
+    udf_dir = tmp_path / "udf"
+    udf_dir.mkdir()
+    udf_file = udf_dir / "f.sql"
+    udf_file.write_text(UDF)
+    index_path = str(tmp_path / "index.json")
+    index = UdfIndex(index_path)
+    raw_udfs = read_udf_dirs(str(udf_dir), index=index)
+    assert raw_udfs == read_udf_dirs(str(udf_dir))
+    assert raw_udfs["udf_f"].dependencies == ["udf_g"]
+    index.save()
+    # unchanged files are not parsed again
+    index = UdfIndex(index_path)
+    index.files[str(udf_file)]["udf"]["tests"] = ["cached"]
+    assert read_udf_dirs(str(udf_dir), index=index)["udf_f"].tests == ["cached"]
+    # changed files are
+    udf_file.write_text(UDF.replace("udf_g", "udf_h"))
+    os.utime(udf_file, ns=(0, 0))
+    assert read_udf_dirs(str(udf_dir), index=index)["udf_f"].dependencies == ["udf_h"]
+
+
+def test_raw_udf_xfail():
+    raw_udf = RawUdf.from_text(
+        UDF + "-- comment\n#xfail\nSELECT udf_f(0);", "udf/f.sql"
+    )
+    assert raw_udf.tests == [
+        "SELECT assert_equals(1, udf_f(1));",
+        "#xfail\nSELECT udf_f(0);",
+    ]
+
+
+def test_udf_graph():
+    graph = udf_graph(
+        ("udf_a", "udf_b", "udf_c"),
+        ("udf_b", "udf_c", "udf_missing"),
+        ("udf_c",),
+        ("udf_d", "udf_c"),
+    )
+    assert graph.closure("udf_a") == ("udf_c", "udf_b", "udf_a")
+    assert graph.closure("udf_missing") == ()
+    assert graph.resolve(["udf_d", "udf_a"]) == ["udf_c", "udf_d", "udf_b", "udf_a"]
+    assert graph.dependents("udf_c") == ("udf_a", "udf_b", "udf_c", "udf_d")
+    assert graph.dependents("udf_a") == ("udf_a",)
+    assert graph.levels == {"udf_a": 2, "udf_b": 1, "udf_c": 0, "udf_d": 1}
+
+
+def test_udf_graph_cycle():
+    with pytest.raises(ValueError, match="udf_a -> udf_b -> udf_a"):
+        udf_graph(("udf_a", "udf_b"), ("udf_b", "udf_a"))
+
+
+def test_udf_usage_index(tmp_path):
+    graph = udf_graph(("udf_a", "udf_b"), ("udf_b",))
+    query_dir = tmp_path / "sql"
+    query_dir.mkdir()
+    (query_dir / "a.sql").write_text("SELECT udf_a(1) -- udf_c")
+    (query_dir / "b.sql").write_text("SELECT `project.udf.b`(1)")
+    index_path = str(tmp_path / "index.json")
+    index = UdfUsageIndex(index_path)
+    index.update(graph, str(query_dir))
+    index.save()
+    a, b = str(query_dir / "a.sql"), str(query_dir / "b.sql")
+    assert index.queries == {"udf_a": [a], "udf_b": [a, b]}
+    # unchanged files are not read again
+    index = UdfUsageIndex(index_path)
+    index.files[a]["usages"] = []
+    index.update(graph, str(query_dir))
+    assert index.queries == {"udf_b": [b]}
+    # removed files are removed from the index
+    (query_dir / "b.sql").unlink()
+    index.update(graph, str(query_dir))
+    assert list(index.files) == [a]
+
+
+def test_find_unused_udfs(tmp_path):
+    graph = udf_graph(("udf_a", "udf_b"), ("udf_b",), ("udf_c", "udf_d"), ("udf_d",))
+    (tmp_path / "view.sql").write_text("SELECT udf.a(1) -- udf_c")
+    (tmp_path / "generate").write_text("print('SELECT udf_d(1)')")
+    index = UdfUsageIndex(str(tmp_path / "index.json"))
+    assert find_unused_udfs(graph, str(tmp_path), index=index) == ["udf_c"]
@@ -0,0 +1,139 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from bigquery_etl.parse_udf import RawUdf
+from bigquery_etl.publish_udfs import (
+    PublishManifest,
+    persistent_udf_queries,
+    publish,
+    topological_levels,
+    upload_libraries,
+)
+from tests.udf_helpers import udf_graph
+
+
+class FakeClient:
+    def __init__(self, fail=()):
+        self.queries = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def query(self, query):
+        if any(name in query for name in self.fail):
+            raise ValueError(query)
+        with self.lock:
+            self.queries.append(query)
+        return self
+
+    def result(self):
+        pass
+
+
+class LocalBlob:
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+
+class LocalBucket:
+    def __init__(self, path):
+        self.path = path
+
+    def blob(self, name):
+        return LocalBlob(os.path.join(self.path, name))
+
+
+@pytest.fixture
+def graph():
+    return udf_graph(
+        ("udf_a", "udf_b", "udf_c"), ("udf_b", "udf_c"), ("udf_c",), ("udf_js_d",)
+    )
+
+
+def test_topological_levels(graph):
+    assert topological_levels(graph, graph.raw_udfs) == [
+        ["udf_c", "udf_js_d"],
+        ["udf_b"],
+        ["udf_a"],
+    ]
+    assert topological_levels(graph, ["udf_a", "udf_c"]) == [["udf_c"], ["udf_a"]]
+
+
+def test_publish(graph, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+
+    def run(client):
+        manifest = PublishManifest(manifest_path)
+        return publish(client, graph, graph.raw_udfs, "udf", "p", "b", "", manifest)
+
+    client = FakeClient()
+    assert run(client) == ["udf_c", "udf_js_d", "udf_b", "udf_a"]
+    assert client.queries[-1] == (
+        "CREATE OR REPLACE FUNCTION `p`.udf.a() AS (`p`.udf.b, `p`.udf.c);"
+    )
+    # unchanged UDFs are skipped
+    assert run(FakeClient()) == []
+    graph.raw_udfs["udf_b"].definitions = ["CREATE TEMP FUNCTION udf_b() AS (1);"]
+    assert run(FakeClient()) == ["udf_b"]
+    # UDFs that were published before a failure are recorded
+    graph.raw_udfs["udf_c"].definitions = ["CREATE TEMP FUNCTION udf_c() AS (2);"]
+    graph.raw_udfs["udf_js_d"].definitions = ["CREATE TEMP FUNCTION udf_js_d() AS (2);"]
+    with pytest.raises(ValueError):
+        run(FakeClient(fail=["udf.c"]))
+    assert PublishManifest(manifest_path).published.keys() == {
+        "p.udf.a",
+        "p.udf.b",
+        "p.udf.c",
+        "p.udf.d",
+    }
+    assert run(FakeClient()) == ["udf_c"]
+
+
+def test_upload_libraries(tmp_path):
+    dep_dir = tmp_path / "lib"
+    dep_dir.mkdir()
+    (dep_dir / "a.js").write_text("a")
+    (dep_dir / "b.js").write_text("b")
+    (dep_dir / "sub").mkdir()
+    (dep_dir / "sub" / "a.js").write_text("sub")
+    bucket_dir = tmp_path / "bucket"
+    libraries = upload_libraries(LocalBucket(str(bucket_dir)), "js/", str(dep_dir))
+    assert sorted(libraries) == ["a.js", "b.js", "sub/a.js"]
+    name = libraries["a.js"]
+    assert name.startswith("js/") and name.endswith("/a.js")
+    assert (bucket_dir / name).read_text() == "a"
+    # unchanged libraries keep their names, and changed libraries get new ones
+    (dep_dir / "b.js").write_text("c")
+    log = []
+    new_libraries = upload_libraries(
+        LocalBucket(str(bucket_dir)), "js/", str(dep_dir), log=log.append
+    )
+    assert log == ["uploaded 1 of 3 libraries"]
+    assert new_libraries["a.js"] == name
+    assert new_libraries["b.js"] != libraries["b.js"]
+    assert (bucket_dir / new_libraries["b.js"]).read_text() == "c"
+
+    udf = RawUdf(
+        "udf_js_f",
+        "udf_js/f.sql",
+        [
+            "CREATE TEMP FUNCTION udf_js_f() LANGUAGE js AS '' OPTIONS ("
+            ' library = "gs://tests/a.js", library = "gs://tests/sub/a.js",'
+            ' library = "gs://tests/other/c.js");'
+        ],
+        [],
+        [],
+    )
+    (query,) = persistent_udf_queries(udf, "udf_js", "p", "b", "js/", new_libraries)
+    assert f'library = "gs://b/{name}"' in query
+    assert f'library = "gs://b/{new_libraries["sub/a.js"]}"' in query
+    assert 'library = "gs://b/js/other/c.js"' in query
@@ -0,0 +1,84 @@
+import pytest
+
+from bigquery_etl.shredder.cluster_conditions import (
+    generate_conditions,
+    parse_condition,
+    validate_conditions,
+)
+from bigquery_etl.shredder.config import ClusterCondition, DELETE_TARGETS
+
+
+def test_parse_condition():
+    evaluate, literals = parse_condition(
+        "(a IS NULL OR a NOT IN (1, 2)) AND b BETWEEN 'x' AND 'y' AND NOT c.d < -1.5"
+    )
+    assert literals == {"a": {1, 2}, "b": {"x", "y"}, "c.d": {-1.5}}
+    assert evaluate({"a": None, "b": "xa", "c.d": 0}) is True
+    assert evaluate({"a": 1, "b": "xa", "c.d": 0}) is False
+    assert evaluate({"a": 3, "b": "z", "c.d": 0}) is False
+    assert evaluate({"a": 3, "b": "x", "c.d": None}) is None
+    with pytest.raises(ValueError, match="Expected a literal"):
+        parse_condition("a = b")
+
+
+def test_validate_configured_conditions():
+    targets = [target for target in DELETE_TARGETS if target.cluster_conditions]
+    assert targets
+    for target in targets:
+        assert validate_conditions(target.cluster_conditions) == []
+
+
+def test_validate_conditions_problems():
+    gap, overlap, single = validate_conditions(
+        [
+            ClusterCondition("a < 5", False),
+            ClusterCondition("a >= 3 AND a != 10", True),
+            ClusterCondition("a IS NULL", True),
+        ]
+    )
+    assert gap.startswith("1 combinations of values match no condition")
+    assert "{'a': 10}" in gap
+    assert overlap.startswith("2 combinations of values match more than one")
+    assert "{'a': 3}" in overlap
+    assert "needs_clustering is False but 'a < 5'" in single
+    # sample_id is only checked for known values, unless field_values is given
+    conditions = [
+        ClusterCondition("sample_id BETWEEN 0 AND 49", True),
+        ClusterCondition("sample_id >= 50 OR sample_id IS NULL", True),
+    ]
+    assert validate_conditions(conditions) == []
+    assert validate_conditions(conditions, field_values={}) == [
+        "1 combinations of values match no condition, such as {'sample_id': -1}"
+    ]
+
+
+def test_generate_conditions():
+    cluster_bytes = [
+        ((sample_id, channel), num_bytes)
+        for sample_id in range(10)
+        for channel, num_bytes in [("release", 300), ("beta", 20), (None, 5)]
+    ] + [((None, "release"), 3)]
+    fields = ["sample_id", "normalized_channel"]
+
+    conditions = generate_conditions(fields, cluster_bytes, 200)
+    assert validate_conditions([c for c, _ in conditions], field_values={}) == []
+    assert sum(num_bytes for _, num_bytes in conditions) == 3253
+    assert len(conditions) == 21
+    assert (
+        ClusterCondition("sample_id = 0 AND normalized_channel = 'release'", False),
+        300,
+    ) in conditions
+    assert (
+        ClusterCondition(
+            "sample_id = 0 AND (normalized_channel IS NULL "
+            "OR normalized_channel != 'release')",
+            True,
+        ),
+        25,
+    ) in conditions
+
+    conditions = generate_conditions(fields, cluster_bytes, 1000)
+    assert validate_conditions([c for c, _ in conditions], field_values={}) == []
+    assert len(conditions) == 4
+    assert max(num_bytes for _, num_bytes in conditions) <= 1000
+    assert all(cluster.needs_clustering for cluster, _ in conditions)
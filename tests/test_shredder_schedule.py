@@ -0,0 +1,88 @@
+from datetime import date
+from functools import partial
+from types import SimpleNamespace
+import asyncio
+
+from google.api_core.exceptions import NotFound
+
+from bigquery_etl.shredder.config import ClusterCondition, DeleteTarget
+from bigquery_etl.shredder.delete import get_job_bytes, plan_table
+from bigquery_etl.shredder.schedule import Scheduler, simulate
+
+
+def test_simulate():
+    # the largest job is last in config order
+    job_bytes = [10] * 12 + [100]
+    in_order = simulate(job_bytes, 2, 4, 1, longest_first=False)
+    longest_first = simulate(job_bytes, 2, 4, 1, longest_first=True)
+    assert in_order.makespan == 130
+    assert longest_first.makespan == 100
+    assert sum(in_order.project_bytes) == sum(longest_first.project_bytes) == 220
+    assert in_order.project_bytes == [160, 60]
+    assert longest_first.project_bytes == [140, 80]
+
+
+def test_scheduler():
+    started = []
+
+    async def job(num_bytes, client):
+        started.append((num_bytes, client))
+        await asyncio.sleep(0)
+
+    async def run():
+        scheduler = Scheduler(["a", "b"], 2, 5, 1)
+        await asyncio.gather(
+            *[
+                scheduler.run(num_bytes, partial(job, num_bytes))
+                for num_bytes in [1, 5, 3, 4, 2]
+            ]
+        )
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert [num_bytes for num_bytes, _ in started] == [5, 4, 3, 2, 1]
+    assert started[:2] == [(5, "a"), (4, "b")]
+    assert sum(scheduler.assigned_bytes) == 15
+    assert scheduler.finished_bytes == scheduler.total_bytes == 15
+
+
+class FakePlanClient:
+    def __init__(self, table_bytes, partition_bytes):
+        self.table_bytes = table_bytes
+        self.partition_bytes = partition_bytes
+
+    def get_table(self, table_id):
+        table_id, _, partition_id = table_id.partition("$")
+        if not partition_id:
+            return SimpleNamespace(num_bytes=self.table_bytes)
+        if self.partition_bytes[partition_id] is None:
+            raise NotFound(table_id)
+        return SimpleNamespace(num_bytes=self.partition_bytes[partition_id])
+
+    def query(self, query, job_config):
+        rows = [{"partition_id": partition_id} for partition_id in self.partition_bytes]
+        return SimpleNamespace(result=lambda: rows)
+
+
+def test_plan_table():
+    client = FakePlanClient(1000, {"20200101": 10, "20200102": 900, "20200103": 90})
+    target = DeleteTarget(
+        table="d.t",
+        field="client_id",
+        cluster_conditions=(ClusterCondition("TRUE", True),),
+    )
+    table, partitions = asyncio.run(
+        plan_table(client, target, date(2020, 1, 3), max_single_dml_bytes=10 ** 9)
+    )
+    # partitions on or after end_date aren't planned or fetched
+    assert partitions == [
+        ("20200101", date(2020, 1, 1), 10),
+        ("20200102", date(2020, 1, 2), 900),
+    ]
+    assert get_job_bytes([(target, (table, partitions))]) == [10, 900]
+    # partitions whose size can't be fetched get an even share of the table
+    client.partition_bytes["20200102"] = None
+    _, partitions = asyncio.run(
+        plan_table(client, target, date(2020, 1, 3), max_single_dml_bytes=10 ** 9)
+    )
+    assert [partition_bytes for _, _, partition_bytes in partitions] == [10, 500]
@@ -0,0 +1,50 @@
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+from bigquery_etl.shredder.state import SqliteState
+
+START_DATE = date(2020, 1, 1)
+END_DATE = date(2020, 1, 15)
+
+
+def job(job_id, ended=None, destination=None, total_bytes_processed=None):
+    return SimpleNamespace(
+        project="p",
+        location="US",
+        job_id=job_id,
+        started=datetime(2020, 1, 15, tzinfo=timezone.utc),
+        ended=ended,
+        destination=destination,
+        total_bytes_processed=total_bytes_processed,
+    )
+
+
+def test_sqlite_state(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = SqliteState(path, START_DATE, END_DATE, batch_size=10).load()
+    assert state.tasks == {}
+    destination = SimpleNamespace(project="p", dataset_id="d", table_id="t")
+    ended = datetime(2020, 1, 16, tzinfo=timezone.utc)
+    state.started("delete", job("a"))
+    state.finished("delete", job("a", ended, destination, 10))
+    # rows for finished jobs are buffered until flushed
+    tasks = SqliteState(path, START_DATE, END_DATE).load().tasks
+    assert tasks["delete"].job_ended is None
+    # rows for started jobs are written immediately, with buffered rows
+    state.started("copy", job("b"))
+    tasks = SqliteState(path, START_DATE, END_DATE).load().tasks
+    assert tasks["delete"].job_ended == ended
+    assert tasks["copy"].job_ended is None
+    state.flush()
+
+    tasks = SqliteState(path, START_DATE, END_DATE).load().tasks
+    assert tasks.keys() == {"delete", "copy"}
+    assert tasks["copy"].job == "p.US.b"
+    assert tasks["copy"].job_ended is None
+    completed = tasks["delete"].completed_job()
+    assert completed.ended == ended
+    assert completed.total_bytes_processed == 10
+    assert completed.destination.table_id == "t"
+    assert completed.ddl_target_table == completed.destination
+    # rows are only loaded for the same dates
+    assert SqliteState(path, START_DATE, date(2020, 1, 16)).load().tasks == {}
@@ -0,0 +1,44 @@
+from bigquery_etl.parse_udf import prepend_udf_usage_definitions
+from bigquery_etl.udf_cost import measure, measure_files, persistent_variant
+from tests.udf_helpers import raw_udf, udf_graph
+
+JS = "CREATE TEMP FUNCTION udf_js_h() RETURNS INT64 LANGUAGE js AS 'return 1';"
+
+
+GRAPH = udf_graph(
+    raw_udf("udf_f", "udf_g", definition="CREATE TEMP FUNCTION udf_f() AS (udf_g());"),
+    raw_udf("udf_g", definition="CREATE TEMP FUNCTION udf_g() AS (1);"),
+    raw_udf("udf_js_h", definition=JS),
+)
+
+
+def test_measure():
+    text = "SELECT udf_f(), udf_js_h()"
+    cost = measure(text, GRAPH)
+    assert cost.udfs == ["udf_g", "udf_f", "udf_js_h"]
+    assert cost.depth == 2
+    assert cost.js_udfs == ["udf_js_h"]
+    assert cost.js_bytes == len(JS) + 2
+    full_text = prepend_udf_usage_definitions(text, GRAPH)
+    assert cost.inline_bytes == len(full_text) - len(text)
+    assert cost.mode(threshold=cost.inline_bytes) == "inline"
+    assert cost.mode(threshold=cost.inline_bytes - 1) == "persistent"
+    assert measure("SELECT 1", GRAPH).depth == 0
+
+
+def test_measure_files(tmp_path):
+    paths = []
+    for name, text in [("a", "SELECT udf_js_h()"), ("b", "SELECT udf_js_h(), 1")]:
+        paths.append(str(tmp_path / f"{name}.sql"))
+        (tmp_path / f"{name}.sql").write_text(text)
+    assert [c.duplicate_js_bytes for c in measure_files(paths, GRAPH)] == [
+        len(JS) + 2
+    ] * 2
+    assert measure_files(paths[:1], GRAPH)[0].duplicate_js_bytes == 0
+
+
+def test_persistent_variant():
+    assert persistent_variant("SELECT udf_f(), udf_js_h(), my_udf_f, udf_x", GRAPH) == (
+        "SELECT udf.f(), udf_js.h(), my_udf_f, udf_x"
+    )
+    assert persistent_variant("SELECT udf_f()", GRAPH, "p") == "SELECT `p`.udf.f()"
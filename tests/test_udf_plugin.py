@@ -0,0 +1,46 @@
+from bigquery_etl.pytest_plugin.udf import assign_batches, batch_script
+from tests.udf_helpers import udf_graph
+
+
+def test_batch_script():
+    graph = udf_graph(("udf_f",), ("udf_g",))
+    script = batch_script(
+        {"udf_f#1": "SELECT udf_f();", "udf_f#2": "SELECT udf_f()"}, graph
+    )
+    statements = script.split("\n\n")
+    assert statements[0].startswith("DECLARE udf_test_failures")
+    assert statements[1] == "CREATE TEMP FUNCTION udf_f() AS ();"
+    assert statements[2].startswith("BEGIN\nSELECT udf_f();\nEXCEPTION WHEN ERROR")
+    assert '"udf_f#2" AS test' in statements[3]
+    assert statements[4] == "SELECT test, message FROM UNNEST(udf_test_failures);"
+
+
+class FakeTest:
+    def __init__(self, parent, name, xfail=False, skip=False):
+        self.parent = parent
+        self.name = name
+        self.test = f"SELECT {name}"
+        self.xfail = xfail
+        self.skip = skip
+        self.batch = None
+
+    def get_closest_marker(self, name):
+        return name == "skip" and self.skip or None
+
+
+def test_assign_batches():
+    tests = [
+        FakeTest("f", "f#1"),
+        FakeTest("f", "f#2", xfail=True),
+        FakeTest("g", "g#1"),
+        FakeTest("h", "h#1", skip=True),
+        FakeTest("i", "i#1"),
+        FakeTest("i", "i#2"),
+    ]
+    assign_batches(tests, 2)
+    f1, f2, g1, h1, i1, i2 = tests
+    assert f2.batch is None and h1.batch is None
+    assert f1.batch is g1.batch
+    assert list(f1.batch.tests) == ["f#1", "g#1"]
+    assert i1.batch is i2.batch is not f1.batch
+    assert i1.batch.tests == {"i#1": "SELECT i#1", "i#2": "SELECT i#2"}
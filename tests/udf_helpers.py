@@ -0,0 +1,23 @@
+from bigquery_etl.parse_udf import RawUdf, UdfGraph
+
+UDF_DIRS = ("udf_js", "udf_legacy", "udf", "assert")
+
+
+def raw_udf(name, *dependencies, definition=None):
+    """Make a RawUdf that calls its dependencies, in the directory for its name."""
+    udf_dir = next(d for d in UDF_DIRS if name.startswith(d + "_"))
+    if definition is None:
+        definition = f"CREATE TEMP FUNCTION {name}() AS ({', '.join(dependencies)});"
+    return RawUdf(
+        name,
+        f"{udf_dir}/{name[len(udf_dir) + 1:]}.sql",
+        [definition],
+        [],
+        list(dependencies),
+    )
+
+
+def udf_graph(*specs):
+    """Make a UdfGraph from RawUdfs, or tuples of a name and its dependencies."""
+    raw_udfs = [spec if isinstance(spec, RawUdf) else raw_udf(*spec) for spec in specs]
+    return UdfGraph({udf.name: udf for udf in raw_udfs})